@@ -203,7 +203,12 @@ void bitbang_backdoor()
      * Fill words   96 word(address) word(pattern) word(wordcount)  -> word(pattern ^ (4+last_address))
      * Exit         87                                              -> 55
      * Fill bytes   78 word(address) byte(pattern) word(bytecount)  -> word(pattern ^ (1+last_address))
+     * Write block  69 word(address) word(wordcount) word(data) * wordcount -> word(last_data ^ (4+last_address))
      * Signature    (other)                                               -> (text line)
+     *
+     * Builds with the write block command say so in their signature, so the
+     * host never sends 69 to an older backdoor that would read its payload
+     * as a stream of opcodes.
      */
 
     critical_section crit;
@@ -289,9 +294,20 @@ void bitbang_backdoor()
                 }
                 break;
 
+            case 0x69:      // Write block
+                address = bitbang_read32();
+                aux = bitbang_read32();
+                while (aux) {
+                    data = bitbang_read32();
+                    *(uint32_t*)address = data;
+                    address += 4;
+                    aux--;
+                }
+                break;
+
             default:
             bitbang_read32();
-                bitbang("~MeS`14 [bitbang]\r\n");
+                bitbang("~MeS`14 [bitbang wb]\r\n");
                 continue;
         }
 
@@ -48,11 +48,18 @@ class BitbangDevice:
     To switch to this device in cmshell, you can use the %bitbang command.
     """
 
+    # Signature lines the backdoor sends, and whether that build has write block
+    signatures = {
+        b'~MeS`14 [bitbang]\r\n': False,
+        b'~MeS`14 [bitbang wb]\r\n': True,
+    }
+
     def __init__(self, serial_port):
         # Only require pyserial if we're using BitbangDevice
         import serial
         self.port = serial.Serial(port=serial_port, baudrate=57600, timeout=0.25)
         self.synchronized = False
+        self.has_write_block = False
         self.sync()
 
     def _write(self, s, delay = 2):
@@ -107,16 +114,17 @@ class BitbangDevice:
     def sync(self):
         # Gross delay-based synchronization, but it keeps the part on the slow CPU simple.
         self.synchronized = False
-        expected_signature = b'~MeS`14 [bitbang]\r\n'
         self.port.flushInput()
         self._write(b'\n' * 32)
         self._delay(100)
 
-        if self.port.read(len(expected_signature)) == expected_signature:
+        signature = self.port.readline()
+        if signature in self.signatures:
             # Make sure we're synchronized, cuz the dumb protocol is dumb.
             # This discards input until timeout, so we know there's no buffered
             # data anywhere in the system.
             self.port.read(0x10000)
+            self.has_write_block = self.signatures[signature]
             self.synchronized = True
         else:
             raise IOError("Can't establish contact with bitbang_backdoor()")
@@ -188,6 +196,25 @@ class BitbangDevice:
         check = struct.unpack('<I', self.port.read(4))[0]
         self._check(check, byte, address + bytecount)
 
+    def write_block(self, address, data):
+        # Word-aligned data, any length. The protocol has no limit, but a
+        # dropped byte means resending the whole command, so go 1 kB at a time.
+        # Older backdoor builds don't have the command; poke each word instead.
+        if not self.has_write_block:
+            for offset in range(0, len(data), 4):
+                self.poke(address + offset, struct.unpack_from('<I', data, offset)[0])
+            return
+        for offset in range(0, len(data), 0x400):
+            self._write_block(address + offset, data[offset:offset + 0x400])
+
+    @_auto_retry
+    @_maintain_sync
+    def _write_block(self, address, data):
+        wordcount = len(data) // 4
+        self._write(struct.pack('<BII', 0x69, address, wordcount) + data)
+        check = struct.unpack('<I', self.port.read(4))[0]
+        self._check(check, struct.unpack('<I', data[-4:])[0], address + 4 * wordcount)
+
     @_auto_retry
     @_maintain_sync
     def exit(self):
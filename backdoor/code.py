@@ -25,7 +25,7 @@ __all__ = [
 
     # ARM disassembler
     'disassemble_string', 'disassemble',
-    'disassembly_lines', 'disassemble_context',
+    'Instruction', 'disassembly_lines', 'disassemble_context',
     'side_by_side_disassembly',
 
     # 8051 support
@@ -284,18 +284,24 @@ def prepare_cppfile(temp, includes, defines, body):
     ''' % locals())
 
 
+# Flags for every C++ compile, after the input and output files
+cc_flags = [
+    '-I', '../lib',                           # Project-wide includes
+    '-Os', '-fwhole-program', '-nostdlib',    # Important to keep this as tiny as possible
+    '-fpermissive', '-Wno-multichar',         # Relax, this is a debugger.
+    '-fno-exceptions',                        # Lol, no
+    '-std=gnu++11',                           # But compile-time abstraction is awesome
+    '-lgcc',                                  # Runtime support for multiply, divide, switch...
+]
+
+
 def compile_objfile(temp, thumb):
     """Compile a C++ expression to an object file"""
 
     compiler = subprocess.Popen([
         CC,
-        '-I', '../lib',                           # Project-wide includes
         '-o', temp.o, temp.cpp, '-T', temp.ld,    # Ins and outs
-        '-Os', '-fwhole-program', '-nostdlib',    # Important to keep this as tiny as possible
-        '-fpermissive', '-Wno-multichar',         # Relax, this is a debugger.            
-        '-fno-exceptions',                        # Lol, no
-        '-std=gnu++11',                           # But compile-time abstraction is awesome
-        '-lgcc',                                  # Runtime support for multiply, divide, switch...
+        ] + cc_flags + [
         ('-mthumb', '-mno-thumb')[not thumb]      # Thumb or not?
         ],
         stderr = subprocess.STDOUT,
@@ -469,35 +475,46 @@ text:
         return d.blx(address, r0)
 
 
-def disassembly_lines(text):
-    """Convert disassembly text to a sequence of objects
+class Instruction(object):
+    """One line of disassembly, also used as an entry in the simulator's icache.
 
-    Each object has attributes:
-        - address
-        - op
-        - args
-        - comment
+    Slotted, since the simulator keeps lots of these. 'next_address' is set
+    once we know where the following instruction starts; 'hle' and 'opfunc'
+    (the simulator's executor for this instruction) start out as None.
     """
-    class disassembly_line:
-        def __str__(self):
-            return '\t%s\t%s' % (self.op, self.args)
-        def __repr__(self):
-            return 'disassembly_line(address=%08x, op=%r, args=%r, comment=%r)' % (
-                self.address, self.op, self.args, self.comment)
+    __slots__ = ('address', 'next_address', 'op', 'args', 'comment', 'hle', 'opfunc')
+
+    def __init__(self, address, op, args = '', comment = '', next_address = None):
+        self.address = address
+        self.next_address = next_address
+        self.op = op
+        self.args = args
+        self.comment = comment
+        self.hle = None
+        self.opfunc = None
 
+    def __str__(self):
+        return '\t%s\t%s' % (self.op, self.args)
+
+    def __repr__(self):
+        return '%s(address=%08x, op=%r, args=%r, comment=%r)' % (
+            type(self).__name__, self.address, self.op, self.args, self.comment)
+
+
+def disassembly_lines(text):
+    """Convert disassembly text to a list of Instruction objects,
+    with attributes address, op, args, and comment.
+    """
     lines = []
     line_re = re.compile(r'^([^\t]+)\t([^\t]+)?([^;]*)(.*)')
     for line in text.split('\n'):
 
-        obj = disassembly_line()
         m = line_re.match(line)
         if not m:
             raise ValueError('Bad disassembly,\n%s' % line)
 
-        obj.address = int(m.group(1), 16)
-        obj.op = m.group(2) or '<unknown>'
-        obj.args = m.group(3).strip()
-        obj.comment = m.group(4)[1:].strip()
+        obj = Instruction(int(m.group(1), 16), m.group(2) or '<unknown>',
+            m.group(3).strip(), m.group(4)[1:].strip())
 
         if obj.op.find('out of bounds') > 0:
             continue
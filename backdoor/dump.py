@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 import sys, struct, time
+from memory_map import *
 
 # Use on the command line to interactively dump regions of memory.
 # Or import as a library for higher level dumping functions.
 
 __all__ = [
     'words_from_string',
-    'poke_words', 'poke_words_from_string', 'poke_bytes',
+    'poke_words', 'poke_words_from_string', 'poke_bytes', 'write_block',
     'read_block', 'scsi_read_buffer',
     'hexdump', 'hexdump_words',
     'dump', 'dump_words',
@@ -85,6 +86,20 @@ def poke_bytes(d, address, bytes, verbose = True, reporting_interval = 0.1):
     progress.complete(l, l)
 
 
+def write_block(d, address, data):
+    """Write a word-aligned block of data in as few round trips as we can.
+    Uses the device's own write_block() if it has one, otherwise pokes each word.
+    """
+    assert (address & 3) == 0
+    assert (len(data) & 3) == 0
+    fn = getattr(d, 'write_block', None)
+    if fn:
+        fn(address, data)
+    else:
+        for i, w in enumerate(struct.unpack('<%dI' % (len(data) // 4), data)):
+            d.poke(address + 4*i, w)
+
+
 def scsi_read_buffer(d, mode, address, size):
     """Use the SCSI 'Read Buffer' command to grab a block of data quickly.
 
@@ -92,7 +107,7 @@ def scsi_read_buffer(d, mode, address, size):
     with mode 6 mapped to ARM memory (low 16MB only) and mode 2 mapped
     to something we'll call DMA memory.
     """
-    return d.scsi_in(b''.join(map(chr, [
+    return d.scsi_in(bytes([
         0x3c, mode, 0,
         (address >> 16) & 0xff,
         (address >> 8) & 0xff,
@@ -100,7 +115,7 @@ def scsi_read_buffer(d, mode, address, size):
         (size >> 16) & 0xff,
         (size >> 8) & 0xff,
         (size >> 0) & 0xff,
-        0,0,0 ])), size)
+        0,0,0 ]), size)
 
 
 def read_word_aligned_block(d, address, size,
@@ -118,7 +133,7 @@ def read_word_aligned_block(d, address, size,
 
     while i < size:
         wordcount = min(size - i, 64*1024) // 4
-        dram_address = (address - 0x1c08000) & 0xffffffff
+        dram_address = (address - dram_base) & 0xffffffff
 
         if addr_space == 'dma' and hasattr(d, 'scsi_in'):
             # Undocumented SCSI command that reads some kind of DMA memory space.
@@ -129,9 +144,9 @@ def read_word_aligned_block(d, address, size,
         elif fast and hasattr(d, 'scsi_in') and addr_space == 'arm' and dram_address + i <= 0x368000:
             # Use the DMA reads, where we can, to implement fast DRAM reads.
 
-            part = scsi_read_buffer(d, 2, address - 0x1c08000 + i, wordcount * 4)
+            part = scsi_read_buffer(d, 2, address - dram_base + i, wordcount * 4)
 
-        elif fast and hasattr(d, 'scsi_in') and addr_space == 'arm' and address + i <= 0x200000:
+        elif fast and hasattr(d, 'scsi_in') and addr_space == 'arm' and address + i <= flash_size:
             # Undocumented SCSI command that copies data from flash addresses
             # via the ARM to DRAM and DMA's it out to SCSI. Very fast, handles
             # addreses (including RAM mappings) below 2MB.
@@ -0,0 +1,132 @@
+# Map of the ARM address space, and how each region may be accessed.
+#
+# This is the one place that knows which memory is safe to cache, to read in
+# large blocks, or to write out of order. The simulator picks its caching and
+# store policy from it, and dump.py and memsquare.py use it to decide where the
+# fast paths apply. See doc/cpu-arm.txt for how these ranges were found.
+
+__all__ = [
+    'MemoryRegion', 'MemoryMap', 'default_memory_map',
+    'flash_size', 'dram_base',
+]
+
+import bisect
+
+flash_size = 0x200000
+dram_base = 0x1c08000
+
+# Nothing is mapped at or above this address, as far as we know
+address_limit = 0x05000000
+
+region_kinds = ('flash', 'dram', 'sram', 'mmio', 'unknown')
+write_policies = ('combine', 'direct')
+
+
+class MemoryRegion(object):
+    """One inclusive range [begin, end] of the address space.
+
+    'kind' is one of 'flash', 'dram', 'sram', 'mmio' or 'unknown'.
+
+    'cacheable' regions only change when we write them, and reading them has
+    no side effects, so a local copy stays good. 'prefetch' is how many bytes
+    to read at once on a local cache miss, or zero to read one access at a time.
+
+    'write' is 'combine' if stores can be held back and merged into larger
+    writes (until a load overlaps them), or 'direct' if every store has to
+    reach the hardware right away and in order.
+
+    'paged' regions are demand-paged into the simulator: a whole page is read
+    on first access, and loads and stores use the local copy until it's
+    written back. Only safe where nothing else (DMA, other CPUs) writes.
+    """
+    def __init__(self, begin, end, kind, name = '', cacheable = False, prefetch = 0, write = 'direct', paged = False):
+        if kind not in region_kinds:
+            raise ValueError("Unknown memory region kind %r" % kind)
+        if write not in write_policies:
+            raise ValueError("Unknown write policy %r" % write)
+        self.begin = begin
+        self.end = end
+        self.kind = kind
+        self.name = name or kind
+        self.cacheable = cacheable
+        self.prefetch = prefetch
+        self.write = write
+        self.paged = paged
+
+    def __repr__(self):
+        return 'MemoryRegion(%08x-%08x %s %r)' % (self.begin, self.end, self.kind, self.name)
+
+    def copy(self):
+        return MemoryRegion(self.begin, self.end, self.kind, self.name,
+            self.cacheable, self.prefetch, self.write, self.paged)
+
+    @property
+    def size(self):
+        return self.end - self.begin + 1
+
+
+class MemoryMap(object):
+    """Sorted, non-overlapping list of MemoryRegions.
+    Gaps below 'limit' are filled with 'unknown' regions; lookups at or
+    above 'limit' find nothing.
+    """
+    def __init__(self, regions, limit = address_limit):
+        self.limit = limit
+        self.regions = []
+        next_address = 0
+        for r in sorted(regions, key=lambda r: r.begin):
+            if r.begin < next_address:
+                raise ValueError("Memory regions overlap at %08x" % r.begin)
+            if r.begin > next_address:
+                self.regions.append(MemoryRegion(next_address, r.begin - 1, 'unknown'))
+            self.regions.append(r)
+            next_address = r.end + 1
+        if next_address < limit:
+            self.regions.append(MemoryRegion(next_address, limit - 1, 'unknown'))
+        self._begins = [r.begin for r in self.regions]
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def copy(self):
+        """An independent copy, for changing policies without affecting other tools"""
+        return MemoryMap([r.copy() for r in self.regions], self.limit)
+
+    def lookup(self, address):
+        """The region containing an address, or None"""
+        i = bisect.bisect_right(self._begins, address) - 1
+        if i >= 0:
+            r = self.regions[i]
+            if address <= r.end:
+                return r
+
+    def find(self, name):
+        """The first region with a name or kind"""
+        return self.select(name)[0]
+
+    def select(self, name):
+        """All regions with a name, or else all regions of a kind"""
+        regions = [r for r in self.regions if r.name == name] or [r for r in self.regions if r.kind == name]
+        if not regions:
+            raise ValueError("No memory region named %r" % name)
+        return regions
+
+    def cacheable(self, address, size):
+        """Is every byte of this range safe to keep a local copy of?"""
+        while size > 0:
+            r = self.lookup(address)
+            if r is None or not r.cacheable:
+                return False
+            size -= r.end + 1 - address
+            address = r.end + 1
+        return True
+
+
+default_memory_map = MemoryMap([
+    MemoryRegion(0x00000000, flash_size - 1, 'flash', 'Flash',
+        cacheable=True, prefetch=0x100),
+    MemoryRegion(dram_base, 0x01ffffff, 'dram', 'Shared DRAM', write='combine'),
+    MemoryRegion(0x02000000, 0x02001fff, 'sram', 'System SRAM', write='combine'),
+    MemoryRegion(0x02002000, 0x02007fff, 'dram', 'System DRAM', write='combine'),
+    MemoryRegion(0x04000000, 0x043fffff, 'mmio', 'Memory mapped I/O'),
+])
@@ -8,6 +8,7 @@
 __all__ = ['categorize_block', 'categorize_block_array', 'memsquare']
 
 from dump import *
+from memory_map import *
 from math import log
 from hilbert import hilbert
 import remote, sys, png, struct, time
@@ -127,9 +128,13 @@ def low64():
     # Each pixel is 4 bytes, so this is about as much resolution as we could want.
     memsquare(remote.Device(), 'memsquare-00000000-3fffffff.png', 0, 4)
 
+def region_filename(r):
+    return 'memsquare-%08x-%08x.png' % (r.begin, r.end)
+
 def mmio():
     # Map every byte in 4MB of MMIO space
-    memsquare(remote.Device(), 'memsquare-04000000-043fffff.png', 0x04000000, 1, 2048)
+    r = default_memory_map.find('mmio')
+    memsquare(remote.Device(), region_filename(r), r.begin, 1, 2048)
 
 def dram():
     # Fast dump of DRAM. 512x512, 16 byte scale.
@@ -138,7 +143,19 @@ def dram():
 
 def sram():
     # Small 8kB mapping, looks like SRAM. 2-byte scale.
-    memsquare(remote.Device(), 'memsquare-02000000-02001fff.png', 0x02000000, 2, 64)
+    r = default_memory_map.find('sram')
+    memsquare(remote.Device(), region_filename(r), r.begin, 2, 64)
+
+def regions():
+    # One image per known region in the memory map, up to 512x512 each
+    d = remote.Device()
+    for r in default_memory_map:
+        if r.kind != 'unknown':
+            pixelsize = 512
+            while pixelsize > 1 and (pixelsize // 2) ** 2 >= r.size:
+                pixelsize //= 2
+            blocksize = max(1, r.size // (pixelsize * pixelsize))
+            memsquare(d, region_filename(r), r.begin, blocksize, pixelsize)
 
 def dma():
     # DMA memory space, starting with DRAM. 
@@ -146,7 +163,7 @@ def dma():
 
 
 if __name__ == '__main__':
-    modes = ['survey', 'low64', 'mmio', 'dram', 'sram', 'dma']
+    modes = ['survey', 'low64', 'mmio', 'dram', 'sram', 'regions', 'dma']
     if len(sys.argv) == 2 and sys.argv[1] in modes:
         globals()[sys.argv[1]]()
     else:
@@ -10,7 +10,7 @@ from IPython.core.magic_arguments import magic_arguments, argument, parse_argstr
 from IPython.core.display import display
 from IPython.core.error import UsageError
 
-import struct, sys, json, argparse, time
+import struct, sys, os, json, argparse, time
 from hilbert import hilbert
 import target_memory
 import remote
@@ -25,6 +25,12 @@ from hook import *
 from bitfuzz import *
 from bitbang import *
 from sim_arm import *
+from sim_trace import *
+from sim_offline import *
+from sim_replay import *
+from sim_profile import *
+from sim_history import *
+from sim_coverage import *
 from cpu8051 import *
 
 
@@ -737,11 +743,21 @@ class ShellMagics(magic.Magics):
     @magic.line_magic
     @magic_arguments()
     @argument('-l', '--log', type=argparse.FileType('a'), default='trace.log', metavar='FILE', help='Append logs to a file')
+    @argument('-t', '--trace', type=argparse.FileType('ab'), metavar='FILE', help='Append a compact binary trace (e.g. sim.trace) instead of text logs; see sim_trace.py')
     @argument('-r', '--reset', type=hexint, help='Reset the processor, sending it to the indicated vector')
     @argument('-c', '--continuous', action='store_true', help='Keep taking steps until interrupted')
     @argument('-b', '--breakpoint', type=hexint, help='Run until the program counter matches')
     @argument('-S', '--save', type=str, metavar='FILE', help='Save local simulation state to files')
     @argument('-L', '--load', type=str, metavar='FILE', help='Load local simulation state from files')
+    @argument('--offline', type=str, metavar='FIRMWARE', help='Start a new simulation with no hardware, using a 2 MB firmware image')
+    @argument('--record', type=str, metavar='FILE', help='Record all device traffic during this command')
+    @argument('--replay', type=str, metavar='FILE', help='Answer device traffic from a recording instead of hardware')
+    @argument('--profile', action='store_true', help='Profile this command, then report hot spots and stub candidates')
+    @argument('--flame', type=argparse.FileType('w'), metavar='FILE', help='Profile this command, and write its call stacks to a file for flame graph tools')
+    @argument('--coverage', type=str, metavar='FILE', help='Add the code this command executes to a coverage map file; see sim_coverage.py')
+    @argument('--history', type=int, metavar='STEPS', help='Start keeping a checkpoint every STEPS steps and a log of device traffic, for --back and --when')
+    @argument('--back', type=int, metavar='N', help='Go back N steps, re-executing from the nearest checkpoint without hardware')
+    @argument('--when', type=str, metavar='REG_OR_HEX', help='Find the last step that changed a register or local memory word')
     @argument('steps', nargs='?', type=int, help='Number of steps to take (decimal int)')
     def sim(self, line):
         """Take a step in a simulated ARM processor.
@@ -749,11 +765,32 @@ class ShellMagics(magic.Magics):
         The first time you call %sim, it creates a simulation state object as
         'arm' in the shell. Afterwards, %sim by default takes a single step,
         and bridges simulated registers to and from shell variables.
+
+        With --offline, a new simulation runs against an OfflineDevice instead
+        of 'd', and needs no hardware at all.
+
+        With --record or --replay, the device is wrapped for the duration of
+        this command. Use them on the command that creates the simulation to
+        include its setup traffic.
+
+        With --history, every later command keeps checkpoints and a device log
+        so that --back can step backwards and --when can search the past.
+
+        With --flame, the profiler's shadow call stack is written as a
+        collapsed stack file (steps per stack), ready for flamegraph.pl.
+
+        With --coverage, the flash halfwords this command executes are merged
+        into a coverage map file, created if needed. SimCoverage.load() reads
+        it back, and write_png() draws it.
         """
         args = parse_argstring(self.sim, line)
         ns = self.shell.user_ns
         d = ns['d']
         arm = ns.get('arm')
+        if args.offline:
+            if arm:
+                raise UsageError("Simulation already exists; 'del arm' first to go offline")
+            d = OfflineDevice(args.offline)
         steps = args.steps
         state = 'idle'
         logfile = args.log
@@ -761,24 +798,55 @@ class ShellMagics(magic.Magics):
             steps = 1e100
         pc_break = (args.breakpoint or -1) & 0xfffffffe
 
+        def wrap_device(device):
+            if args.replay:
+                device = ReplayDevice(args.replay)
+            if args.record:
+                device = RecordingDevice(device, args.record, lambda: arm.step_count if arm else 0)
+            return device
+
+        if args.history is not None:
+            if arm and arm.history:
+                raise UsageError("Simulation already has history")
+            if not arm and (args.record or args.replay):
+                raise UsageError("Start --history after the command that creates the simulation")
+        elif (args.back is not None or args.when) and not (arm and arm.history):
+            raise UsageError("No history; start keeping it with --history")
+
         if arm:
             # Update existing ARM object, default to 1 step
             if steps is None: steps = 1
             arm.copy_registers_from(ns)
             arm.device = d
+            if args.history is not None:
+                SimHistory(args.history).attach(arm)
+            saved_device = arm.memory.device
+            arm.memory.device = wrap_device(saved_device)
         else:
             # New simulator object, default to 0 steps
             if steps is None: steps = 0
-            arm = simulate_arm(d)
+            saved_device = d
+            arm = simulate_arm(wrap_device(d))
             ns['arm'] = arm
             sys.stdout.write('- initialized simulation state\n')
             state = 'INIT'
             arm.copy_registers_to(ns)
 
             # Simulator shouldn't see the overlay, make sure this is off
-            overlay_set(d, None)
+            overlay_set(arm.memory.device, None)
+
+            if args.history is not None:
+                SimHistory(args.history).attach(arm)
+                saved_device = arm.memory.device
 
         arm.memory.logfile = logfile
+        trace = arm.memory.trace = args.trace and TraceWriter(args.trace)
+        profiler = (args.profile or args.flame) and SimProfiler()
+        if profiler:
+            profiler.attach(arm)
+        coverage = args.coverage and SimCoverage()
+        if coverage:
+            coverage.attach(arm)
 
         if args.load:
             arm.load_state(args.load)
@@ -793,11 +861,31 @@ class ShellMagics(magic.Magics):
             arm.save_state(args.save)
             steps = 0
 
+        if args.back is not None or args.when:
+            steps = 0
+
+        if args.back is not None:
+            state = 'BACK'
+            arm.history.back(args.back)
+            arm.copy_registers_to(ns)
+
+        if args.when:
+            what = args.when
+            if what.lower() not in arm.reg_numbers:
+                what = hexint(what)
+            change = arm.history.last_change(what)
+            if change:
+                step_count, old, new = change
+                sys.stdout.write('- last changed at step %d, %s -> %s\n' % (step_count,
+                    '%08x' % old if old is not None else 'invalid', '%08x' % new))
+            else:
+                sys.stdout.write('- no change since step %d\n' % arm.history.checkpoints[0].step_count)
+
         min_timestamp = 0
 
         # Capture 'print' output from hook functions
         saved_stdout = sys.stdout
-        sys.stdout = Tee(sys.stdout, logfile)
+        sys.stdout = Tee(sys.stdout, trace or logfile)
 
         try:
             while True:
@@ -814,8 +902,11 @@ class ShellMagics(magic.Magics):
                     min_timestamp = now + 0.25
 
                 # Write detailed output to log file
-                logfile.write('# %-70s %s\n' % (arm.summary_line(), arm.register_trace_line()))
-                assert logfile == arm.memory.logfile
+                if trace:
+                    trace.step(arm)
+                else:
+                    logfile.write('# %-70s %s\n' % (arm.summary_line(), arm.register_trace_line()))
+                    assert logfile == arm.memory.logfile
 
                 if (arm.regs[15] & ~1) == pc_break:
                     sys.stdout.write('- breakpoint reached\n%s' % arm.register_trace())
@@ -827,6 +918,30 @@ class ShellMagics(magic.Magics):
         finally:
             sys.stdout = saved_stdout
             logfile.flush()
+            if trace:
+                trace.close()
+                arm.memory.trace = None
+            if profiler:
+                profiler.detach(arm)
+            if args.profile:
+                sys.stdout.write(profiler.report())
+            if args.flame:
+                profiler.write_collapsed(args.flame)
+                args.flame.close()
+                sys.stdout.write('- wrote call stacks to %s\n' % args.flame.name)
+            if coverage:
+                coverage.detach(arm)
+                if os.path.exists(args.coverage):
+                    coverage.merge(SimCoverage.load(args.coverage))
+                coverage.save(args.coverage)
+                sys.stdout.write('- %d halfwords covered in %s\n' % (coverage.count(), args.coverage))
+            if args.record or args.replay:
+                # Pending stores belong to this recording
+                arm.memory.flush()
+            if args.record:
+                arm.memory.device.close()
+            arm.memory.device = saved_device
+            arm.memory.icache_save()
 
 
 class Tee(object):
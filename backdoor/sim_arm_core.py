@@ -1,12 +1,19 @@
 # The jankiest simulator for our janky debugger.
 # This simulation core is more of an assembly language interpreter than a CPU emulator.
 
-__all__ = [ 'SimARM', 'SimARMMemory' ]
+__all__ = [ 'SimARM', 'SimARMMemory', 'SimStop', 'HLEPrint' ]
 
-import struct, json, sys, io
+import struct, json, sys, os, re
 from code import *
 from dump import *
 from console import *
+from sim_blocks import *
+from sim_arm_decode import *
+from sim_icache import *
+from sim_pages import *
+from sim_trace import *
+from memory_map import *
+from target_memory import offload_code
 
 
 class RunEncoder(object):
@@ -34,6 +41,55 @@ class RunEncoder(object):
         self.key = (None, None, None)
         return r
 
+    def overlaps(self, address, size):
+        begin, pattern, unit = self.key
+        return self.count and address < begin + self.count * unit and begin < address + size
+
+
+class HLEPrint(object):
+    """HLE handler that only prints a line, run locally instead of on the device.
+    The template is %-formatted with 'r0', so '%(r0)08x' prints it the way
+    console() does on the device.
+    """
+    def __init__(self, template):
+        self.template = template
+
+    def __repr__(self):
+        return 'HLEPrint(%r)' % self.template
+
+    def __call__(self, memory, r0):
+        memory.hle_log(self.template % dict(r0=r0))
+
+
+class WriteCombiner(object):
+    """Gather stores that land on or next to each other into one range of bytes.
+    Both 'write' and 'flush' return an (address, data) tuple for a range
+    that has to be written first, where 'data' might be empty.
+    """
+    def __init__(self, limit = 0x400):
+        self.limit = limit
+        self.address = 0
+        self.data = bytearray()
+
+    def write(self, address, data):
+        begin = self.address
+        if self.data and begin <= address <= begin + len(self.data) and address + len(data) - begin <= self.limit:
+            offset = address - begin
+            self.data[offset:offset + len(data)] = data
+            return (0, b'')
+        r = self.flush()
+        self.address = address
+        self.data = bytearray(data)
+        return r
+
+    def flush(self):
+        r = (self.address, bytes(self.data))
+        self.data = bytearray()
+        return r
+
+    def overlaps(self, address, size):
+        return self.data and address < self.address + len(self.data) and self.address < address + size
+
 
 def lsl(a, b):
     b &= 31
@@ -91,32 +147,71 @@ def rrx(a, b, carry):
     return (a & 0xffffffff, 1 & (a >> 32))
 
 
+# Runs of the same value at least this many bytes long are sent as a fill
+fill_min_bytes = 16
+
+unit_formats = { 4: '<I', 2: '<H', 1: '<B' }
+
+# ARM code to call an offloaded function with four arguments. blx only gives
+# us r0, so that points to the arguments followed by the function address.
+offload_thunk = struct.pack('<6I',
+    0xe92d4010,     # push    {r4, lr}
+    0xe1a04000,     # mov     r4, r0
+    0xe894000f,     # ldm     r4, {r0, r1, r2, r3}
+    0xe594c010,     # ldr     ip, [r4, #16]
+    0xe12fff3c,     # blx     ip
+    0xe8bd8010,     # pop     {r4, pc}
+)
+
+
 class SimARMMemory(object):
     """Memory manager for a simulated ARM core, backed by a remote device.
 
     This manages a tiny bit of caching and write consolidation, to conserve
-    bandwidth on the bitbang debug pipe.
+    bandwidth on the bitbang debug pipe. What's safe to cache or combine
+    comes from a MemoryMap; each simulation gets its own copy to adjust.
     """
-    def __init__(self, device, logfile=None):
+    def __init__(self, device, logfile=None, memory_map=None):
         self.device = device
         self.logfile = logfile
+        self.memory_map = (memory_map or default_memory_map).copy()
+        self.trace = None
 
-        # Instruction cache
+        # Instruction cache, and translated blocks built from it
         self.instructions = {}
+        self.blocks = {}
+        self.block_boundaries = set()
 
         # Special addresses
         self.skip_stores = {}
         self.patch_notes = {}
         self.patch_hle = {}
         self.hle_handlers = {}
+        self.hle_local = {}
         self.hooks = {}
 
         # Local RAM and cached flash, reads and writes don't go to hardware
-        self.local_addresses = io.BytesIO()
-        self.local_data = io.BytesIO()
+        self.local = PageTable()
+
+        # Demand-paged memory: page number -> contents the hardware has
+        self.paged = {}
 
-        # Detect fills
+        # Persistent instruction cache, see icache_open(). It only saves
+        # flash as the device gave it to us, never our own stores there.
+        self.icache_file = None
+        self.icache_size = 0
+        self.icache_flash = PageTable()
+
+        # Optional sim_patches.PatchCache, for patch() and hle_init()
+        self.patch_cache = None
+
+        # Detect fills, and combine other RAM stores into block writes
         self.rle = RunEncoder()
+        self.combiner = WriteCombiner()
+
+        # Watchpoints for SimARM.run(), by word address
+        self.watch_words = set()
+        self.watch_suspended = False
 
     def skip(self, address, reason):
         self.skip_stores[address] = reason
@@ -128,11 +223,15 @@ class SimARMMemory(object):
 
         HLE markers will propagage to the icache, and they instruct us to invoke C++ code from sim_arm.h
         HLE markers run after the patched code, they're blocks of C++ that can optionally modify r0.
+
+        An 'hle' that isn't a string runs locally, with no device round trips. It's called
+        as fn(memory, r0) and returns the new r0, or None to leave it alone. HLEPrint
+        makes one that just prints a line.
         """
         if code:
             # Note the extra nop to facilitate the way load_assembly sizes instructions
-            s = assemble_string(address, code + '\nnop', thumb=thumb)
-            lines = disassembly_lines(disassemble_string(s, address=address, thumb=thumb))
+            text, size = self._assemble_patch(address, code + '\nnop', thumb)
+            lines = disassembly_lines(text)
 
             for l in lines[:-1]:
                 assert (l.address & 1) == 0
@@ -148,84 +247,316 @@ class SimARMMemory(object):
         # The handler is a block of code that can optionally modify r0
         if hle:
             name = 'hle_%08x' % address
-            self.hle_handlers[name] = '{uint32_t r0 = arg; %s; r0;}' % hle
+            if isinstance(hle, str):
+                self.hle_handlers[name] = '{uint32_t r0 = arg; %s; r0;}' % hle
+                self.hle_local.pop(name, None)
+            else:
+                self.hle_local[name] = hle
+                self.hle_handlers.pop(name, None)
             self.patch_hle[hle_addr] = name
 
         if code:
             # Populates icache with patch
             self._load_assembly(address, lines, thumb=thumb)
+            self.invalidate_blocks(address, size)
         else:
             # Remove cached instructions, so when they're reloaded our HLE patch will be applied
             if hle_addr in self.instructions:
                 del self.instructions[hle_addr]
+            self.invalidate_blocks(address & ~1, 2)
+
+    def _assemble_patch(self, address, code, thumb):
+        # Returns (disassembly text, size)
+        if self.patch_cache:
+            return self.patch_cache.assemble(address, code, thumb)
+        s = assemble_string(address, code, thumb=thumb)
+        return disassemble_string(s, address=address, thumb=thumb), len(s)
 
     def hook(self, address, fn):
         """At a particular address, invoke fn(arm)
         Hooks run after both the simulator proper and the HLE runs.
         """
         self.hooks[address & ~1] = fn
+        self.invalidate_blocks(address & ~1, 2)
+
+    def offload(self, address, name = '', writes = (), thumb = True, timeout = 30):
+        """Run a function on the hardware instead of simulating it.
+        When simulated code calls 'address', pending stores and paged memory
+        are written back, the device runs the real function with r0-r3, and
+        simulation resumes at lr with the r0 and r1 it returned.
+
+        'writes' lists the (address, size) ranges the function changes, or is
+        a function of the SimARM that returns them. Local copies of those are
+        invalidated afterward. Stack arguments aren't passed, and the function
+        can't see memory that only exists locally.
+        """
+        function = thumb | (address & ~1)
+        def fn(arm):
+            ranges = writes(arm) if callable(writes) else writes
+            regs = arm.regs
+            regs[0], regs[1] = self.offload_call(function, regs[:4], ranges, name, timeout)
+        self.replace_function(address, fn, 'OFFLOAD %s' % name, thumb)
+
+    def replace_function(self, address, fn, note = '', thumb = True):
+        """When simulated code calls 'address', return straight to lr and
+        invoke fn(arm) instead. The function's arguments are still in r0-r3,
+        and fn can leave results there.
+        """
+        address &= ~1
+        size = (4, 2)[thumb]
+        lines = disassembly_lines('%08x\tbx\tlr\n%08x\tnop' % (address, address + size))
+        self.instructions.pop(thumb | address, None)
+        self._load_assembly(address, lines, thumb=thumb)
+        self.invalidate_blocks(address, size)
+        self.patch_notes[address] = note or 'PATCH'
+        self.hook(address, fn)
+
+    def offload_call(self, function, args, writes = (), name = '', timeout = 30):
+        """Call a function on the hardware with up to four arguments.
+        Demand-paged memory is written back first and read again afterwards.
+        Also invalidates local copies of the 'writes' ranges. Returns (r0, r1).
+        """
+        self.write_back()
+        args = (list(args) + [0] * 4)[:4]
+        write_block(self.device, offload_code, offload_thunk + struct.pack('<5I', *(args + [function])))
+        r0, r1 = self.device.blx(offload_code, offload_code + len(offload_thunk), timeout=timeout)
+        self.drop_pages()
+        for address, size in writes:
+            self.invalidate(address, size)
+        self.log_message('OFFLOAD: %s %08x(%s) -> %08x\n' % (
+            name, function, ', '.join('%08x' % a for a in args), r0))
+        return r0, r1
+
+    def invalidate(self, address, size):
+        """Forget what we know about memory that changed behind our back.
+        Paged memory is read again when it's next used, other local data is
+        refreshed from the device, and instructions decoded from the range
+        are dropped (except for patches).
+        """
+        end = address + size
+        for number in range(address >> page_shift, ((end - 1) >> page_shift) + 1):
+            if number in self.paged:
+                self.local.discard(number)
+                del self.paged[number]
+        for begin, data in self.local.runs(address, end):
+            self.fetch_local_data(begin, len(data))
+        for key in [k for k in self.instructions if address <= (k & ~1) < end]:
+            if (key & ~1) not in self.patch_notes:
+                del self.instructions[key]
+        self.invalidate_blocks(address, size)
+
+    def watch(self, addresses):
+        """Trap stores to the words at these addresses, replacing any earlier set"""
+        self.watch_words = set(a & ~3 for a in addresses)
+        pages = set(w >> page_shift for w in self.watch_words)
+        for number in list(self.local.watched):
+            if number not in pages:
+                self.local.unwatch(number)
+        for number in pages:
+            self.local.watch(number, self._watch_trap)
+
+    def _watch_trap(self, address, size):
+        if self.watch_suspended:
+            return
+        for w in range(address & ~3, address + size, 4):
+            if w in self.watch_words:
+                raise WatchpointHit(address, size)
+
+    def invalidate_blocks(self, address, size):
+        """Throw away any translated blocks that cover part of a memory range"""
+        for key, block in list(self.blocks.items()):
+            if block.overlaps(address, size):
+                del self.blocks[key]
+
+    def block_boundary(self, address):
+        """Make sure a translated block begins at this address.
+        Used for breakpoints, so we can check them between blocks.
+        """
+        address &= ~1
+        if address not in self.block_boundaries:
+            self.block_boundaries.add(address)
+            self.invalidate_blocks(address, 1)
 
     def save_state(self, filebase):
         """Save state to disk, using files beginning with 'filebase'"""
-        with open(filebase + '.addr', 'wb') as f:
-            f.write(self.local_addresses.getvalue())
-        with open(filebase + '.data', 'wb') as f:
-            f.write(self.local_data.getvalue())
+        with open(filebase + '.pages', 'wb') as f:
+            self.local.save(f)
 
-    def load_state(self, filebase):
-        """Load state from save_state()"""
-        with open(filebase + '.addr', 'rb') as f:
-           self.local_addresses = io.BytesIO()
-           self.local_addresses.write(f.read())
-        with open(filebase + '.data', 'rb') as f:
-            self.local_data = io.BytesIO()
-            self.local_data.write(f.read())
+    def load_state(self, filebase, delta = False):
+        """Load state from save_state()
+        Also understands the older format, with flat '.addr' and '.data' files.
+        With 'delta', applies the pages on top of the current local memory.
+        """
+        local = self.local if delta else PageTable()
+        if os.path.exists(filebase + '.pages'):
+            with open(filebase + '.pages', 'rb') as f:
+                local.load(f)
+        else:
+            with open(filebase + '.addr', 'rb') as f:
+                flags = f.read()
+            with open(filebase + '.data', 'rb') as f:
+                data = f.read()
+            for m in re.finditer(b'\xff+', flags):
+                local.mark(m.start(), m.end() - 1)
+                local.write(m.start(), data[m.start():m.end()])
+        self.local = local
+
+    def icache_open(self, directory = '.'):
+        """Use a persistent instruction cache file for the flash we're connected to.
+        Anything already in the file goes straight into the local flash and
+        instruction caches. Patches are not cached, and take priority as long
+        as they're installed first.
+        """
+        fingerprint = flash_fingerprint(self)
+        self.icache_file = icache_filename(fingerprint, directory)
+        self.icache_fingerprint = fingerprint
+
+        cached = read_icache(self.icache_file, fingerprint)
+        if cached:
+            blocks, instructions = cached
+            for address, data in blocks:
+                self.local.write(address, data)
+                self.icache_flash.write(address, data)
+
+            for key, size, text in instructions:
+                address = key & ~1
+                thumb = key & 1
+                if text is None:
+                    instr = decode_instruction(self.local.read(address, size), 0, address, thumb)
+                else:
+                    instr = disassembly_lines('%08x\t%s' % (address, text))[0]
+                    instr.next_address = address + size
+                if instr:
+                    self._cache_instruction(instr, thumb)
+
+            print("* Loaded %d cached instructions from %s" % (len(instructions), self.icache_file))
+        self.icache_size = len(self.instructions)
+
+    def icache_save(self):
+        """Write new flash instructions back to the file from icache_open()"""
+        if not self.icache_file or len(self.instructions) == self.icache_size:
+            return
+
+        instructions = []
+        for key, instr in self.instructions.items():
+            address = key & ~1
+            size = instr.next_address - address
+            if address >= flash_size or address in self.patch_notes:
+                continue
+            if (not self.icache_flash.valid(address, size) or
+                    self.icache_flash.read(address, size) != self.local.read(address, size)):
+                # Decoded from something we stored, not from the flash
+                continue
+            if isinstance(instr, DecodedInstruction):
+                text = None
+            else:
+                text = '%s\t%s' % (instr.op, instr.args)
+                if instr.comment:
+                    text += '\t; ' + instr.comment
+            instructions.append((key, size, text))
+
+        write_icache(self.icache_file, self.icache_fingerprint,
+            self.icache_flash.runs(0, flash_size), instructions)
+        self.icache_size = len(self.instructions)
 
     def local_ram(self, begin, end):
-        self.local_addresses.seek(begin)
-        self.local_addresses.write(b'\xff' * (end - begin + 1))
+        self.local.mark(begin, end)
+
+    def demand_paging(self, name, enabled = True):
+        """Turn demand paging on or off for memory map regions, by name or kind"""
+        regions = self.memory_map.select(name)
+        if not enabled:
+            self.write_back()
+            for number in list(self.paged):
+                if any(r.begin <= (number << page_shift) <= r.end for r in regions):
+                    self.local.discard(number)
+                    del self.paged[number]
+        for r in regions:
+            r.paged = enabled
+
+    def page_in(self, address, size = 1):
+        """Read the pages covering a range into local memory, if they're in
+        demand-paged regions. Pages that already have local data (from
+        local_ram, say) are left alone. Returns True if the range is now local.
+        """
+        for number in range(address >> page_shift, ((address + size - 1) >> page_shift) + 1):
+            base = number << page_shift
+            region = self.memory_map.lookup(base)
+            if self.local.has_page(number) or not (region and region.paged) or region.end < base + page_size - 1:
+                continue
+            self.flush_overlapping(base, page_size)
+            self.log_prefetch(base)
+            data = read_block(self.device, base, page_size, fast=True)
+            self.local.write(base, data)
+            self.paged[number] = data
+        return self.local.valid(address, size)
+
+    def write_back(self):
+        """Send pending stores and changes to demand-paged memory to the hardware"""
+        self.flush()
+        for number, clean in sorted(self.paged.items()):
+            if not self.local.has_page(number):
+                # Restored to a snapshot from before this page was read
+                del self.paged[number]
+                continue
+            base = number << page_shift
+            current = self.local.read(base, page_size)
+            if current == clean:
+                continue
+            start = None
+            for offset in range(0, page_size + 64, 64):
+                same = offset >= page_size or current[offset:offset + 64] == clean[offset:offset + 64]
+                if start is None and not same:
+                    start = offset
+                elif start is not None and same:
+                    self.post_combined_store(base + start, current[start:offset])
+                    start = None
+            self.paged[number] = current
+
+    def drop_pages(self):
+        """Write back and forget all demand-paged memory, so it's read again from hardware"""
+        self.write_back()
+        for number in self.paged:
+            self.local.discard(number)
+        self.paged = {}
 
     def note(self, address):
         return self.patch_notes.get(address & ~1, '')
 
-    def log_replayable_write(self, address, data, size):
-        # In addition to the human-friendly "arm-mem" logs, we log in a replayable format
-        # Returns the next address, to make fills easy.
-        if size == 'word':
-            self.logfile.write("%%wr %x %x\n" % (address, data))
-            return address + 4
-        elif size == 'byte':
-            self.logfile.write("%%wrb %x %x\n" % (address, data))
-            return address + 1
-        elif size == 'half':
-            self.logfile.write("%%wrb %x %x\n" % (address, data & 0xff))
-            self.logfile.write("%%wrb %x %x\n" % (address + 1, data >> 8))
-            return address + 2
-
     def log_store(self, address, data, size='word', message=''):
-        if self.logfile:
-            self.logfile.write("arm-mem-STORE %4s[%08x] <- %08x %s\n" % (size, address, data, message))
-            self.log_replayable_write(address, data, size)
+        if self.trace:
+            self.trace.store(address, data, size, message)
+        elif self.logfile:
+            self.logfile.write(store_text(address, data, size, message))
 
     def log_fill(self, address, pattern, count, size='word'):
-        if self.logfile:
-            self.logfile.write("arm-mem-FILL  %4s[%08x] <- %08x * %04x\n" % (size, address, pattern, count))
-            while count > 0:
-                count -= 1
-                address = self.log_replayable_write(address, pattern, size)
+        if self.trace:
+            self.trace.fill(address, pattern, count, size)
+        elif self.logfile:
+            self.logfile.write(fill_text(address, pattern, count, size))
 
     def log_load(self, address, data, size='word'):
-        if self.logfile:
-            self.logfile.write("arm-mem-LOAD  %4s[%08x] -> %08x\n" % (size, address, data))
+        if self.trace:
+            self.trace.load(address, data, size)
+        elif self.logfile:
+            self.logfile.write(load_text(address, data, size))
 
     def log_prefetch(self, address):
-        if self.logfile:
-            self.logfile.write("arm-prefetch [%08x]\n" % address)
+        if self.trace:
+            self.trace.prefetch(address)
+        elif self.logfile:
+            self.logfile.write(prefetch_text(address))
+
+    def region(self, address):
+        """The memory map region for an address. Raises IndexError if it's unmapped."""
+        region = self.memory_map.lookup(address)
+        if region is None:
+            raise IndexError("Address %08x doesn't look valid. Simulator bug?" % address)
+        return region
 
     def check_address(self, address):
         # Called before write (crash less) and after read (curiosity)
-        if address >= 0x05000000:
-            raise IndexError("Address %08x doesn't look valid. Simulator bug?" % address)
+        self.region(address)
 
     def post_rle_store(self, count, address, pattern, size):
         """Process stores after RLE consolidation has happened"""
@@ -262,9 +593,56 @@ class SimARMMemory(object):
             count -= 1
             address += size
 
+    def post_combined_store(self, address, data):
+        """Process stores after write combining has happened"""
+        end = address + len(data)
+        head = min(end, (address + 3) & ~3)
+        tail = max(head, end & ~3)
+
+        for a in range(address, head):
+            self.log_store(a, data[a - address], 'byte')
+            self.device.poke_byte(a, data[a - address])
+
+        if tail > head:
+            block = data[head - address:tail - address]
+            for a in range(head, tail, 4):
+                self.log_store(a, struct.unpack_from('<I', data, a - address)[0])
+            if tail - head == 4:
+                self.device.poke(head, struct.unpack('<I', block)[0])
+            else:
+                write_block(self.device, head, block)
+
+        for a in range(tail, end):
+            self.log_store(a, data[a - address], 'byte')
+            self.device.poke_byte(a, data[a - address])
+
+    def combine_store(self, count, address, pattern, size):
+        """Process RAM stores after RLE consolidation.
+        Long runs become fills, everything else waits in the write combiner.
+        """
+        if not count:
+            return
+        combiner = self.combiner
+        if (count * size >= fill_min_bytes and size != 2) or (size == 4 and address & 3):
+            # Fills, and unaligned words the hardware handles its own way
+            if combiner.overlaps(address, count * size):
+                self.post_combined_store(*combiner.flush())
+            self.post_rle_store(count, address, pattern, size)
+        else:
+            data = struct.pack(unit_formats[size], pattern & ((1 << (8 * size)) - 1)) * count
+            address, data = combiner.write(address, data)
+            if data:
+                self.post_combined_store(address, data)
+
     def flush(self):
-        # If there's a cached fill, make it happen
-        self.post_rle_store(*self.rle.flush())
+        # The current run is newest, it joins the combined writes on their way out
+        self.combine_store(*self.rle.flush())
+        self.post_combined_store(*self.combiner.flush())
+
+    def flush_overlapping(self, address, size):
+        # Pending stores only have to go out before a load that might see them
+        if self.combiner.overlaps(address, size) or self.rle.overlaps(address, size):
+            self.flush()
 
     def fetch_local_data(self, address, size, max_round_trips = None):
         """Immediately read a block of data from the remote device into the local cache.
@@ -272,76 +650,91 @@ class SimARMMemory(object):
         Returns the length of the block we actually read, in bytes.
         """
         block = read_block(self.device, address, size, max_round_trips=max_round_trips)
-        self.local_ram(address, address + len(block) - 1)
-        self.local_data.seek(address)
-        self.local_data.write(block)
+        self.local.write(address, block)
+        if address < flash_size:
+            self.icache_flash.write(address, block[:flash_size - address])
         return len(block)
 
     def local_data_available(self, address, limit = 0x100):
         """How many bytes of local data are available at an address?"""
-        self.local_addresses.seek(address)
-        flags = self.local_addresses.read(limit)
-        return len(flags[:flags.find(b'\x00')])
+        return self.local.available(address, limit)
 
     def flash_prefetch_hint(self, address):
-        """We're accessing an address, if it's flash maybe prefetch around it.
+        """We're accessing an address, if it's in a region with prefetch (flash) read around it.
         Returns the number of bytes prefetched or the number of bytes already available.
         Guaranteed to have at least 8 bytes available for flash addresses.
         """
-        # Flash prefetch, whatever we can get quickly
+        # Prefetch whatever we can get quickly
         avail = self.local_data_available(address)
-        if address < 0x200000 and avail < 8:
-            self.flush()
-            self.log_prefetch(address)
-            avail = self.fetch_local_data(address, size=0x100, max_round_trips=1)
+        if avail < 8:
+            region = self.memory_map.lookup(address)
+            if region and region.paged:
+                self.page_in(address)
+                avail = self.local_data_available(address)
+            elif region and region.prefetch:
+                size = min(region.prefetch, region.end + 1 - address)
+                self.flush_overlapping(address, size)
+                self.log_prefetch(address)
+                avail = self.fetch_local_data(address, size=size, max_round_trips=1)
         return avail
 
+    def flush_load(self, address, size):
+        # Loads from regions with in-order stores (I/O) see every store before them
+        region = self.memory_map.lookup(address)
+        if region is None or region.write == 'direct':
+            self.flush()
+        else:
+            self.flush_overlapping(address, size)
+
     def load(self, address):
+        data = self.local.load32(address)
+        if data is not None:
+            return data
         self.flash_prefetch_hint(address)
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(4) == b'\xff\xff\xff\xff':
-            self.local_data.seek(address)
-            return struct.unpack('<I', self.local_data.read(4))[0]
+        data = self.local.load32(address)
+        if data is not None:
+            return data
 
         # Non-cached device address
-        self.flush()
+        self.flush_load(address, 4)
         data = self.device.peek(address)
         self.log_load(address, data)
         self.check_address(address)
         return data
 
     def load_half(self, address):
+        data = self.local.load16(address)
+        if data is not None:
+            return data
         self.flash_prefetch_hint(address)
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(2) == b'\xff\xff':
-            self.local_data.seek(address)
-            return struct.unpack('<H', self.local_data.read(2))[0]
+        data = self.local.load16(address)
+        if data is not None:
+            return data
 
         # Doesn't seem to be architecturally necessary; emulate with bytes
-        self.flush()
+        self.flush_load(address, 2)
         data = self.device.peek_byte(address) | (self.device.peek_byte(address + 1) << 8)
         self.log_load(address, data, 'half')
         self.check_address(address)
         return data
 
     def load_byte(self, address):
+        data = self.local.load8(address)
+        if data is not None:
+            return data
         self.flash_prefetch_hint(address)
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(1) == b'\xff':
-            self.local_data.seek(address)
-            return ord(self.local_data.read(1))
+        data = self.local.load8(address)
+        if data is not None:
+            return data
 
-        self.flush()
+        self.flush_load(address, 1)
         data = self.device.peek_byte(address)
         self.log_load(address, data, 'byte')
         self.check_address(address)
         return data
 
     def store(self, address, data):
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(4) == b'\xff\xff\xff\xff':
-            self.local_data.seek(address)
-            self.local_data.write(struct.pack('<I', data))
+        if self.local.store32(address, data):
             return
 
         if address in self.skip_stores:
@@ -349,13 +742,17 @@ class SimARMMemory(object):
                 message='(skipped: %s)'% self.skip_stores[address])
             return
 
-        self.post_rle_store(*self.rle.write(address, data, 4))
+        region = self.region(address)
+        if region.paged and self.page_in(address, 4):
+            self.local.store32(address, data)
+        elif region.write == 'combine':
+            self.combine_store(*self.rle.write(address, data, 4))
+        else:
+            self.flush()
+            self.post_rle_store(1, address, data, 4)
 
     def store_half(self, address, data):
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(2) == b'\xff\xff':
-            self.local_data.seek(address)
-            self.local_data.write(struct.pack('<H', data))
+        if self.local.store16(address, data):
             return
 
         if address in self.skip_stores:
@@ -363,13 +760,17 @@ class SimARMMemory(object):
                 message='(skipped: %s)'% self.skip_stores[address])
             return
 
-        self.post_rle_store(*self.rle.write(address, data, 2))
+        region = self.region(address)
+        if region.paged and self.page_in(address, 2):
+            self.local.store16(address, data)
+        elif region.write == 'combine':
+            self.combine_store(*self.rle.write(address, data, 2))
+        else:
+            self.flush()
+            self.post_rle_store(1, address, data, 2)
 
     def store_byte(self, address, data):
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(1) == b'\xff':
-            self.local_data.seek(address)
-            self.local_data.write(bytes([data]))
+        if self.local.store8(address, data):
             return
 
         if address in self.skip_stores:
@@ -377,7 +778,78 @@ class SimARMMemory(object):
                 message='(skipped: %s)'% self.skip_stores[address])
             return
 
-        self.post_rle_store(*self.rle.write(address, data, 1))
+        region = self.region(address)
+        if region.paged and self.page_in(address, 1):
+            self.local.store8(address, data)
+        elif region.write == 'combine':
+            self.combine_store(*self.rle.write(address, data, 1))
+        else:
+            self.flush()
+            self.post_rle_store(1, address, data, 1)
+
+    def _block_region(self, address, size):
+        # The region a whole ldm/stm range lands in, if it can be moved as one block
+        region = self.memory_map.lookup(address)
+        if region and not (address & 3) and address + size - 1 <= region.end:
+            return region
+
+    def load_block(self, address, count):
+        """Load 'count' consecutive words, for ldm and pop.
+        Anything not already local is read with one read_block() where the
+        memory map allows it; I/O is still read one word at a time, in order.
+        """
+        size = 4 * count
+        if count > 1 and not self.local.valid(address, size):
+            region = self._block_region(address, size)
+            if region and region.paged:
+                self.page_in(address, size)
+            elif region and region.cacheable:
+                self.flush_overlapping(address, size)
+                self.log_prefetch(address)
+                self.fetch_local_data(address, size)
+            elif region and region.write == 'combine':
+                if not self.local.any_valid(address, size):
+                    self.flush_overlapping(address, size)
+                    words = struct.unpack('<%dI' % count, read_block(self.device, address, size))
+                    for i, data in enumerate(words):
+                        self.log_load(address + 4 * i, data)
+                    return list(words)
+
+        if self.local.valid(address, size):
+            return list(struct.unpack('<%dI' % count, self.local.read(address, size)))
+        return [self.load(address + 4 * i) for i in range(count)]
+
+    def store_block(self, address, words):
+        """Store consecutive words, for stm and push.
+        RAM stores join the write combiner as one range; anything else
+        (I/O, skipped stores, partly local ranges) goes a word at a time.
+        """
+        count = len(words)
+        size = 4 * count
+        data = struct.pack('<%dI' % count, *words)
+        if self.local.watched:
+            self.local.check_watch(address, size)
+        if self.local.valid(address, size):
+            self.local.write(address, data)
+            return
+
+        region = self._block_region(address, size)
+        if (count > 1 and region and region.write == 'combine' and
+                not self.local.any_valid(address, size) and
+                not any(address + 4 * i in self.skip_stores for i in range(count))):
+            if region.paged and self.page_in(address, size):
+                self.local.write(address, data)
+                return
+            if not self.local.any_valid(address, size):
+                # The pending run is older than this block
+                self.combine_store(*self.rle.flush())
+                address, data = self.combiner.write(address, data)
+                if data:
+                    self.post_combined_store(address, data)
+                return
+
+        for i, word in enumerate(words):
+            self.store(address + 4 * i, word)
 
     def fetch(self, address, thumb):
         try:
@@ -391,43 +863,119 @@ class SimARMMemory(object):
         self.flush()
         block_size = self.flash_prefetch_hint(address)
         assert block_size >= 8
-        self.local_data.seek(address)
-        data = self.local_data.read(block_size)
-        lines = disassembly_lines(disassemble_string(data, address, thumb=thumb))
-        self._load_assembly(address, lines, thumb=thumb)
+        data = self.local.read(address, block_size)
+
+        # Decode in-process when we can; objdump only sees the rare
+        # instruction our decoder doesn't know about.
+        lines = decode_instructions(data, address, thumb=thumb)
+        if lines:
+            for instr in lines:
+                self._cache_instruction(instr, thumb)
+        else:
+            lines = disassembly_lines(disassemble_string(data, address, thumb=thumb))
+            self._load_assembly(address, lines, thumb=thumb)
 
     def _load_assembly(self, address, lines, thumb):
         # NOTE: Requires an extra instruction of padding at the end
         for i in range(len(lines) - 1):
             instr = lines[i]
             instr.next_address = lines[i+1].address
-            addr = thumb | (lines[i].address & ~1)
-            instr.hle = self.patch_hle.get(addr)
-            if addr not in self.instructions:
-                self.instructions[addr] = instr
+            self._cache_instruction(instr, thumb)
+
+    def _cache_instruction(self, instr, thumb):
+        addr = thumb | (instr.address & ~1)
+        instr.hle = self.patch_hle.get(addr)
+        if addr not in self.instructions:
+            self.instructions[addr] = instr
 
     def hle_init(self, code_address = pad):
         """Install a C++ library to handle high-level emulation operations
+        Devices with no compiler (OfflineDevice) can provide their own handlers.
+        Local handlers don't need anything installed; with only those, this
+        doesn't touch the device. With a patch_cache, the library is only
+        compiled when the handlers or headers change.
         """
-        self.hle_symbols = compile_library(self.device, code_address, self.hle_handlers)
+        if not self.hle_handlers:
+            self.hle_symbols = {}
+            return
+        install = getattr(self.device, 'install_hle', None)
+        if install:
+            self.hle_symbols = install(self.hle_handlers)
+            print("* Installed %d offline High Level Emulation handlers" % len(self.hle_symbols))
+            return
+        if self.patch_cache:
+            self.hle_symbols = self.patch_cache.compile_library(self.device, code_address, self.hle_handlers)
+        else:
+            self.hle_symbols = compile_library(self.device, code_address, self.hle_handlers)
         print("* Installed High Level Emulation handlers at %08x" % code_address)
 
     def hle_invoke(self, instruction, r0):
         """Invoke the high-level emulation operation for an instruction
-        Captures console output to the log.
+        Captures console output to the log. Demand-paged memory is written
+        back first, so the handler sees the same memory we do, and dropped
+        afterwards in case the handler changed it. Local handlers skip all
+        of that.
         """
+        local = self.hle_local.get(instruction.hle)
+        if local:
+            result = local(self, r0)
+            return r0 if result is None else result & 0xffffffff
+
+        self.write_back()
         cb = ConsoleBuffer(self.device)
         cb.discard()
         r0, _ = self.device.blx(self.hle_symbols[instruction.hle], r0)
-        logdata = cb.read(max_round_trips = None).decode('utf8')
+        self.drop_pages()
+        self.hle_log(cb.read(max_round_trips = None).decode('utf8'))
+        return r0
 
+    def hle_log(self, text):
         # Prefix log lines, normalize trailing newline
-        logdata = '\n'.join([ 'HLE: ' + l for l in logdata.rstrip().split('\n') ]) + '\n'
+        self.log_message('\n'.join([ 'HLE: ' + l for l in text.rstrip().split('\n') ]) + '\n')
+
+    def log_message(self, text):
+        sys.stdout.write(text)
+        if self.trace:
+            self.trace.write(text)
+        elif self.logfile:
+            self.logfile.write(text)
+
+
+class WatchpointHit(Exception):
+    """Raised by a store to a watched word, before it happens"""
+    def __init__(self, address, size):
+        Exception.__init__(self, "Watchpoint hit by %d byte store to %08x" % (size, address))
+        self.address = address
+        self.size = size
 
-        sys.stdout.write(logdata)
-        if self.logfile:
-            self.logfile.write(logdata)
-        return r0
+
+class SimStop(object):
+    """Why SimARM.run() stopped.
+    'reason' is 'breakpoint', 'watchpoint', or 'steps'. For watchpoints,
+    'address' and 'size' describe the store that hit it.
+    """
+    def __init__(self, reason, arm, address = None, size = None):
+        self.reason = reason
+        self.pc = arm.regs[15]
+        self.step_count = arm.step_count
+        self.address = address
+        self.size = size
+
+    def __repr__(self):
+        if self.reason == 'watchpoint':
+            return 'SimStop(%s, pc=%08x, store %d bytes to %08x)' % (
+                self.reason, self.pc, self.size, self.address)
+        return 'SimStop(%s, pc=%08x)' % (self.reason, self.pc)
+
+
+class SimARMSnapshot(object):
+    """In-memory simulator state from SimARM.snapshot()"""
+    def __init__(self, state, pages, pending):
+        self.state = state
+        self.pages = pages
+        self.pending = pending
+        self.step_count = state['step_count']
+        self.filebase = None
 
 
 class SimARM(object):
@@ -441,6 +989,7 @@ class SimARM(object):
     """
     def __init__(self, memory):
         self.memory = memory
+        self.regs = [0] * 16
         self.reset(0)
 
         # Register lookup
@@ -462,11 +1011,17 @@ class SimARM(object):
             if name.startswith('op_'):
                 self._generate_condition_codes(getattr(self, name), name + '%s')
 
+        self.translator = BlockTranslator(self)
+        self.profiler = None
+        self.history = None
+        self.coverage = None
         self.memory.hle_init()
 
     def reset(self, vector):
-        self.regs = [0] * 16
+        # Translated blocks hold on to this list, so change it in place
+        self.regs[:] = [0] * 16
         self.thumb = vector & 1
+        self._lazy_flags = None
         self.cpsrV = False
         self.cpsrC = False
         self.cpsrZ = False
@@ -477,6 +1032,111 @@ class SimARM(object):
 
     _state_fields = ('thumb', 'cpsrV', 'cpsrC', 'cpsrZ', 'cpsrN', 'step_count')
 
+    # Condition flags are evaluated lazily. Arithmetic ops only record their
+    # operands and result as (is_sub, a, b, r) in _lazy_flags; N/Z/C/V are
+    # worked out when something actually reads them. Ops that set just a few
+    # flags resolve the pending arithmetic first, then write _cpsrX directly.
+
+    _lazy_flags = None
+    _cpsrN = _cpsrZ = _cpsrC = _cpsrV = False
+
+    def _materialize_flags(self):
+        is_sub, a, b, r = self._lazy_flags
+        self._lazy_flags = None
+        self._cpsrN = (r >> 31) & 1
+        self._cpsrZ = not (r & 0xffffffff)
+        if is_sub:
+            self._cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
+            self._cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+        else:
+            self._cpsrC = r > 0xffffffff
+            self._cpsrV = ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1)
+
+    def _flag_property(name):
+        def getter(self):
+            if self._lazy_flags: self._materialize_flags()
+            return getattr(self, name)
+        def setter(self, value):
+            if self._lazy_flags: self._materialize_flags()
+            setattr(self, name, value)
+        return property(getter, setter)
+
+    cpsrN = _flag_property('_cpsrN')
+    cpsrZ = _flag_property('_cpsrZ')
+    cpsrC = _flag_property('_cpsrC')
+    cpsrV = _flag_property('_cpsrV')
+    del _flag_property
+
+    # Condition tests. The common ones after a compare read the pending
+    # arithmetic directly, without materializing every flag.
+
+    def _test_eq(self):
+        lazy = self._lazy_flags
+        if lazy:
+            return not (lazy[3] & 0xffffffff)
+        return self._cpsrZ
+
+    def _test_ne(self):
+        lazy = self._lazy_flags
+        if lazy:
+            return (lazy[3] & 0xffffffff) != 0
+        return not self._cpsrZ
+
+    def _test_cs(self):
+        lazy = self._lazy_flags
+        if lazy:
+            if lazy[0]:
+                return (lazy[1] & 0xffffffff) >= (lazy[2] & 0xffffffff)
+            return lazy[3] > 0xffffffff
+        return self._cpsrC
+
+    def _test_cc(self):
+        lazy = self._lazy_flags
+        if lazy:
+            if lazy[0]:
+                return (lazy[1] & 0xffffffff) < (lazy[2] & 0xffffffff)
+            return lazy[3] <= 0xffffffff
+        return not self._cpsrC
+
+    def _test_mi(self):
+        lazy = self._lazy_flags
+        if lazy:
+            return (lazy[3] >> 31) & 1
+        return self._cpsrN
+
+    def _test_pl(self):
+        lazy = self._lazy_flags
+        if lazy:
+            return not (lazy[3] >> 31) & 1
+        return not self._cpsrN
+
+    def _test_vs(self):
+        return self.cpsrV
+
+    def _test_vc(self):
+        return not self.cpsrV
+
+    def _test_hi(self):
+        return self.cpsrC and not self._cpsrZ
+
+    def _test_ls(self):
+        return self.cpsrZ or not self._cpsrC
+
+    def _test_ge(self):
+        return (not self.cpsrN) == (not self._cpsrV)
+
+    def _test_lt(self):
+        return (not self.cpsrN) != (not self._cpsrV)
+
+    def _test_gt(self):
+        return ((not self.cpsrN) == (not self._cpsrV)) and not self._cpsrZ
+
+    def _test_le(self):
+        return ((not self.cpsrN) != (not self._cpsrV)) or self._cpsrZ
+
+    _test_hs = _test_cs
+    _test_lo = _test_cc
+
     @property
     def state(self):
         d = {}
@@ -498,54 +1158,223 @@ class SimARM(object):
             json.dump(self.state, f)
 
     def load_state(self, filebase):
-        """Load state from save_state()"""
-        self.memory.load_state(filebase)
+        """Load state from save_state() or save_checkpoint()"""
         with open(filebase + '.core', 'r') as f:
-            self.state = json.load(f)
+            state = json.load(f)
+        base = state.get('base')
+        if base:
+            self.load_state(base)
+        self.memory.load_state(filebase, delta=bool(base))
+        self.state = state
+
+    def snapshot(self):
+        """Capture the simulator state in memory, for restore().
+        Local memory is copy-on-write, so this only costs as much as the
+        pages that changed since the last snapshot. Device state isn't included,
+        but stores still waiting to be combined are, so taking a snapshot
+        doesn't change the traffic we send to the device.
+        """
+        memory = self.memory
+        pending = (memory.rle.count, memory.rle.key, memory.combiner.address, bytes(memory.combiner.data))
+        return SimARMSnapshot(self.state, memory.local.snapshot(), pending)
+
+    def restore(self, snapshot):
+        """Return to the state from snapshot(). Pending stores that haven't
+        reached the device yet are discarded along with the rest of the state.
+        """
+        memory = self.memory
+        memory.local.restore(snapshot.pages)
+        memory.rle.count, memory.rle.key, memory.combiner.address, data = snapshot.pending
+        memory.combiner.data = bytearray(data)
+        self.state = snapshot.state
+
+    def save_checkpoint(self, filebase, snapshot, base = None):
+        """Save a snapshot to disk, in the same files as save_state().
+        If 'base' is an earlier snapshot that was already saved, only pages
+        that changed since then are written, and load_state() reads the
+        base checkpoint first.
+        """
+        state = dict(snapshot.state)
+        if base:
+            state['base'] = base.filebase
+        with open(filebase + '.pages', 'wb') as f:
+            self.memory.local.save_delta(f, snapshot.pages, base and base.pages)
+        with open(filebase + '.core', 'w') as f:
+            json.dump(state, f)
+        snapshot.filebase = filebase
 
     def step(self, repeat = 1, breakpoint = None):
         """Step the simulated ARM by one or more instructions
         Stops when the repeat count is exhausted or we hit a breakpoint.
         """
-        regs = self.regs
-        while repeat > 0:
-            repeat -= 1
-            self.step_count += 1
-
-            hook = self.memory.hooks.get(regs[15], None)
-            instr = self.memory.fetch(regs[15], self.thumb)
-            self._branch = None
+        self._run(repeat, frozenset() if breakpoint is None else frozenset([breakpoint]))
 
-            if self.thumb:
-                regs[15] = (instr.next_address + 3) & ~3
-            else:
-                regs[15] += 8
+    def run(self, until_pcs = (), watch_addresses = (), max_steps = None):
+        """Run until the PC reaches an address in 'until_pcs', a store
+        touches the word at an address in 'watch_addresses', or we've taken
+        'max_steps' steps. Returns a SimStop saying which.
 
-            try:
+        Breakpoints are checked between blocks. Watchpoints are a flag on
+        each page in the memory layer; only stores to watched pages pay for
+        them. The store that hits one finishes before we stop.
 
-                # The op_ function does some precalculation and returns a function that
-                # actually runs the operation. We cache the latter function.
+        A hook can call run() again. The outer run's watchpoints stay active
+        in the inner one, and a store to one of them stops the outer run.
+        """
+        memory = self.memory
+        breakpoints = frozenset(a & ~1 for a in until_pcs)
+        end = self.step_count + max_steps if max_steps is not None else None
+        outer = memory.watch_words
+        own = set(a & ~3 for a in watch_addresses)
+        memory.watch(outer | own)
+        try:
+            while True:
+                remaining = end - self.step_count if end is not None else 1 << 62
+                if remaining <= 0:
+                    return SimStop('steps', self)
                 try:
-                    opfunc = instr.opfunc
-                except AttributeError:
-                    opfunc = instr.opfunc = getattr(self, 'op_' + instr.op.split('.', 1)[0])(instr)
-
-                opfunc()
-                regs[15] = self._branch or instr.next_address
-                if regs[15] == breakpoint:
-                    return
-
-            except:
-                # If we don't finish, point the PC at that instruction
-                regs[15] = instr.address
-                raise
-
-            if instr.hle:
-                regs[0] = self.memory.hle_invoke(instr, regs[0])
+                    if self._run(remaining, breakpoints):
+                        return SimStop('breakpoint', self)
+                except WatchpointHit as hit:
+                    if outer and not own.intersection(range(hit.address & ~3, hit.address + hit.size, 4)):
+                        # Only the outer run() is watching this one
+                        raise
+                    # The store didn't happen, and the PC points at its instruction
+                    self.step_count -= 1
+                    memory.watch_suspended = True
+                    try:
+                        self._step_instruction()
+                    finally:
+                        memory.watch_suspended = False
+                    return SimStop('watchpoint', self, hit.address, hit.size)
+        finally:
+            memory.watch(outer)
+
+    def _run(self, repeat, breakpoints):
+        """Step until the repeat count is exhausted, or the PC is in the
+        'breakpoints' set. Returns True if we stopped at a breakpoint.
+
+        Runs whole translated blocks when the repeat count allows, and falls
+        back to single instructions otherwise. Both paths stop at exactly the
+        same places; a breakpoint always begins a new block.
+        """
+        regs = self.regs
+        memory = self.memory
+        blocks = memory.blocks
+        hooks = memory.hooks
+        profiler = self.profiler
+        history = self.history
+        coverage = self.coverage
+        for address in breakpoints:
+            memory.block_boundary(address)
+
+        while repeat > 0:
+            if history and self.step_count >= history.next_step:
+                history.checkpoint(self)
+
+            block = blocks.get(self.thumb | regs[15])
+            if block is None:
+                if repeat == 1:
+                    # A single step can't use a block; don't pay to compile one
+                    repeat -= 1
+                    if self._step_instruction(breakpoints):
+                        return True
+                    continue
+                block = self._translate()
+                if block is None:
+                    # Not translatable; single-step it to raise the usual error
+                    repeat -= 1
+                    if self._step_instruction(breakpoints):
+                        return True
+                    continue
+
+            if block.count > repeat:
+                repeat -= 1
+                if self._step_instruction(breakpoints):
+                    return True
+                continue
+
+            repeat -= block.count
+            self.step_count += block.count
+            if profiler:
+                profiler.begin()
+            block.run()
+            if coverage and block not in coverage.seen:
+                coverage.add_block(block)
+            last = block.last
+            if regs[15] not in breakpoints and last.hle:
+                regs[0] = memory.hle_invoke(last, regs[0])
+            if profiler:
+                profiler.end(self, block.thumb | block.address, block.instructions)
+            if regs[15] in breakpoints:
+                return True
+
+            hook = hooks.get(last.address)
             if hook:
                 # Hooks can do anything including reentrantly step()'ing
                 hook(self)
 
+    def _translate(self):
+        """Translate and cache a block at the current PC"""
+        address = self.regs[15]
+        block = self.translator.translate(address, self.thumb)
+        if block is not None:
+            self.memory.blocks[self.thumb | address] = block
+        return block
+
+    def _opfunc(self, instr):
+        """The op_ function does some precalculation and returns a function that
+        actually runs the operation. We cache the latter function.
+        """
+        opfunc = instr.opfunc
+        if opfunc is None:
+            opfunc = instr.opfunc = getattr(self, 'op_' + instr.op.split('.', 1)[0])(instr)
+        return opfunc
+
+    def _step_instruction(self, breakpoints = ()):
+        """Step exactly one instruction, without using translated blocks.
+        Returns True if we stopped at a breakpoint.
+        """
+        regs = self.regs
+        self.step_count += 1
+        profiler = self.profiler
+        if profiler:
+            profiler.begin()
+
+        hook = self.memory.hooks.get(regs[15], None)
+        thumb = self.thumb
+        instr = self.memory.fetch(regs[15], thumb)
+        self._branch = None
+
+        if self.thumb:
+            regs[15] = (instr.next_address + 3) & ~3
+        else:
+            regs[15] += 8
+
+        try:
+            self._opfunc(instr)()
+            regs[15] = self._branch or instr.next_address
+            if self.coverage:
+                self.coverage.add(instr.address, instr.next_address - instr.address)
+            if regs[15] in breakpoints:
+                if profiler:
+                    profiler.end(self, thumb | instr.address, [instr])
+                return True
+
+        except:
+            # If we don't finish, point the PC at that instruction
+            regs[15] = instr.address
+            raise
+
+        if instr.hle:
+            regs[0] = self.memory.hle_invoke(instr, regs[0])
+        if profiler:
+            profiler.end(self, thumb | instr.address, [instr])
+        if hook:
+            # Hooks can do anything including reentrantly step()'ing
+            hook(self)
+        return False
+
     def get_next_instruction(self):
         return self.memory.fetch(self.regs[15], self.thumb)
 
@@ -581,7 +1410,7 @@ class SimARM(object):
         return ' '.join('%s=%08x' % (self.reg_names[i], self.regs[i]) for i in range(count))
 
     def copy_registers_from(self, ns):
-        self.regs = [ns.get(n, 0) for n in self.reg_names]
+        self.regs[:] = [ns.get(n, 0) for n in self.reg_names]
 
     def copy_registers_to(self, ns):
         for i, name in enumerate(self.reg_names):
@@ -615,27 +1444,28 @@ class SimARM(object):
             left = self.reg_numbers[left.strip('!')]
             regs = right.strip('{}').split(', ')
 
+            # The registers fill one ascending range of words. Where it
+            # starts, relative to the base, and where the base ends up.
+            delta = (pre + post) * len(regs)
+            lowest = min(pre, delta - post)
+
             if memop =='st':
                 src_rn = [self.reg_numbers[n] for n in regs]
                 def fn():
                     addr = self.regs[left]
-                    for rn in src_rn:
-                        addr += pre
-                        self.memory.store(addr, self.regs[rn])
-                        addr += post
+                    self.memory.store_block(addr + lowest, [self.regs[rn] for rn in src_rn])
                     if writeback:
-                        self.regs[left] = addr
+                        self.regs[left] = addr + delta
                 return fn
             else:
                 dst_funcs = [self._dstpc(n) for n in regs]
                 def fn():
                     addr = self.regs[left]
-                    for dF in dst_funcs:
-                        addr += pre
-                        dF(self.memory.load(addr))
-                        addr += post
+                    words = self.memory.load_block(addr + lowest, len(dst_funcs))
+                    for dF, data in zip(dst_funcs, words):
+                        dF(data)
                     if writeback:
-                        self.regs[left] = addr
+                        self.regs[left] = addr + delta
                 return fn
 
         setattr(self, 'op_' + memop + 'm' + mode, op_fn)
@@ -643,22 +1473,9 @@ class SimARM(object):
         self._generate_condition_codes(op_fn, 'op_' + memop + 'm' + mode + '%s')
 
     def _generate_condition_codes(self, fn, name):
-        setattr(self, name % 'eq', lambda i: lambda fn=fn(i): (self.cpsrZ     ) and fn())
-        setattr(self, name % 'ne', lambda i: lambda fn=fn(i): (not self.cpsrZ ) and fn())
-        setattr(self, name % 'cs', lambda i: lambda fn=fn(i): (self.cpsrC     ) and fn())
-        setattr(self, name % 'hs', lambda i: lambda fn=fn(i): (self.cpsrC     ) and fn())
-        setattr(self, name % 'cc', lambda i: lambda fn=fn(i): (not self.cpsrC ) and fn())
-        setattr(self, name % 'lo', lambda i: lambda fn=fn(i): (not self.cpsrC ) and fn())
-        setattr(self, name % 'mi', lambda i: lambda fn=fn(i): (self.cpsrN     ) and fn())
-        setattr(self, name % 'pl', lambda i: lambda fn=fn(i): (not self.cpsrN ) and fn())
-        setattr(self, name % 'vs', lambda i: lambda fn=fn(i): (self.cpsrV     ) and fn())
-        setattr(self, name % 'vc', lambda i: lambda fn=fn(i): (not self.cpsrV ) and fn())
-        setattr(self, name % 'hi', lambda i: lambda fn=fn(i): (self.cpsrC and not self.cpsrZ ) and fn())
-        setattr(self, name % 'ls', lambda i: lambda fn=fn(i): (self.cpsrZ or not self.cpsrC ) and fn())
-        setattr(self, name % 'ge', lambda i: lambda fn=fn(i): (((not self.cpsrN) == (not self.cpsrV)) ) and fn())
-        setattr(self, name % 'lt', lambda i: lambda fn=fn(i): (((not self.cpsrN) != (not self.cpsrV)) ) and fn())
-        setattr(self, name % 'gt', lambda i: lambda fn=fn(i): (((not self.cpsrN) == (not self.cpsrV)) and not self.cpsrZ ) and fn())
-        setattr(self, name % 'le', lambda i: lambda fn=fn(i): (((not self.cpsrN) != (not self.cpsrV)) or self.cpsrZ      ) and fn())
+        for cond in condition_codes:
+            test = getattr(self, '_test_' + cond)
+            setattr(self, name % cond, lambda i, test=test: lambda fn=fn(i): test() and fn())
         setattr(self, name % 'al', fn)
 
     def _reg_or_literal(self, s):
@@ -804,17 +1621,17 @@ class SimARM(object):
         reglist = [self.reg_numbers[r] for r in i.args.strip('{}').split(', ')]
         def fn():
             sp = self.regs[13] - 4 * len(reglist)
+            self.memory.store_block(sp, [self.regs[r] for r in reglist])
             self.regs[13] = sp
-            for i in range(len(reglist)):
-                self.memory.store(sp + 4 * i, self.regs[reglist[i]])
         return fn
 
     def op_pop(self, i):
         reglist = [self._dstpc(r) for r in i.args.strip('{}').split(', ')]
         def fn():
             sp = self.regs[13]
-            for i in range(len(reglist)):
-                reglist[i]( self.memory.load(sp + 4 * i) )
+            words = self.memory.load_block(sp, len(reglist))
+            for dF, data in zip(reglist, words):
+                dF(data)
             self.regs[13] = sp + 4 * len(reglist)
         return fn
 
@@ -878,9 +1695,10 @@ class SimARM(object):
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
-            r, self.cpsrC = sF()
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            if self._lazy_flags: self._materialize_flags()
+            r, self._cpsrC = sF()
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
             dF(r)
         return fn
 
@@ -897,10 +1715,11 @@ class SimARM(object):
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
+            if self._lazy_flags: self._materialize_flags()
             r, self.csprC = sF()
             r = r ^ 0xffffffff
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
             dF(r)
         return fn
 
@@ -921,10 +1740,11 @@ class SimARM(object):
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
+            if self._lazy_flags: self._materialize_flags()
             s, _ = sF()
             r = self.regs[rn] & ~s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
             dF(r)
         return fn
 
@@ -945,10 +1765,11 @@ class SimARM(object):
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
-            s, self.cpsrC = sF()
+            if self._lazy_flags: self._materialize_flags()
+            s, self._cpsrC = sF()
             r = self.regs[rn] | s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
             dF(r)
         return fn
 
@@ -969,10 +1790,11 @@ class SimARM(object):
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
-            s, self.cpsrC = sF()
+            if self._lazy_flags: self._materialize_flags()
+            s, self._cpsrC = sF()
             r = self.regs[rn] & s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
             dF(r)
         return fn
 
@@ -981,10 +1803,11 @@ class SimARM(object):
         rn = self.reg_numbers[src0]
         sF = self._shifter(src1)
         def fn():
-            s, self.cpsrC = sF()
+            if self._lazy_flags: self._materialize_flags()
+            s, self._cpsrC = sF()
             r = self.regs[rn] & s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
         return fn
 
     def op_teq(self, i):
@@ -992,10 +1815,11 @@ class SimARM(object):
         rn = self.reg_numbers[src0]
         sF = self._shifter(src1)
         def fn():
-            s, self.cpsrC = sF()
+            if self._lazy_flags: self._materialize_flags()
+            s, self._cpsrC = sF()
             r = self.regs[rn] ^ s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
         return fn
 
     def op_eor(self, i):
@@ -1013,10 +1837,11 @@ class SimARM(object):
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
-            s, self.cpsrC = sF()
+            if self._lazy_flags: self._materialize_flags()
+            s, self._cpsrC = sF()
             r = self.regs[rn] ^ s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            self._cpsrZ = r == 0
+            self._cpsrN = (r >> 31) & 1
             dF(r)
         return fn
 
@@ -1038,10 +1863,7 @@ class SimARM(object):
             a = self.regs[rn]
             b, _ = sF()
             r = a + b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = r > 0xffffffff
-            self.cpsrV = ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (False, a, b, r)
             dF(r)
         return fn
 
@@ -1063,10 +1885,7 @@ class SimARM(object):
             a = self.regs[rn]
             b, _ = sF()
             r = a + b + (self.cpsrC & 1)
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = r > 0xffffffff
-            self.cpsrV = ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (False, a, b, r)
             dF(r)
         return fn
 
@@ -1088,10 +1907,7 @@ class SimARM(object):
             a = self.regs[rn]
             b, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (True, a, b, r)
             dF(r)
         return fn
 
@@ -1113,10 +1929,7 @@ class SimARM(object):
             a = self.regs[rn]
             b, _ = sF()
             r = a - b + self.cpsrC - 1
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (True, a, b, r)
             dF(r)
         return fn
 
@@ -1138,10 +1951,7 @@ class SimARM(object):
             b = self.regs[rn]
             a, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (True, a, b, r)
             dF(r)
         return fn
 
@@ -1153,10 +1963,7 @@ class SimARM(object):
             a = self.regs[rn]
             b, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (True, a, b, r)
         return fn
 
     def op_cmn(self, i):
@@ -1167,10 +1974,7 @@ class SimARM(object):
             a = self.regs[rn]
             b, _ = sF()
             r = a + b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = r > 0xffffffff
-            self.cpsrV = ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (False, a, b, r)
         return fn
 
     def op_lsl(self, i):
@@ -1188,9 +1992,10 @@ class SimARM(object):
         n0 = self.reg_numbers[src0]
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = lsl(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            if self._lazy_flags: self._materialize_flags()
+            r, self._cpsrC = lsl(self.regs[n0], f1())
+            self._cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
             fD(r)
         return fn
 
@@ -1209,9 +2014,10 @@ class SimARM(object):
         n0 = self.reg_numbers[src0]
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = lsr(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            if self._lazy_flags: self._materialize_flags()
+            r, self._cpsrC = lsr(self.regs[n0], f1())
+            self._cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
             fD(r)
         return fn
 
@@ -1230,9 +2036,10 @@ class SimARM(object):
         n0 = self.reg_numbers[src0]
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = asr(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            if self._lazy_flags: self._materialize_flags()
+            r, self._cpsrC = asr(self.regs[n0], f1())
+            self._cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
             fD(r)
         return fn
 
@@ -1251,9 +2058,10 @@ class SimARM(object):
         n0 = self.reg_numbers[src0]
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = rol(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            if self._lazy_flags: self._materialize_flags()
+            r, self._cpsrC = rol(self.regs[n0], f1())
+            self._cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
             fD(r)
         return fn
 
@@ -1272,9 +2080,10 @@ class SimARM(object):
         n0 = self.reg_numbers[src0]
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = ror(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            if self._lazy_flags: self._materialize_flags()
+            r, self._cpsrC = ror(self.regs[n0], f1())
+            self._cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
             fD(r)
         return fn
 
@@ -1293,9 +2102,10 @@ class SimARM(object):
         n0 = self.reg_numbers[src0]
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = rrx(self.regs[n0], f1(), self.cpsrC)
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            if self._lazy_flags: self._materialize_flags()
+            r, self._cpsrC = rrx(self.regs[n0], f1(), self.cpsrC)
+            self._cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
             fD(r)
         return fn
 
@@ -1314,11 +2124,12 @@ class SimARM(object):
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
+            if self._lazy_flags: self._materialize_flags()
             a = self.regs[rn]
             b, _ = sF()
             r = a * b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
+            self._cpsrZ = not (r & 0xffffffff)
             dF(r)
         return fn
 
@@ -1339,9 +2150,10 @@ class SimARM(object):
         nRn = self.reg_numbers[Rn]
         dF = self._dstpc(dst)
         def fn():
+            if self._lazy_flags: self._materialize_flags()
             r = self.regs[nRm] * self.regs[nRs] + self.regs[nRn]
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
+            self._cpsrN = (r >> 31) & 1
+            self._cpsrZ = not (r & 0xffffffff)
             dF(r)
         return fn
 
@@ -1364,9 +2176,10 @@ class SimARM(object):
         dlF = self._dstpc(dstLo)
         dhF = self._dstpc(dstHi)
         def fn():
+            if self._lazy_flags: self._materialize_flags()
             r = self.regs[Rm] * self.regs[Rs]
-            self.cpsrN = (r >> 64) & 1
-            self.cpsrZ = not r
+            self._cpsrN = (r >> 64) & 1
+            self._cpsrZ = not r
             dlF(r)
             dhF(r >> 32)
         return fn
@@ -1417,9 +2230,6 @@ class SimARM(object):
             a = 0
             b, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._lazy_flags = (True, a, b, r)
             dF(r)
         return fn
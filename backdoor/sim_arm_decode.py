@@ -0,0 +1,609 @@
+# Table-driven instruction decoder for the ARMv5T / Thumb subset of %sim.
+#
+# The simulator's icache used to fill itself by writing each block of code to a
+# temp file and running arm-none-eabi-objdump on it. This module decodes the
+# same bytes in-process. It produces the same 'op' and 'args' text objdump
+# would, so the op_* generators in sim_arm_core keep working unchanged, plus a
+# structured view of each instruction:
+#
+#   cond        Condition code suffix, '' for always
+#   setflags    True if the instruction updates N/Z/C/V
+#   operands    Tuple of operands, each one a tuple:
+#
+#       ('reg', n)                          Register number
+#       ('imm', value)                      32-bit immediate
+#       ('shift', kind, amount)             Applies to the previous operand.
+#                                           Kind is lsl/lsr/asr/ror/rrx,
+#                                           amount is an int or ('reg', n)
+#       ('mem', base, offset, pre, wb)      Offset is None, ('imm', signed),
+#                                           or ('reg', n, subtract, shift)
+#       ('list', (n, n, ...))               Register list
+#       ('target', address)                 Branch target
+#
+# Encodings we don't recognize decode to None; callers can fall back to
+# objdump for those.
+
+__all__ = [
+    'DecodedInstruction',
+    'decode_instruction', 'decode_instructions',
+]
+
+import struct
+from code import Instruction
+
+reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+             'r8', 'r9', 'sl', 'fp', 'ip', 'sp', 'lr', 'pc')
+
+cond_names = ('eq', 'ne', 'cs', 'cc', 'mi', 'pl', 'vs', 'vc',
+              'hi', 'ls', 'ge', 'lt', 'gt', 'le', '', 'nv')
+
+shift_names = ('lsl', 'lsr', 'asr', 'ror')
+
+dp_names = ('and', 'eor', 'sub', 'rsb', 'add', 'adc', 'sbc', 'rsc',
+            'tst', 'teq', 'cmp', 'cmn', 'orr', 'mov', 'bic', 'mvn')
+
+thumb_alu_names = ('and', 'eor', 'lsl', 'lsr', 'asr', 'adc', 'sbc', 'ror',
+                   'tst', 'neg', 'cmp', 'cmn', 'orr', 'mul', 'bic', 'mvn')
+
+
+class DecodedInstruction(Instruction):
+    """One decoded instruction, an Instruction with the structured view too"""
+    __slots__ = ('size', 'cond', 'setflags', 'operands')
+
+    def __init__(self, address, size, op, args, comment = '',
+                 cond = '', setflags = False, operands = ()):
+        Instruction.__init__(self, address, op, args, comment, address + size)
+        self.size = size
+        self.cond = cond
+        self.setflags = setflags
+        self.operands = operands
+
+
+def _sext(value, bits):
+    sign = 1 << (bits - 1)
+    return (value & (sign - 1)) - (value & sign)
+
+
+def _reglist_text(regs):
+    return '{%s}' % ', '.join(reg_names[r] for r in regs)
+
+
+def _reglist(mask):
+    return tuple(r for r in range(16) if mask & (1 << r))
+
+
+def _signed32(value):
+    # objdump prints 32-bit immediates with %d
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def _imm_comment(value):
+    # objdump's value_in_comment rule
+    value = _signed32(value)
+    if value > 32 or value < -16:
+        return '0x%x' % (value & 0xffffffff)
+    return ''
+
+
+###########################################################################
+# 32-bit ARM
+###########################################################################
+
+
+def _arm_shift(w, print_shift = True):
+    """Register operand with optional shift, as (text, operands)"""
+    rm = w & 0xf
+    text = reg_names[rm]
+    operands = [('reg', rm)]
+    if w & 0xff0:
+        kind = (w >> 5) & 3
+        if not (w & 0x10):
+            amount = (w >> 7) & 0x1f
+            if amount == 0:
+                if kind == 3:
+                    return text + ', rrx', operands + [('shift', 'rrx', 1)]
+                amount = 32
+            if print_shift:
+                text += ', %s #%d' % (shift_names[kind], amount)
+            else:
+                text += ', #%d' % amount
+            operands.append(('shift', shift_names[kind], amount))
+        elif w & 0x80:
+            return None, None
+        else:
+            rs = (w >> 8) & 0xf
+            if print_shift:
+                text += ', %s %s' % (shift_names[kind], reg_names[rs])
+            else:
+                text += ', %s' % reg_names[rs]
+            operands.append(('shift', shift_names[kind], ('reg', rs)))
+    return text, operands
+
+
+def _arm_operand2(w):
+    """Shifter operand as (text, operands, comment)"""
+    if w & 0x02000000:
+        rotate = (w >> 7) & 0x1e
+        immed = w & 0xff
+        value = ((immed >> rotate) | (immed << (32 - rotate))) & 0xffffffff
+        for i in range(0, 32, 2):
+            if ((value << i) | (value >> (32 - i))) & 0xffffffff <= 0xff:
+                break
+        if i != rotate:
+            text = '#%d, %d' % (immed, rotate)
+        else:
+            text = '#%d' % _signed32(value)
+        return text, [('imm', value)], _imm_comment(value)
+    text, operands = _arm_shift(w)
+    return text, operands, ''
+
+
+def _arm_address(w, address):
+    """Addressing mode 2 (word and unsigned byte) as (text, operand, comment)"""
+    rn = (w >> 16) & 0xf
+    pre = bool(w & (1 << 24))
+    up = bool(w & (1 << 23))
+    wb = bool(w & (1 << 21))
+    comment = ''
+
+    if rn == 15 and not (w & 0x02000000):
+        offset = w & 0xfff
+        if not up:
+            offset = -offset
+        if pre:
+            text = '[pc, #%d]%s' % (offset, '!' if wb else '')
+            target = address + 8 + offset
+        else:
+            text = '[pc], #%d' % offset
+            target = address + 8
+        comment = '0x%08x' % (target & 0xffffffff)
+        return text, ('mem', 15, ('imm', offset), pre, wb), comment
+
+    base = '[%s' % reg_names[rn]
+    sign = '' if up else '-'
+    if w & 0x02000000:
+        shift_text, shift_ops = _arm_shift(w)
+        if shift_text is None:
+            return None, None, None
+        offset = ('reg', w & 0xf, not up, shift_ops[1] if len(shift_ops) > 1 else None)
+        if pre:
+            text = '%s, %s%s]%s' % (base, sign, shift_text, '!' if wb else '')
+        else:
+            text = '%s], %s%s' % (base, sign, shift_text)
+    else:
+        imm = w & 0xfff
+        offset = ('imm', imm if up else -imm)
+        if pre:
+            if imm or not up or wb:
+                text = '%s, #%s%d]%s' % (base, sign, imm, '!' if wb else '')
+            else:
+                text = base + ']'
+        else:
+            text = '%s], #%s%d' % (base, sign, imm)
+    return text, ('mem', rn, offset, pre, wb), comment
+
+
+def _arm_address_half(w, address):
+    """Addressing mode 3 (halfword, signed byte) as (text, operand, comment)"""
+    rn = (w >> 16) & 0xf
+    pre = bool(w & (1 << 24))
+    up = bool(w & (1 << 23))
+    wb = bool(w & (1 << 21))
+    sign = '' if up else '-'
+
+    if w & (1 << 22):
+        imm = ((w >> 4) & 0xf0) | (w & 0xf)
+        offset = ('imm', imm if up else -imm)
+        if rn == 15:
+            if pre:
+                text = '[pc, #%s%d]' % (sign, imm)
+                comment = '0x%08x' % ((address + 8 + offset[1]) & 0xffffffff)
+            else:
+                text = '[pc], #%s%d' % (sign, imm)
+                comment = '0x%08x' % (address + 8)
+            return text, ('mem', 15, offset, pre, wb), comment
+        if pre:
+            if wb:
+                text = '[%s, #%s%d]!' % (reg_names[rn], sign, imm)
+            elif imm or not up:
+                text = '[%s, #%s%d]' % (reg_names[rn], sign, imm)
+            else:
+                text = '[%s]' % reg_names[rn]
+        else:
+            text = '[%s], #%s%d' % (reg_names[rn], sign, imm)
+    else:
+        rm = w & 0xf
+        offset = ('reg', rm, not up, None)
+        if pre:
+            text = '[%s, %s%s]%s' % (reg_names[rn], sign, reg_names[rm], '!' if wb else '')
+        else:
+            text = '[%s], %s%s' % (reg_names[rn], sign, reg_names[rm])
+    return text, ('mem', rn, offset, pre, wb), ''
+
+
+def _decode_arm(w, address):
+    cond_bits = w >> 28
+    cond = cond_names[cond_bits]
+    rd = (w >> 12) & 0xf
+    rn = (w >> 16) & 0xf
+
+    def make(op, args, comment = '', setflags = False, operands = ()):
+        return DecodedInstruction(address, 4, op, args, comment,
+            cond, setflags, tuple(operands))
+
+    if cond_bits == 0xf:
+        # Unconditional space: only BLX (immediate) is interesting
+        if (w & 0x0e000000) == 0x0a000000:
+            target = (address + 8 + (_sext(w & 0xffffff, 24) << 2)
+                + ((w >> 23) & 2)) & 0xffffffff
+            return DecodedInstruction(address, 4, 'blx', '0x%08x' % target,
+                operands = (('target', target),))
+        return None
+
+    if w == 0xe1a00000:
+        return make('nop', '', '(mov r0, r0)')
+
+    if (w & 0x0ffffff0) == 0x012fff10:
+        return make('bx' + cond, reg_names[w & 0xf], operands = [('reg', w & 0xf)])
+
+    if (w & 0x0ffffff0) == 0x012fff30:
+        return make('blx' + cond, reg_names[w & 0xf], operands = [('reg', w & 0xf)])
+
+    if (w & 0x0fff0ff0) == 0x016f0f10:
+        return make('clz' + cond, '%s, %s' % (reg_names[rd], reg_names[w & 0xf]),
+            operands = [('reg', rd), ('reg', w & 0xf)])
+
+    if (w & 0x0fbf0fff) == 0x010f0000:
+        psr = 'SPSR' if w & (1 << 22) else 'CPSR'
+        return make('mrs' + cond, '%s, %s' % (reg_names[rd], psr),
+            operands = [('reg', rd)])
+
+    if (w & 0x0db0f000) == 0x0120f000:
+        psr = ('SPSR_' if w & (1 << 22) else 'CPSR_') + ''.join(
+            c for bit, c in ((19, 'f'), (18, 's'), (17, 'x'), (16, 'c')) if w & (1 << bit))
+        text, operands, comment = _arm_operand2(w)
+        if text is None:
+            return None
+        return make('msr' + cond, '%s, %s' % (psr, text), comment, operands = operands)
+
+    if (w & 0x0fc000f0) == 0x00000090:
+        # mul, mla
+        s = 's' if w & (1 << 20) else ''
+        rm, rs, racc = w & 0xf, (w >> 8) & 0xf, rd
+        if w & (1 << 21):
+            return make('mla' + s + cond, '%s, %s, %s, %s' % (
+                reg_names[rn], reg_names[rm], reg_names[rs], reg_names[racc]),
+                setflags = bool(s), operands = [('reg', rn), ('reg', rm), ('reg', rs), ('reg', racc)])
+        return make('mul' + s + cond, '%s, %s, %s' % (
+            reg_names[rn], reg_names[rm], reg_names[rs]),
+            setflags = bool(s), operands = [('reg', rn), ('reg', rm), ('reg', rs)])
+
+    if (w & 0x0f8000f0) == 0x00800090:
+        # umull, umlal, smull, smlal
+        name = ('umull', 'umlal', 'smull', 'smlal')[(w >> 21) & 3]
+        s = 's' if w & (1 << 20) else ''
+        rm, rs = w & 0xf, (w >> 8) & 0xf
+        return make(name + s + cond, '%s, %s, %s, %s' % (
+            reg_names[rd], reg_names[rn], reg_names[rm], reg_names[rs]),
+            setflags = bool(s), operands = [('reg', rd), ('reg', rn), ('reg', rm), ('reg', rs)])
+
+    if (w & 0x0e000090) == 0x00000090 and (w & 0x60):
+        # Halfword and signed byte transfers
+        load = bool(w & (1 << 20))
+        sh = (w >> 5) & 3
+        if sh == 1:
+            name = 'ldrh' if load else 'strh'
+        elif load:
+            name = ('', '', 'ldrsb', 'ldrsh')[sh]
+        else:
+            # ldrd/strd are ARMv5TE
+            return None
+        text, mem, comment = _arm_address_half(w, address)
+        return make(name + cond, '%s, %s' % (reg_names[rd], text), comment,
+            operands = [('reg', rd), mem])
+
+    if (w & 0x0c000000) == 0x00000000:
+        # Data processing
+        opcode = (w >> 21) & 0xf
+        setflags = bool(w & (1 << 20))
+        name = dp_names[opcode]
+        text, operands, comment = _arm_operand2(w)
+        if text is None:
+            return None
+
+        if 8 <= opcode <= 11:
+            if not setflags:
+                return None
+            return make(name + ('p' if rd == 15 else '') + cond,
+                '%s, %s' % (reg_names[rn], text), comment, True,
+                [('reg', rn)] + operands)
+
+        s = 's' if setflags else ''
+        if opcode == 13 and not (w & 0x02000000) and (w & 0xff0):
+            # Register shifts get their own UAL mnemonics
+            if (w & 0xff0) == 0x060:
+                return make('rrx' + s + cond, '%s, %s' % (reg_names[rd], reg_names[w & 0xf]),
+                    '', setflags, [('reg', rd), ('reg', w & 0xf)])
+            kind = shift_names[(w >> 5) & 3]
+            shift_text, shift_ops = _arm_shift(w, print_shift = False)
+            if shift_text is None:
+                return None
+            return make(kind + s + cond, '%s, %s' % (reg_names[rd], shift_text),
+                '', setflags, [('reg', rd)] + shift_ops)
+
+        if opcode in (13, 15):
+            return make(name + s + cond, '%s, %s' % (reg_names[rd], text),
+                comment, setflags, [('reg', rd)] + operands)
+
+        return make(name + s + cond, '%s, %s, %s' % (reg_names[rd], reg_names[rn], text),
+            comment, setflags, [('reg', rd), ('reg', rn)] + operands)
+
+    if (w & 0x0c000000) == 0x04000000:
+        # Word and unsigned byte transfers
+        if (w & 0x02000010) == 0x02000010:
+            return None
+        load = bool(w & (1 << 20))
+
+        # Single register push and pop get their own mnemonics
+        if (w & 0x0fff0fff) == 0x052d0004:
+            return make('push' + cond, '{%s}' % reg_names[rd],
+                '(str%s %s, [sp, #-4]!)' % (cond, reg_names[rd]),
+                operands = [('list', (rd,))])
+        if (w & 0x0fff0fff) == 0x049d0004:
+            return make('pop' + cond, '{%s}' % reg_names[rd],
+                '(ldr%s %s, [sp], #4)' % (cond, reg_names[rd]),
+                operands = [('list', (rd,))])
+
+        name = ('ldr' if load else 'str') + ('b' if w & (1 << 22) else '')
+        if not (w & (1 << 24)) and (w & (1 << 21)):
+            name += 't'
+        text, mem, comment = _arm_address(w, address)
+        if text is None:
+            return None
+        return make(name + cond, '%s, %s' % (reg_names[rd], text), comment,
+            operands = [('reg', rd), mem])
+
+    if (w & 0x0e000000) == 0x08000000:
+        # Block transfers
+        load = bool(w & (1 << 20))
+        regs = _reglist(w & 0xffff)
+        hat = '^' if w & (1 << 22) else ''
+        wb = '!' if w & (1 << 21) else ''
+        mode = ('da', 'ia', 'db', 'ib')[(w >> 23) & 3]
+        if (w & 0x0fff0000) == (0x08bd0000 if load else 0x092d0000) and not hat:
+            return make(('pop' if load else 'push') + cond, _reglist_text(regs),
+                operands = [('list', regs)])
+        name = ('ldm' if load else 'stm') + ('' if mode == 'ia' else mode) + cond
+        return make(name, '%s%s, %s%s' % (reg_names[rn], wb, _reglist_text(regs), hat),
+            operands = [('reg', rn), ('list', regs)])
+
+    if (w & 0x0e000000) == 0x0a000000:
+        target = (address + 8 + (_sext(w & 0xffffff, 24) << 2)) & 0xffffffff
+        name = 'bl' if w & (1 << 24) else 'b'
+        return make(name + cond, '0x%08x' % target, operands = [('target', target)])
+
+    if (w & 0x0f000000) == 0x0f000000:
+        return make('svc' + cond, '0x%08x' % (w & 0xffffff),
+            operands = [('imm', w & 0xffffff)])
+
+    return None
+
+
+###########################################################################
+# 16-bit Thumb
+###########################################################################
+
+
+def _decode_thumb(h, h2, address):
+    lo = h & 7
+    mid = (h >> 3) & 7
+
+    def make(op, args, comment = '', setflags = False, operands = (), size = 2, cond = ''):
+        return DecodedInstruction(address, size, op, args, comment,
+            cond, setflags, tuple(operands))
+
+    def lo3(op, rd, rs, setflags):
+        return make(op, '%s, %s' % (reg_names[rd], reg_names[rs]), '',
+            setflags, [('reg', rd), ('reg', rs)])
+
+    top5 = h >> 11
+
+    if h == 0x46c0:
+        return make('nop', '', '(mov r8, r8)')
+
+    if (h & 0xfc00) == 0x4000:
+        # Format 4, ALU operations
+        opcode = (h >> 6) & 0xf
+        name = thumb_alu_names[opcode]
+        if opcode in (8, 10, 11):
+            return lo3(name, lo, mid, True)
+        return lo3(name + 's', lo, mid, True)
+
+    if (h & 0xff00) == 0xb000:
+        # Format 13, adjust stack pointer
+        imm = (h & 0x7f) << 2
+        name = 'sub' if h & 0x80 else 'add'
+        return make(name, 'sp, #%d' % imm, '', False, [('reg', 13), ('imm', imm)])
+
+    if (h & 0xff87) == 0x4780:
+        rm = (h >> 3) & 0xf
+        return make('blx', reg_names[rm], operands = [('reg', rm)])
+
+    if (h & 0xff87) == 0x4700:
+        rm = (h >> 3) & 0xf
+        return make('bx', reg_names[rm], operands = [('reg', rm)])
+
+    if (h & 0xfc00) == 0x4400:
+        # Format 5, hi register operations
+        op = (h >> 8) & 3
+        if op == 3:
+            return None
+        rd = lo | ((h >> 4) & 8)
+        rs = (h >> 3) & 0xf
+        return lo3(('add', 'cmp', 'mov')[op], rd, rs, op == 1)
+
+    if (h & 0xf600) == 0xb400:
+        # Format 14, push and pop
+        regs = _reglist(h & 0xff)
+        if h & 0x800:
+            if h & 0x100:
+                regs += (15,)
+            return make('pop', _reglist_text(regs), operands = [('list', regs)])
+        if h & 0x100:
+            regs += (14,)
+        return make('push', _reglist_text(regs), operands = [('list', regs)])
+
+    if (h & 0xf800) == 0x1800:
+        # Format 2, add/subtract
+        rn = (h >> 6) & 7
+        name = 'subs' if h & 0x200 else 'adds'
+        if h & 0x400:
+            return make(name, '%s, %s, #%d' % (reg_names[lo], reg_names[mid], rn), '',
+                True, [('reg', lo), ('reg', mid), ('imm', rn)])
+        return make(name, '%s, %s, %s' % (reg_names[lo], reg_names[mid], reg_names[rn]), '',
+            True, [('reg', lo), ('reg', mid), ('reg', rn)])
+
+    if (h & 0xf000) == 0x5000:
+        # Formats 7 and 8, load/store with register offset
+        rm = (h >> 6) & 7
+        name = ('str', 'strh', 'strb', 'ldrsb', 'ldr', 'ldrh', 'ldrb', 'ldrsh')[(h >> 9) & 7]
+        return make(name, '%s, [%s, %s]' % (reg_names[lo], reg_names[mid], reg_names[rm]),
+            operands = [('reg', lo), ('mem', mid, ('reg', rm, False, None), True, False)])
+
+    if top5 < 3:
+        # Format 1, move shifted register
+        amount = (h >> 6) & 0x1f
+        kind = top5
+        if kind == 0 and amount == 0:
+            return lo3('movs', lo, mid, True)
+        if kind and amount == 0:
+            amount = 32
+        return make(shift_names[kind] + 's', '%s, %s, #%d' % (reg_names[lo], reg_names[mid], amount),
+            '', True, [('reg', lo), ('reg', mid), ('shift', shift_names[kind], amount)])
+
+    if (h & 0xe000) == 0x2000:
+        # Format 3, move/compare/add/subtract immediate
+        rd = (h >> 8) & 7
+        imm = h & 0xff
+        name = ('movs', 'cmp', 'adds', 'subs')[(h >> 11) & 3]
+        return make(name, '%s, #%d' % (reg_names[rd], imm), '',
+            True, [('reg', rd), ('imm', imm)])
+
+    if top5 == 9:
+        # Format 6, PC-relative load
+        rd = (h >> 8) & 7
+        imm = (h & 0xff) << 2
+        target = ((address + 4) & ~3) + imm
+        return make('ldr', '%s, [pc, #%d]' % (reg_names[rd], imm), '(0x%08x)' % target,
+            operands = [('reg', rd), ('mem', 15, ('imm', imm), True, False)])
+
+    if (h & 0xe000) == 0x6000 or (h & 0xf000) == 0x8000:
+        # Formats 9 and 10, load/store with immediate offset
+        imm = (h >> 6) & 0x1f
+        if (h & 0xf000) == 0x8000:
+            name, imm = ('ldrh' if h & 0x800 else 'strh'), imm << 1
+        elif h & 0x1000:
+            name = 'ldrb' if h & 0x800 else 'strb'
+        else:
+            name, imm = ('ldr' if h & 0x800 else 'str'), imm << 2
+        return make(name, '%s, [%s, #%d]' % (reg_names[lo], reg_names[mid], imm),
+            operands = [('reg', lo), ('mem', mid, ('imm', imm), True, False)])
+
+    if (h & 0xf000) == 0x9000:
+        # Format 11, SP-relative load/store
+        rd = (h >> 8) & 7
+        imm = (h & 0xff) << 2
+        name = 'ldr' if h & 0x800 else 'str'
+        return make(name, '%s, [sp, #%d]' % (reg_names[rd], imm),
+            operands = [('reg', rd), ('mem', 13, ('imm', imm), True, False)])
+
+    if (h & 0xf000) == 0xa000:
+        # Format 12, load address
+        rd = (h >> 8) & 7
+        imm = (h & 0xff) << 2
+        if h & 0x800:
+            return make('add', '%s, sp, #%d' % (reg_names[rd], imm), '',
+                False, [('reg', rd), ('reg', 13), ('imm', imm)])
+        target = ((address + 4) & ~3) + imm
+        return make('add', '%s, pc, #%d' % (reg_names[rd], imm),
+            '(adr %s, 0x%08x)' % (reg_names[rd], target),
+            False, [('reg', rd), ('reg', 15), ('imm', imm)])
+
+    if (h & 0xf000) == 0xc000:
+        # Format 15, multiple load/store
+        rb = (h >> 8) & 7
+        regs = _reglist(h & 0xff)
+        if h & 0x800:
+            wb = '' if rb in regs else '!'
+            return make('ldmia', '%s%s, %s' % (reg_names[rb], wb, _reglist_text(regs)),
+                operands = [('reg', rb), ('list', regs)])
+        return make('stmia', '%s!, %s' % (reg_names[rb], _reglist_text(regs)),
+            operands = [('reg', rb), ('list', regs)])
+
+    if (h & 0xff00) == 0xdf00:
+        return make('svc', '%d' % (h & 0xff), operands = [('imm', h & 0xff)])
+
+    if (h & 0xff00) == 0xbe00:
+        return make('bkpt', '0x%04x' % (h & 0xff), operands = [('imm', h & 0xff)])
+
+    if (h & 0xf000) == 0xd000:
+        # Format 16, conditional branch
+        cc = (h >> 8) & 0xf
+        if cc >= 0xe:
+            return None
+        target = (address + 4 + (_sext(h & 0xff, 8) << 1)) & 0xffffffff
+        return make('b%s.n' % cond_names[cc], '0x%08x' % target,
+            operands = [('target', target)], cond = cond_names[cc])
+
+    if (h & 0xf800) == 0xe000:
+        # Format 18, unconditional branch
+        target = (address + 4 + (_sext(h & 0x7ff, 11) << 1)) & 0xffffffff
+        return make('b.n', '0x%08x' % target, operands = [('target', target)])
+
+    if (h & 0xf800) == 0xf000 and h2 is not None and (h2 & 0xe800) == 0xe800:
+        # Format 19, long branch with link (a pair of halfwords)
+        offset = (_sext(h & 0x7ff, 11) << 12) | ((h2 & 0x7ff) << 1)
+        target = (address + 4 + offset) & 0xffffffff
+        if h2 & 0x1000:
+            name = 'bl'
+        else:
+            name = 'blx'
+            target &= ~3
+        return make(name, '0x%08x' % target, operands = [('target', target)], size = 4)
+
+    return None
+
+
+def decode_instruction(data, offset, address, thumb = True):
+    """Decode the instruction at data[offset:], located at 'address'.
+    Returns a DecodedInstruction, or None if we can't decode it.
+    """
+    if thumb:
+        if offset + 2 > len(data):
+            return None
+        h, = struct.unpack_from('<H', data, offset)
+        h2 = None
+        if offset + 4 <= len(data):
+            h2, = struct.unpack_from('<H', data, offset + 2)
+        return _decode_thumb(h, h2, address)
+    else:
+        if offset + 4 > len(data):
+            return None
+        w, = struct.unpack_from('<I', data, offset)
+        return _decode_arm(w, address)
+
+
+def decode_instructions(data, address = 0, thumb = True):
+    """Decode instructions from a string buffer, like disassembly_lines().
+
+    Stops at the end of the buffer, or at the first instruction we can't
+    decode. Returns a list of DecodedInstruction objects.
+    """
+    lines = []
+    offset = 0
+    while True:
+        instr = decode_instruction(data, offset, address + offset, thumb)
+        if instr is None:
+            return lines
+        lines.append(instr)
+        offset += instr.size
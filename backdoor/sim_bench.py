@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# Throughput benchmarks for the ARM simulator.
+#
+# Each kernel is a small synthetic loop that stresses one part of sim_arm_core:
+# straight-line arithmetic, a word copy whose stores go to the device, Thumb
+# calls with push/pop, ARM conditional execution and flags, and Thumb to ARM
+# interworking. A kernel runs from flash in an OfflineDevice, so there's no
+# hardware and no USB latency, only the simulator.
+#
+# Kernels are assembled with assemble_string() when the cross toolchain is
+# installed. Each one also has the same code as precomputed machine words, used
+# when there's no toolchain.
+#
+# For each kernel we report simulated instructions per second, and device
+# operations per instruction. The second number doesn't depend on the host, so
+# any change to it is a change in behavior. Results can be saved as a baseline
+# (sim-bench-baseline.json) and later runs are compared against it:
+#
+#   python3 sim_bench.py --save     Record a baseline on this machine
+#   python3 sim_bench.py            Compare, exit with status 1 on a regression
+
+__all__ = [
+    'BenchKernel', 'BenchResult', 'kernels',
+    'kernel_code', 'run_kernel', 'run_benchmarks',
+    'read_baseline', 'write_baseline', 'compare_baseline',
+]
+
+import json, struct, sys, time
+from code import assemble_string
+from sim_arm_core import SimARM, SimARMMemory
+from sim_offline import OfflineDevice
+from sim_profile import CountingDevice
+
+default_baseline_file = 'sim-bench-baseline.json'
+default_steps = 200000
+default_warmup = 2000
+default_repeat = 5
+
+# Slower than this fraction of the baseline counts as a regression
+default_tolerance = 0.1
+
+# Where kernels live in flash, the data memcpy reads, and the stack
+kernel_base = 0x20000
+stack_top = 0x2000000
+
+
+def _thumb(*halfwords):
+    return struct.pack('<%dH' % len(halfwords), *halfwords)
+
+
+def _arm(*words):
+    return struct.pack('<%dI' % len(words), *words)
+
+
+class BenchKernel(object):
+    """A benchmark loop, as assembly source and as the same code precomputed"""
+    def __init__(self, name, description, thumb, source, precomputed):
+        self.name = name
+        self.description = description
+        self.thumb = thumb
+        self.source = source
+        self.precomputed = precomputed
+
+    def __repr__(self):
+        return 'BenchKernel(%r)' % self.name
+
+
+kernels = [
+    BenchKernel('tight_loop', 'Thumb arithmetic in a loop', True, '''
+            movs    r0, #0
+            movs    r1, #0
+        loop:
+            adds    r0, #1
+            adds    r1, r1, r0
+            lsls    r2, r0, #2
+            eors    r2, r1
+            b       loop
+        ''', _thumb(
+            0x2000, 0x2100, 0x3001, 0x1809, 0x0082, 0x404a, 0xe7fa)),
+
+    BenchKernel('memcpy', 'Thumb word copy from flash to DRAM', True, '''
+        start:
+            ldr     r0, src
+            ldr     r1, dest
+            movs    r2, #64
+        loop:
+            ldr     r3, [r0]
+            adds    r0, #4
+            str     r3, [r1]
+            adds    r1, #4
+            subs    r2, #1
+            bne     loop
+            b       start
+            .align  2
+        src:
+            .word   0x00030000
+        dest:
+            .word   0x01c80000
+        ''', _thumb(
+            0x4804, 0x4905, 0x2240, 0x6803, 0x3004, 0x600b, 0x3104, 0x3a01,
+            0xd1f9, 0xe7f5) + _arm(0x00030000, 0x01c80000)),
+
+    BenchKernel('calls', 'Thumb bl to a function with push/pop prologue', True, '''
+            movs    r0, #0
+        loop:
+            bl      function
+            adds    r0, #1
+            b       loop
+        function:
+            push    {r4-r7, lr}
+            adds    r4, r0, #1
+            adds    r5, r4, r0
+            eors    r5, r4
+            pop     {r4-r7, pc}
+        ''', _thumb(
+            0x2000, 0xf000, 0xf802, 0x3001, 0xe7fb, 0xb5f0, 0x1c44, 0x1825,
+            0x4065, 0xbdf0)),
+
+    BenchKernel('flags', 'ARM compares and conditional execution', False, '''
+            mov     r0, #0
+            mov     r1, #100
+        loop:
+            add     r0, r0, #1
+            cmp     r0, r1
+            movgt   r2, r0
+            movle   r2, r1
+            tst     r0, #3
+            addeq   r3, r3, #1
+            subs    r4, r1, r0
+            rsbmi   r4, r4, #0
+            cmn     r4, #1
+            teq     r2, r3
+            b       loop
+        ''', _arm(
+            0xe3a00000, 0xe3a01064, 0xe2800001, 0xe1500001, 0xc1a02000,
+            0xd1a02001, 0xe3100003, 0x02833001, 0xe0514000, 0x42644000,
+            0xe3740001, 0xe1320003, 0xeafffff4)),
+
+    BenchKernel('interworking', 'Thumb blx to an ARM function and back', True, '''
+            .arch   armv5te
+            ldr     r3, function_address
+        loop:
+            blx     r3
+            adds    r0, #1
+            b       loop
+            .align  2
+        function_address:
+            .word   function
+            .arm
+        function:
+            push    {r4, r5, lr}
+            add     r4, r0, r0, lsl #1
+            lsr     r5, r4, #2
+            pop     {r4, r5, lr}
+            bx      lr
+        ''', _thumb(
+            0x4b01, 0x4798, 0x3001, 0xe7fc) + _arm(
+            kernel_base + 0xc, 0xe92d4030, 0xe0804080, 0xe1a05124, 0xe8bd4030,
+            0xe12fff1e)),
+]
+
+
+def kernel_code(kernel):
+    """Machine code for a kernel at kernel_base, and where it came from.
+    Returns (data, 'assembled' or 'precomputed').
+    """
+    try:
+        return assemble_string(kernel_base, kernel.source, thumb=kernel.thumb), 'assembled'
+    except OSError:
+        # No cross toolchain
+        return kernel.precomputed, 'precomputed'
+
+
+class BenchResult(object):
+    """Timing for one kernel. 'seconds' is the best of the repeats."""
+    def __init__(self, kernel, origin, steps, seconds, device_ops):
+        self.name = kernel.name
+        self.origin = origin
+        self.steps = steps
+        self.seconds = seconds
+        self.device_ops = device_ops
+        self.instructions_per_second = steps / seconds
+        self.ops_per_instruction = device_ops / float(steps)
+
+    def __repr__(self):
+        return 'BenchResult(%r, %.0f instructions/s, %.4f ops/instruction)' % (
+            self.name, self.instructions_per_second, self.ops_per_instruction)
+
+
+class _OpCounter(object):
+    # Stands in for the SimProfiler that CountingDevice normally reports to
+    device_ops = 0
+
+
+def run_kernel(kernel, steps = default_steps, warmup = default_warmup, repeat = default_repeat):
+    """Time a kernel, starting from a fresh simulator each repeat.
+    The warmup steps fill the icache and translate blocks, and aren't counted.
+    """
+    code, origin = kernel_code(kernel)
+    firmware = bytearray(b'\xff' * kernel_base) + code
+    best = None
+    for i in range(repeat):
+        counter = _OpCounter()
+        memory = SimARMMemory(CountingDevice(OfflineDevice(firmware), counter))
+        memory.local_ram(0x1f00000, stack_top - 1)
+        arm = SimARM(memory)
+        arm.reset(kernel_base | kernel.thumb)
+        arm.regs[13] = stack_top
+        arm.step(warmup)
+
+        ops = counter.device_ops
+        begin = time.perf_counter()
+        arm.step(steps)
+        memory.flush()
+        seconds = time.perf_counter() - begin
+        ops = counter.device_ops - ops
+        if best is None or seconds < best[0]:
+            best = (seconds, ops)
+    return BenchResult(kernel, origin, steps, best[0], best[1])
+
+
+def run_benchmarks(names = None, steps = default_steps, repeat = default_repeat):
+    """Run every kernel, or just the named ones. Returns a list of BenchResult."""
+    selected = [k for k in kernels if not names or k.name in names]
+    unknown = set(names or ()) - set(k.name for k in kernels)
+    if unknown:
+        raise ValueError("Unknown benchmark kernels: %s" % ', '.join(sorted(unknown)))
+    return [run_kernel(k, steps, repeat=repeat) for k in selected]
+
+
+def read_baseline(filename = default_baseline_file):
+    """Saved results by kernel name, or {} if there's no baseline yet"""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def write_baseline(results, filename = default_baseline_file):
+    baseline = read_baseline(filename)
+    for r in results:
+        baseline[r.name] = dict(
+            instructions_per_second = r.instructions_per_second,
+            ops_per_instruction = r.ops_per_instruction)
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=4, sort_keys=True)
+
+
+def compare_baseline(results, baseline, tolerance = default_tolerance):
+    """Report lines for each result, and a list of names that regressed"""
+    lines = ['%-14s %14s %10s %14s  %s' % ('kernel', 'instr/s', 'vs base', 'ops/instr', '')]
+    regressions = []
+    for r in results:
+        base = baseline.get(r.name)
+        change = notes = ''
+        if base:
+            ratio = r.instructions_per_second / base['instructions_per_second']
+            change = '%+.1f%%' % (100 * (ratio - 1))
+            if ratio < 1 - tolerance:
+                notes = 'SLOWER'
+            if r.ops_per_instruction > base['ops_per_instruction'] + 1e-9:
+                notes = (notes + ' MORE DEVICE OPS').strip()
+            if notes:
+                regressions.append(r.name)
+        if r.origin != 'assembled':
+            notes = (notes + ' (%s)' % r.origin).strip()
+        lines.append('%-14s %14.0f %10s %14.4f  %s' % (
+            r.name, r.instructions_per_second, change, r.ops_per_instruction, notes))
+    return lines, regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulator throughput benchmarks')
+    parser.add_argument('kernels', nargs='*', help='Kernels to run (default: all of %s)' % ', '.join(k.name for k in kernels))
+    parser.add_argument('-n', '--steps', type=int, default=default_steps, help='Instructions to time per kernel')
+    parser.add_argument('-r', '--repeat', type=int, default=default_repeat, help='Runs per kernel, keeping the fastest')
+    parser.add_argument('-b', '--baseline', default=default_baseline_file, metavar='FILE', help='Baseline results file')
+    parser.add_argument('-t', '--tolerance', type=float, default=default_tolerance, help='Slowdown allowed before a kernel counts as a regression')
+    parser.add_argument('--save', action='store_true', help='Save these results as the new baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.kernels, args.steps, args.repeat)
+    lines, regressions = compare_baseline(results, read_baseline(args.baseline), args.tolerance)
+    print('\n'.join(lines))
+
+    if args.save:
+        write_baseline(results, args.baseline)
+        print('Saved baseline to %s' % args.baseline)
+    elif regressions:
+        print('Regressions: %s' % ', '.join(regressions))
+        sys.exit(1)
@@ -0,0 +1,500 @@
+# Basic block translation for the ARM simulator.
+#
+# Single-stepping pays for a hook lookup, an icache fetch, exception setup, a
+# PC fixup and a closure call on every instruction. Here we group straight-line
+# runs of cached instructions into blocks, and compile each block to a single
+# Python function. Common instruction forms are translated to inline Python;
+# anything else calls the same op_* closure that single-stepping would use, so
+# the two paths always agree on semantics.
+#
+# A block ends at the first instruction that may write the PC, at any
+# instruction with an HLE marker or a hook, and just before any block boundary
+# (breakpoint) address. Blocks are cached by SimARMMemory, and thrown away when
+# patch() or hook() touches the addresses they cover.
+
+__all__ = [ 'TranslatedBlock', 'BlockTranslator', 'condition_codes' ]
+
+import re
+
+# Longest block we'll translate, in instructions
+max_block_length = 64
+
+condition_codes = ('eq', 'ne', 'cs', 'hs', 'cc', 'lo', 'mi', 'pl',
+                   'vs', 'vc', 'hi', 'ls', 'ge', 'lt', 'gt', 'le')
+
+# Python expressions for each condition, using SimARM's lazy flag tests
+condition_expressions = dict((cc, 'arm._test_%s()' % cc) for cc in condition_codes)
+
+# Conditions on flags still pending from inline arithmetic in the same block,
+# in terms of the locals a, b, r. Keyed by is_sub. Matches _materialize_flags.
+def _local_conditions(C, V):
+    N = '((r >> 31) & 1)'
+    Z = '(not (r & 0xffffffff))'
+    d = {
+        'eq': Z, 'ne': '(r & 0xffffffff)', 'cs': C, 'cc': 'not ' + C,
+        'mi': N, 'pl': 'not ' + N, 'vs': V, 'vc': 'not ' + V,
+        'hi': '%s and not %s' % (C, Z), 'ls': '%s or not %s' % (Z, C),
+        'ge': '(not %s) == (not %s)' % (N, V), 'lt': '(not %s) != (not %s)' % (N, V),
+        'gt': '((not %s) == (not %s)) and not %s' % (N, V, Z),
+        'le': '((not %s) != (not %s)) or %s' % (N, V, Z),
+    }
+    d['hs'] = d['cs']
+    d['lo'] = d['cc']
+    return d
+
+local_condition_expressions = {
+    True: _local_conditions('(a >= b)', '(((a ^ b) & (a ^ r)) >> 31 & 1)'),
+    False: _local_conditions('(r > 0xffffffff)', '(((a ^ r) & (b ^ r)) >> 31 & 1)'),
+}
+
+branch_ops = set(
+    [ 'b', 'bl', 'blx', 'bx' ] +
+    [ op + cc for op in ('b', 'bl', 'blx', 'bx') for cc in condition_codes ])
+
+pc_re = re.compile(r'\bpc\b')
+flag_read_re = re.compile(r'\barm\._?cpsr([NZCV])\b(?! = )')
+flag_guard = 'if arm._lazy_flags: arm._materialize_flags()'
+
+
+def writes_pc(instr):
+    """Might this instruction change the flow of control?"""
+    if instr.op.split('.', 1)[0] in branch_ops:
+        return True
+    args = instr.args
+    if args.split(', ', 1)[0] == 'pc':
+        return True
+    brace = args.find('{')
+    return brace >= 0 and pc_re.search(args, brace) is not None
+
+
+def pc_value(instr, thumb):
+    """What the PC reads as while this instruction executes"""
+    if thumb:
+        return (instr.next_address + 3) & ~3
+    else:
+        return instr.address + 8
+
+
+class TranslatedBlock(object):
+    """A run of straight-line instructions, compiled to one Python function.
+
+    Calling run() executes every instruction in the block and leaves the PC
+    pointing at the next instruction to execute. If an instruction raises an
+    exception, the PC and step count are left pointing at that instruction.
+    """
+    def __init__(self, address, thumb, instructions, source):
+        self.address = address
+        self.thumb = thumb
+        self.instructions = instructions
+        self.count = len(instructions)
+        self.last = instructions[-1]
+        self.end = self.last.next_address
+        self.source = source
+        self.run = None
+
+    def __repr__(self):
+        return 'TranslatedBlock(address=%08x, thumb=%d, count=%d)' % (
+            self.address, self.thumb, self.count)
+
+    def overlaps(self, address, size):
+        return address < self.end and self.address < address + size
+
+
+class BlockTranslator(object):
+    """Compiles basic blocks for one SimARM instance.
+
+    The emit_* methods return a list of Python source lines implementing one
+    instruction inline, or None if they don't handle that particular form.
+    Inline code can refer to 'regs', 'arm', and the memory accessors by name.
+    """
+    def __init__(self, arm):
+        self.arm = arm
+        self.memory = arm.memory
+        self.reg_numbers = arm.reg_numbers
+
+    def translate(self, address, thumb):
+        """Build a new block starting at 'address', or return None if the
+        first instruction can't be translated. Does not cache the result.
+        """
+        memory = self.memory
+        arm = self.arm
+        instructions = []
+        opfuncs = []
+
+        instr = memory.fetch(address, thumb)
+        while True:
+            try:
+                opfunc = arm._opfunc(instr)
+            except Exception:
+                # Unsupported instruction; leave it for single-stepping to report
+                break
+
+            instructions.append(instr)
+            opfuncs.append(opfunc)
+
+            if (writes_pc(instr) or instr.hle
+                or instr.address in memory.hooks
+                or len(instructions) >= max_block_length
+                or instr.next_address in memory.block_boundaries):
+                break
+
+            instr = memory.instructions.get(thumb | (instr.next_address & ~1))
+            if instr is None:
+                break
+
+        if not instructions:
+            return None
+
+        block = TranslatedBlock(address, thumb, instructions, None)
+        block.source = self._source(block)
+        block.run = self._compile(block, opfuncs)
+        return block
+
+    def _source(self, block):
+        thumb = block.thumb
+        instructions = block.instructions
+        translated = []
+        pending = None
+
+        for index, instr in enumerate(instructions):
+            final = instr is block.last
+            code = None
+            if final and writes_pc(instr):
+                code = self.emit_branch(instr, thumb, pending)
+            if code is None:
+                code = self.emit(instr, thumb)
+            if code is None:
+                # Not translated inline; call the op closure
+                code = ['i', 'f[%d]()' % index]
+                if pc_re.search(instr.args):
+                    code.insert(1, 'regs[15] = 0x%08x' % pc_value(instr, thumb))
+                if final and writes_pc(instr):
+                    code.insert(1, 'arm._branch = None')
+                    code.append('regs[15] = arm._branch or 0x%08x' % instr.next_address)
+            translated.append(code)
+            pending = self._pending_flags(code, pending)
+
+        # Skip flag updates that are overwritten later in the block before
+        # anything can observe them. Anything that might raise an exception
+        # (memory access, op closures) observes all flags.
+        live = set('NZCV')
+        for index in reversed(range(len(translated))):
+            code = translated[index]
+            if code and code[0] == 'i':
+                code[0] = 'i = %d' % index
+                live = set('NZCV')
+                continue
+            written = set()
+            kept = []
+            for line in code:
+                flags = self._flags_written(line)
+                if flags:
+                    written.update(flags)
+                if flags is None or live.intersection(flags):
+                    kept.append(line)
+            if flag_guard in kept and not any(self._flags_written(l) for l in kept):
+                kept.remove(flag_guard)
+            code[:] = kept
+            live -= written
+            for line in code:
+                live.update(flag_read_re.findall(line))
+
+        body = []
+        for instr, code in zip(instructions, translated):
+            body.append('# %08x  %s\t%s' % (instr.address, instr.op, instr.args))
+            body.extend(code)
+        if not writes_pc(block.last):
+            body.append('regs[15] = 0x%08x' % block.end)
+
+        return '\n'.join([
+            'def factory(regs, arm, f, fault, load, load_half, load_byte, store, store_half, store_byte):',
+            '    def block():',
+            '        i = 0',
+            '        try:',
+        ] + [ '            ' + line for line in body ] + [
+            '        except:',
+            '            fault(i)',
+            '            raise',
+            '    return block',
+        ])
+
+    def _pending_flags(self, code, pending):
+        # Track inline arithmetic whose flags are still pending in a, b, r.
+        # Returns is_sub for that arithmetic, or None.
+        if code and code[0] == 'i':
+            return None
+        for line in code:
+            if line.startswith('arm._lazy_flags = ('):
+                pending = line.startswith('arm._lazy_flags = (True')
+            elif line.startswith(('a = ', 'b = ', 'r = ')) or self._flags_written(line):
+                pending = None
+        return pending
+
+    def _flags_written(self, line):
+        # Which flags does a line of inline code assign? None if it isn't a flag update.
+        if line.startswith('arm._lazy_flags = '):
+            return 'NZCV'
+        if line.startswith('arm._cpsr'):
+            return line[9]
+
+    def _compile(self, block, opfuncs):
+        arm = self.arm
+        memory = self.memory
+        namespace = {}
+        code = compile(block.source, '<block %08x>' % block.address, 'exec')
+        exec(code, namespace)
+
+        def fault(index):
+            # Point the PC at the instruction that didn't finish
+            arm.regs[15] = block.instructions[index].address
+            arm.step_count -= block.count - index - 1
+
+        return namespace['factory'](arm.regs, arm, opfuncs, fault,
+            memory.load, memory.load_half, memory.load_byte,
+            memory.store, memory.store_half, memory.store_byte)
+
+    def emit(self, instr, thumb):
+        try:
+            fn = getattr(self, 'emit_' + instr.op.split('.', 1)[0])
+        except AttributeError:
+            return None
+        return fn(instr, thumb)
+
+    def _reg(self, s):
+        # Register name to register number, or None. Excludes the PC.
+        rn = self.reg_numbers.get(s)
+        if rn is not None and rn != 15:
+            return rn
+
+    def _operand(self, s, instr, thumb):
+        # Plain register or literal operand, as a Python expression
+        if s[0] == '#':
+            try:
+                return '0x%x' % (int(s[1:], 0) & 0xffffffff)
+            except ValueError:
+                return None
+        rn = self.reg_numbers.get(s)
+        if rn == 15:
+            return '0x%x' % pc_value(instr, thumb)
+        if rn is not None:
+            return 'regs[%d]' % rn
+
+    def _3arg(self, instr):
+        l = instr.args.split(', ')
+        if len(l) == 2:
+            l = [l[0]] + l
+        if len(l) == 3:
+            return l
+
+    def _alu(self, instr, thumb, expr, flags = None):
+        # Two or three operand data processing, with unshifted operands
+        l = self._3arg(instr)
+        if not l:
+            return None
+        rd = self._reg(l[0])
+        a = self._operand(l[1], instr, thumb)
+        b = self._operand(l[2], instr, thumb)
+        if rd is None or a is None or b is None:
+            return None
+        if not flags:
+            return [ 'regs[%d] = (%s) & 0xffffffff' % (rd, expr.format(a=a, b=b)) ]
+        return [ 'a = %s' % a, 'b = %s' % b, 'r = %s' % expr.format(a='a', b='b') ] + flags + [
+            'regs[%d] = r & 0xffffffff' % rd ]
+
+    # Flag updates, matching the op_* implementations. Arithmetic leaves its
+    # flags pending; partial updates resolve anything pending first.
+    _nz_logic = [ flag_guard, 'arm._cpsrC = 0', 'arm._cpsrZ = r == 0', 'arm._cpsrN = (r >> 31) & 1' ]
+    _add_flags = [ 'arm._lazy_flags = (False, a, b, r)' ]
+    _sub_flags = [ 'arm._lazy_flags = (True, a, b, r)' ]
+
+    def emit_nop(self, instr, thumb):
+        return []
+
+    def emit_mov(self, instr, thumb):
+        dst, src = instr.args.split(', ', 1)
+        rd = self._reg(dst)
+        s = self._operand(src, instr, thumb)
+        if rd is not None and s is not None:
+            return [ 'regs[%d] = %s' % (rd, s) ]
+
+    def emit_movs(self, instr, thumb):
+        dst, src = instr.args.split(', ', 1)
+        rd = self._reg(dst)
+        s = self._operand(src, instr, thumb)
+        if rd is not None and s is not None:
+            return [ 'r = %s' % s ] + self._nz_logic + [ 'regs[%d] = r' % rd ]
+
+    def emit_add(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} + {b}')
+
+    def emit_adds(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} + {b}', self._add_flags)
+
+    def emit_sub(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} - {b}')
+
+    def emit_subs(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} - {b}', self._sub_flags)
+
+    def emit_rsb(self, instr, thumb):
+        return self._alu(instr, thumb, '{b} - {a}')
+
+    def emit_and(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} & {b}')
+
+    def emit_ands(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} & {b}', self._nz_logic)
+
+    def emit_orr(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} | {b}')
+
+    def emit_orrs(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} | {b}', self._nz_logic)
+
+    def emit_eor(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} ^ {b}')
+
+    def emit_eors(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} ^ {b}', self._nz_logic)
+
+    def emit_bic(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} & ~{b}')
+
+    def emit_bics(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} & ~{b}', [
+            flag_guard, 'arm._cpsrZ = r == 0', 'arm._cpsrN = (r >> 31) & 1' ])
+
+    def emit_mul(self, instr, thumb):
+        return self._alu(instr, thumb, '{a} * {b}')
+
+    def _compare(self, instr, thumb, expr, flags):
+        src0, src1 = instr.args.split(', ', 1)
+        a = self._reg(src0)
+        b = self._operand(src1, instr, thumb)
+        if a is not None and b is not None:
+            return [ 'a = regs[%d]' % a, 'b = %s' % b, 'r = %s' % expr ] + flags
+
+    def emit_cmp(self, instr, thumb):
+        return self._compare(instr, thumb, 'a - b', self._sub_flags)
+
+    def emit_cmn(self, instr, thumb):
+        return self._compare(instr, thumb, 'a + b', self._add_flags)
+
+    def emit_tst(self, instr, thumb):
+        return self._compare(instr, thumb, 'a & b', self._nz_logic)
+
+    def _shift(self, instr, thumb, flags):
+        # Shift by a constant from 1 to 31; other amounts have special cases
+        l = self._3arg(instr)
+        if not l or l[2][0] != '#':
+            return None
+        rd = self._reg(l[0])
+        rm = self._reg(l[1])
+        n = int(l[2][1:], 0) & 31
+        if rd is None or rm is None or not n:
+            return None
+        return self.shift_code[instr.op.split('.', 1)[0]](rm, n, flags) + [
+            'regs[%d] = r & 0xffffffff' % rd ]
+
+    shift_code = {
+        'lsl': lambda rm, n, flags: [ 'r = regs[%d] << %d' % (rm, n) ],
+        'lsls': lambda rm, n, flags: [ 'r = regs[%d] << %d' % (rm, n),
+            flag_guard, 'arm._cpsrC = 1 & (r >> 32)' ] + flags,
+        'lsr': lambda rm, n, flags: [ 'r = regs[%d] >> %d' % (rm, n) ],
+        'lsrs': lambda rm, n, flags: [ 'a = regs[%d]' % rm, 'r = a >> %d' % n,
+            flag_guard, 'arm._cpsrC = 1 & (a >> %d)' % (n - 1) ] + flags,
+    }
+
+    def emit_lsl(self, instr, thumb):
+        return self._shift(instr, thumb, None)
+
+    def emit_lsls(self, instr, thumb):
+        return self._shift(instr, thumb, [
+            'arm._cpsrZ = not (r & 0xffffffff)', 'arm._cpsrN = (r >> 31) & 1' ])
+
+    def emit_lsr(self, instr, thumb):
+        return self._shift(instr, thumb, None)
+
+    def emit_lsrs(self, instr, thumb):
+        return self._shift(instr, thumb, [
+            'arm._cpsrZ = not (r & 0xffffffff)', 'arm._cpsrN = (r >> 31) & 1' ])
+
+    def _address(self, right, instr, thumb):
+        # Python expression for [rn], [rn, #imm], or [rn, rm]
+        if right[0] != '[' or right[-1] != ']':
+            return None
+        parts = right[1:-1].split(', ')
+        base = self._operand(parts[0], instr, thumb)
+        if base is None or parts[0][0] == '#':
+            return None
+        if len(parts) == 1:
+            return base
+        if len(parts) == 2:
+            offset = self._operand(parts[1], instr, thumb)
+            if offset is None:
+                return None
+            if base.startswith('0x') and offset.startswith('0x'):
+                # PC-relative literal
+                return '0x%x' % ((int(base, 16) + int(offset, 16)) & 0xffffffff)
+            return '(%s + %s) & 0xffffffff' % (base, offset)
+
+    def _load(self, instr, thumb, accessor):
+        left, right = instr.args.split(', ', 1)
+        rd = self._reg(left)
+        addr = self._address(right, instr, thumb)
+        if rd is not None and addr is not None:
+            return [ 'i', 'regs[%d] = %s(%s)' % (rd, accessor, addr) ]
+
+    def _store(self, instr, thumb, accessor, mask):
+        left, right = instr.args.split(', ', 1)
+        rd = self._reg(left)
+        addr = self._address(right, instr, thumb)
+        if rd is not None and addr is not None:
+            return [ 'i', '%s(%s, %sregs[%d])' % (accessor, addr, mask, rd) ]
+
+    def emit_ldr(self, instr, thumb):
+        return self._load(instr, thumb, 'load')
+
+    def emit_ldrh(self, instr, thumb):
+        return self._load(instr, thumb, 'load_half')
+
+    def emit_ldrb(self, instr, thumb):
+        return self._load(instr, thumb, 'load_byte')
+
+    def emit_str(self, instr, thumb):
+        return self._store(instr, thumb, 'store', '')
+
+    def emit_strh(self, instr, thumb):
+        return self._store(instr, thumb, 'store_half', '0xffff & ')
+
+    def emit_strb(self, instr, thumb):
+        return self._store(instr, thumb, 'store_byte', '0xff & ')
+
+    def emit_branch(self, instr, thumb, pending = None):
+        """Inline code for direct branches at the end of a block.
+        If 'pending' is not None, flags are still pending from inline
+        arithmetic, with is_sub == pending.
+        """
+        op = instr.op.split('.', 1)[0]
+        try:
+            dest = int(instr.args, 0)
+        except ValueError:
+            return None
+
+        if op == 'b':
+            # Note that op_b branching to zero falls through; keep that quirk.
+            return [ 'regs[15] = 0x%08x' % (dest or instr.next_address) ]
+
+        if op == 'bl':
+            return [
+                'regs[14] = 0x%08x' % (instr.next_address | thumb),
+                'regs[15] = 0x%08x' % (dest or instr.next_address) ]
+
+        if op[0] == 'b' and op[1:] in condition_expressions:
+            if pending is None:
+                test = condition_expressions[op[1:]]
+            else:
+                test = local_condition_expressions[pending][op[1:]]
+            return [ 'regs[15] = 0x%08x if %s else 0x%08x' % (
+                dest or instr.next_address, test,
+                instr.next_address) ]
@@ -0,0 +1,172 @@
+# Instruction coverage maps for the ARM simulator.
+#
+# A SimCoverage keeps one bit per halfword of flash (2 MB of flash in 128 kB),
+# set once anything executes an instruction there. That's enough to see which
+# regions of firmware a simulation reached, and which are worth pre-decoding,
+# stubbing, or porting, without grepping a multi-gigabyte trace.log.
+#
+# Translated blocks are marked the first time they run; after that the bits
+# can't change, so the cost per block is one set lookup. Single-stepped
+# instructions are marked every time. Anything else that learns about
+# executed code, like a firmware hook, can call add() itself.
+#
+# Coverage files from many runs merge with a bitwise OR. They can also be
+# drawn as a memsquare-style Hilbert curve PNG, so nearby code stays nearby.
+#
+# File layout, all little-endian:
+#
+#   magic, base address, size in bytes, then the bitmap (bit 0 = lowest address)
+
+__all__ = [ 'SimCoverage', 'merge_coverage_files' ]
+
+import struct, zlib
+from memory_map import flash_size
+
+coverage_magic = b'SIMCV\x00\x01\x00'
+
+# Set bits in each byte value
+_popcount = bytes(bin(i).count('1') for i in range(256))
+
+
+class SimCoverage(object):
+    """Bitmap of executed halfwords in [base, base + size)"""
+
+    def __init__(self, base = 0, size = flash_size):
+        if (base | size) & 0xf:
+            raise ValueError("Coverage maps need 16-byte alignment")
+        self.base = base
+        self.size = size
+        self.bits = bytearray(size // 16)
+        self.seen = set()
+
+    def __repr__(self):
+        return 'SimCoverage(%08x-%08x, %d halfwords covered)' % (
+            self.base, self.base + self.size - 1, self.count())
+
+    def attach(self, arm):
+        """Start recording what a simulator executes. Stays attached until detach()."""
+        arm.coverage = self
+
+    def detach(self, arm):
+        if arm.coverage is self:
+            arm.coverage = None
+
+    def add(self, address, size):
+        """Mark the halfwords in [address, address + size) as executed"""
+        begin = max(address, self.base) - self.base
+        end = min(address + size, self.base + self.size) - self.base
+        bits = self.bits
+        for i in range(begin >> 1, (end + 1) >> 1):
+            bits[i >> 3] |= 1 << (i & 7)
+
+    def add_block(self, block):
+        """Called by SimARM after running a TranslatedBlock"""
+        self.seen.add(block)
+        self.add(block.address, block.end - block.address)
+
+    def __contains__(self, address):
+        offset = address - self.base
+        if 0 <= offset < self.size:
+            i = offset >> 1
+            return bool(self.bits[i >> 3] & (1 << (i & 7)))
+        return False
+
+    def count(self):
+        """Number of halfwords covered"""
+        return sum(self.bits.translate(_popcount))
+
+    def merge(self, other):
+        """Add everything another SimCoverage of the same region covered"""
+        if (other.base, other.size) != (self.base, self.size):
+            raise ValueError("Can't merge coverage of different regions")
+        n = len(self.bits)
+        self.bits[:] = (int.from_bytes(self.bits, 'little') |
+                        int.from_bytes(other.bits, 'little')).to_bytes(n, 'little')
+
+    def runs(self):
+        """List (begin, end) address ranges of covered code, end exclusive"""
+        runs = []
+        start = None
+        bits = self.bits
+        for index, byte in enumerate(bits):
+            if byte == 0xff and start is not None:
+                continue
+            if byte == 0 and start is None:
+                continue
+            for j in range(8):
+                address = self.base + ((index << 3) + j) * 2
+                if (byte >> j) & 1:
+                    if start is None:
+                        start = address
+                elif start is not None:
+                    runs.append((start, address))
+                    start = None
+        if start is not None:
+            runs.append((start, self.base + self.size))
+        return runs
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(coverage_magic + struct.pack('<II', self.base, self.size) + self.bits)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if data[:8] != coverage_magic:
+            raise ValueError("%s isn't a coverage file" % filename)
+        base, size = struct.unpack_from('<II', data, 8)
+        coverage = cls(base, size)
+        if len(data) != 16 + len(coverage.bits):
+            raise ValueError("%s is truncated" % filename)
+        coverage.bits[:] = data[16:]
+        return coverage
+
+    def write_png(self, filename, width = 1024):
+        """Draw the map as a square along a Hilbert curve, 'width' pixels on a
+        side. Each pixel's brightness is the fraction of its halfwords covered.
+        Needs the 'hilbert' extension module (setup.py).
+        """
+        from hilbert import hilbert
+        pixels = width * width
+        halfwords = self.size // 2
+        if width & (width - 1) or pixels > halfwords:
+            raise ValueError("Width must be a power of two, at most one pixel per halfword")
+        per = halfwords // pixels
+
+        covered = [(byte >> j) & 1 for byte in self.bits for j in range(8)]
+        if per > 1:
+            covered = [sum(covered[i:i + per]) for i in range(0, halfwords, per)]
+
+        rows = []
+        for y in range(width):
+            row = bytearray(width + 1)
+            for x in range(width):
+                row[x + 1] = covered[hilbert(x, y, width)] * 255 // per
+            rows.append(bytes(row))
+        _write_greyscale_png(filename, width, width, b''.join(rows))
+
+
+def merge_coverage_files(filenames):
+    """One SimCoverage with everything any of the files covered"""
+    total = None
+    for name in filenames:
+        coverage = SimCoverage.load(name)
+        if total is None:
+            total = coverage
+        else:
+            total.merge(coverage)
+    return total
+
+
+def _write_greyscale_png(filename, width, height, scanlines):
+    # 'scanlines' already has a zero filter byte before each row. (png.py
+    # only runs on Python 2, so this is just enough PNG for one image type.)
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(scanlines, 9)))
+        f.write(chunk(b'IEND', b''))
@@ -0,0 +1,150 @@
+# Parallel path exploration for the ARM simulator.
+#
+# To find out what a function does for many different inputs (SCSI CDB
+# variants, register values at a hook), we run the same simulation once per
+# input. With hardware there's only one device, so that's one run at a time.
+# With an OfflineDevice or a ReplayDevice the device is just memory, so we can
+# fork: every worker process starts as an exact copy of the simulator and its
+# device, applies its own register and memory seeds, and runs on its own core.
+#
+# Each case runs in a fresh fork (one task per worker process), so no case
+# sees another's device state. The SimARM is snapshotted before forking, so
+# each result only reports the local memory pages its own case changed.
+#
+# Hooks and HLE handlers print as they run. That output is discarded in the
+# workers, along with the text log and binary trace.
+
+__all__ = [ 'ExploreResult', 'explore', 'merged_coverage' ]
+
+import multiprocessing, os, sys
+from sim_offline import OfflineDevice
+from sim_replay import RecordingDevice, ReplayDevice
+from sim_profile import SimProfiler
+from sim_pages import page_shift, page_size
+
+default_max_steps = 100000
+
+# The simulator being explored, inherited by forked workers
+_arm = None
+_options = None
+
+
+class ExploreResult(object):
+    """What happened to one case.
+
+    'reason' is the SimStop reason, or None if 'error' has the exception.
+    'state' is SimARM.state at the end, 'coverage' maps each instruction
+    address we ran to an execution count, and 'pages' maps the page numbers
+    of changed local memory to their new contents.
+    """
+    def __init__(self, case, reason, error, state, coverage, pages):
+        self.case = case
+        self.reason = reason
+        self.error = error
+        self.state = state
+        self.coverage = coverage
+        self.pages = pages
+
+    def __repr__(self):
+        return 'ExploreResult(%r, %s, pc=%08x, %d instructions covered)' % (
+            self.case, self.error or self.reason, self.state['regs'][15], len(self.coverage))
+
+    def read(self, address, size):
+        """Read changed local memory, or None if the range didn't change"""
+        data = b''
+        while size > 0:
+            page = self.pages.get(address >> page_shift)
+            if page is None:
+                return None
+            offset = address & (page_size - 1)
+            chunk = page[offset:offset + size]
+            data += chunk
+            address += len(chunk)
+            size -= len(chunk)
+        return data
+
+
+def _check_device(device):
+    # Forked workers can't share hardware or a recording file
+    while True:
+        if isinstance(device, RecordingDevice):
+            raise ValueError("Can't explore while recording device traffic")
+        if isinstance(device, (OfflineDevice, ReplayDevice)):
+            return
+        inner = getattr(device, 'device', None)
+        if inner is None:
+            raise ValueError("Exploring needs an OfflineDevice or ReplayDevice, not %r" % device)
+        device = inner
+
+
+def _seed(arm, case):
+    # Registers by name, memory by address as a word or bytes
+    for key, value in case.items():
+        if isinstance(key, str):
+            number = arm.reg_numbers.get(key.lower())
+            if number is None:
+                raise ValueError("Unknown register %r" % key)
+            arm.regs[number] = value & 0xffffffff
+        elif isinstance(value, (bytes, bytearray)):
+            for i, byte in enumerate(value):
+                arm.memory.store_byte(key + i, byte)
+        else:
+            arm.memory.store(key, value & 0xffffffff)
+
+
+def _run_case(index):
+    arm = _arm
+    memory = arm.memory
+    case = _options['cases'][index]
+    sys.stdout = open(os.devnull, 'w')
+    memory.logfile = memory.trace = None
+
+    profiler = SimProfiler()
+    profiler.attach(arm)
+    reason = error = None
+    try:
+        _seed(arm, case)
+        reason = arm.run(_options['until_pcs'], _options['watch_addresses'], _options['max_steps']).reason
+        memory.flush()
+    except Exception as e:
+        error = repr(e)
+    profiler.detach(arm)
+
+    local = memory.local
+    pages = {}
+    for number in local.dirty:
+        if local.has_page(number):
+            pages[number] = local.read(number << page_shift, page_size)
+    return ExploreResult(case, reason, error, arm.state, profiler.pc_counts(), pages)
+
+
+def explore(arm, cases, until_pcs = (), watch_addresses = (), max_steps = default_max_steps, processes = None):
+    """Run a copy of the simulation for each case, in parallel.
+
+    Each case is a dict of starting registers (by name) and memory (by
+    address; an int is stored as a word, bytes as bytes). Each copy runs
+    as in SimARM.run(). Returns a list of ExploreResult, in case order.
+    """
+    global _arm, _options
+    _check_device(arm.memory.device)
+    cases = list(cases)
+    arm.snapshot()
+    _arm = arm
+    _options = dict(cases=cases, until_pcs=until_pcs, watch_addresses=watch_addresses, max_steps=max_steps)
+    try:
+        pool = multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=1)
+        try:
+            return pool.map(_run_case, range(len(cases)), chunksize=1)
+        finally:
+            pool.terminate()
+    finally:
+        _arm = _options = None
+
+
+def merged_coverage(results):
+    """Total executions per instruction address, over many ExploreResults"""
+    total = {}
+    for result in results:
+        for address, count in result.coverage.items():
+            total[address] = total.get(address, 0) + count
+    return total
@@ -0,0 +1,237 @@
+# Reverse stepping and time-travel queries for the ARM simulator.
+#
+# Once attached, a SimHistory takes a snapshot every 'interval' steps and keeps
+# an in-memory log of every device operation and its response. Going back N
+# steps restores the nearest earlier snapshot and re-executes forward to the
+# target step, answering device traffic from the log instead of hardware.
+# Stepping forward again after that keeps using the log until it runs out, so
+# the same hardware responses come back in the same order. If the simulation
+# takes a different path (registers edited by hand, say) the recorded future
+# is dropped at that point and the device goes live again.
+#
+# The same re-execution answers "when did this register or address last
+# change", one checkpoint interval at a time, newest first. That's instead of
+# grepping a multi-gigabyte trace.log.
+#
+# Hooks that keep state of their own, like the fake clock from sim_patches,
+# aren't rewound; they see re-executed steps again.
+
+__all__ = [ 'SimHistory' ]
+
+import bisect, os, sys
+from dump import write_block
+from sim_replay import ReplayMismatch
+
+default_interval = 100000
+
+
+class HistoryDevice(object):
+    """Device wrapper with a replayable log of operations and responses"""
+    def __init__(self, device, history):
+        self.device = device
+        self.history = history
+        self.log = []
+        self.position = 0
+
+    def __repr__(self):
+        return 'HistoryDevice(%r)' % self.device
+
+    def _call(self, name, args, live = None):
+        log = self.log
+        position = self.position
+        if position < len(log):
+            entry = log[position]
+            if entry[0] == name and entry[1] == args:
+                self.position = position + 1
+                return entry[2]
+            expected = '%s%r' % entry[:2]
+        else:
+            expected = 'end of history'
+
+        # Re-execution never goes to hardware
+        if self.history.replaying:
+            raise ReplayMismatch(self.history.arm.step_count, expected, '%s%r' % (name, args))
+        if position < len(log):
+            self.history.truncate(position)
+
+        result = (live or getattr(self.device, name))(*args)
+        log.append((name, args, result))
+        self.position = position + 1
+        return result
+
+    def peek(self, address):
+        return self._call('peek', (address,))
+
+    def poke(self, address, data):
+        self._call('poke', (address, data))
+
+    def peek_byte(self, address):
+        return self._call('peek_byte', (address,))
+
+    def poke_byte(self, address, data):
+        self._call('poke_byte', (address, data))
+
+    def read_block(self, address, wordcount):
+        return self._call('read_block', (address, wordcount))
+
+    def fill_words(self, address, word, wordcount):
+        self._call('fill_words', (address, word, wordcount))
+
+    def fill_bytes(self, address, byte, bytecount):
+        self._call('fill_bytes', (address, byte, bytecount))
+
+    def write_block(self, address, data):
+        self._call('write_block', (address, bytes(data)), lambda a, d: write_block(self.device, a, d))
+
+    def blx(self, address, r0 = 0, timeout = 30):
+        return self._call('blx', (address, r0), lambda a, r: self.device.blx(a, r, timeout=timeout))
+
+    def __getattr__(self, name):
+        # Fast reads use scsi_in where the device has it. Anything else
+        # (install_hle, console, ...) isn't recorded.
+        attr = getattr(self.device, name)
+        if name == 'scsi_in':
+            return lambda cdb, size: self._call('scsi_in', (cdb, size), attr)
+        return attr
+
+
+class Checkpoint(object):
+    """A snapshot, and where the device log was at the time"""
+    def __init__(self, snapshot, position):
+        self.snapshot = snapshot
+        self.position = position
+        self.step_count = snapshot.step_count
+
+
+class SimHistory(object):
+    """Periodic checkpoints and a device log, for going back in time"""
+
+    def __init__(self, interval = default_interval):
+        self.interval = interval
+        self.arm = None
+        self.device = None
+        self.checkpoints = []
+        self.next_step = 0
+        self.replaying = False
+
+    def attach(self, arm):
+        """Start keeping history. Everything before this is out of reach."""
+        if arm.history is not self:
+            self.arm = arm
+            self.device = HistoryDevice(arm.memory.device, self)
+            arm.memory.device = self.device
+            arm.history = self
+            self.checkpoints = []
+            self.checkpoint(arm)
+
+    def detach(self, arm):
+        if arm.history is self:
+            arm.history = None
+            if arm.memory.device is self.device:
+                arm.memory.device = self.device.device
+            self.checkpoints = []
+            self.device = None
+
+    def checkpoint(self, arm):
+        """Called by SimARM.step() once step_count reaches next_step"""
+        if self.replaying:
+            return
+        if not self.checkpoints or self.checkpoints[-1].step_count < arm.step_count:
+            self.checkpoints.append(Checkpoint(arm.snapshot(), self.device.position))
+        self.next_step = self.checkpoints[-1].step_count + self.interval
+
+    def truncate(self, position):
+        """The simulation left the recorded path; forget the future"""
+        del self.device.log[position:]
+        step_count = self.arm.step_count
+        while self.checkpoints and (self.checkpoints[-1].position > position or
+                                    self.checkpoints[-1].step_count >= step_count):
+            self.checkpoints.pop()
+        self.next_step = step_count
+
+    def _find(self, step_count):
+        # Index of the last checkpoint at or before a step
+        steps = [cp.step_count for cp in self.checkpoints]
+        i = bisect.bisect_right(steps, step_count) - 1
+        if i < 0:
+            raise IndexError("No history before step %d" % self.checkpoints[0].step_count)
+        return i
+
+    def _rewind(self, checkpoint):
+        self.arm.restore(checkpoint.snapshot)
+        self.device.position = checkpoint.position
+
+    def _replay(self, steps, watch = None):
+        # Re-execute quietly from the log. With 'watch', single-step and
+        # return the last (step_count, old, new) change in its value.
+        arm = self.arm
+        memory = arm.memory
+        saved = sys.stdout, memory.logfile, memory.trace
+        devnull = open(os.devnull, 'w')
+        sys.stdout = devnull
+        memory.logfile = memory.trace = None
+        self.replaying = True
+        change = None
+        try:
+            target = arm.step_count + steps
+            if watch is None:
+                while arm.step_count < target:
+                    arm.step(target - arm.step_count)
+            else:
+                value = watch()
+                while arm.step_count < target:
+                    arm.step()
+                    new_value = watch()
+                    if new_value != value:
+                        change = (arm.step_count, value, new_value)
+                        value = new_value
+        finally:
+            self.replaying = False
+            sys.stdout, memory.logfile, memory.trace = saved
+            devnull.close()
+        return change
+
+    def back(self, steps):
+        """Go back in time by a number of steps"""
+        arm = self.arm
+        target = arm.step_count - steps
+        if target < 0:
+            raise IndexError("Can't go back before step 0")
+        self._rewind(self.checkpoints[self._find(target)])
+        self._replay(target - arm.step_count)
+
+    def _watcher(self, what):
+        arm = self.arm
+        if isinstance(what, str):
+            number = arm.reg_numbers.get(what.lower())
+            if number is None:
+                raise ValueError("Unknown register %r" % what)
+            return lambda: arm.regs[number]
+        local = arm.memory.local
+        if local.load32(what) is None:
+            raise ValueError("%08x isn't in local memory; only registers and local memory can be watched" % what)
+        return lambda: local.load32(what)
+
+    def last_change(self, what):
+        """When did a register (by name) or a local memory word (by address)
+        last change? Returns (step_count, old value, new value) or None if
+        it never changed as far back as the history goes. The simulation
+        ends up where it started.
+        """
+        arm = self.arm
+        watch = self._watcher(what)
+        now = arm.step_count
+        current = arm.snapshot()
+        position = self.device.position
+        try:
+            end = now
+            for i in range(self._find(now), -1, -1):
+                checkpoint = self.checkpoints[i]
+                self._rewind(checkpoint)
+                change = self._replay(end - checkpoint.step_count, watch)
+                if change:
+                    return change
+                end = checkpoint.step_count
+        finally:
+            arm.restore(current)
+            self.device.position = position
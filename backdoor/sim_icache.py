@@ -0,0 +1,126 @@
+# Persistent instruction cache for the ARM simulator.
+#
+# Every new simulation starts out fetching and decoding the same TS01 flash,
+# a few hundred bytes per round trip. This file format lets us keep the flash
+# bytes we've seen and the instructions we decoded from them between sessions.
+#
+# A cache file is only valid for one version of the flash. We identify the
+# flash by a fingerprint over the firmware's key, signature table, and the
+# 16-bit checksum at the very end of flash (see flasher/checksum.py), which
+# the flasher recalculates any time the image changes.
+#
+# File layout, all little-endian:
+#
+#   header      magic, 20-byte fingerprint
+#   blocks      count, then (address, length, data) for each run of flash
+#   strings     count, then (length, utf8) for each objdump text line
+#   instrs      count, then (address | thumb, size, string index + 1 or 0)
+#
+# Instructions with a string index of zero came from sim_arm_decode; we store
+# only their address and decode them again from the cached flash on load.
+
+__all__ = [
+    'flash_fingerprint', 'icache_filename',
+    'read_icache', 'write_icache',
+]
+
+import struct, hashlib, os
+
+icache_magic = b'SIMIC\x00\x01\x00'
+
+# Small flash regions that change whenever the firmware image does
+fingerprint_regions = [
+    (0x10400, 0x100),       # Signature table
+    (0x10ff0, 0x10),        # Key
+    (0x1fff00, 0x100),      # Checksum at 0x1ffffe
+]
+
+
+def flash_fingerprint(memory):
+    """Fingerprint the flash contents visible through a SimARMMemory.
+    Reads a few small regions, which stay in the local cache.
+    """
+    h = hashlib.sha1()
+    for address, size in fingerprint_regions:
+        if memory.local_data_available(address, size) < size:
+            memory.fetch_local_data(address, size)
+        h.update(memory.local.read(address, size))
+    return h.digest()
+
+
+def icache_filename(fingerprint, directory = '.'):
+    return os.path.join(directory, 'sim-icache-%s.bin' % fingerprint.hex()[:16])
+
+
+def write_icache(filename, fingerprint, blocks, instructions):
+    """Write a cache file.
+
+    'blocks' is a list of (address, data) flash runs.
+    'instructions' is a list of (key, size, text) where text is None for
+    anything sim_arm_decode can decode again.
+    """
+    strings = []
+    records = []
+    for key, size, text in instructions:
+        if text is None:
+            records.append(struct.pack('<IHH', key, size, 0))
+        else:
+            strings.append(text.encode('utf8'))
+            records.append(struct.pack('<IHH', key, size, len(strings)))
+
+    parts = [icache_magic, fingerprint, struct.pack('<I', len(blocks))]
+    for address, data in blocks:
+        parts.append(struct.pack('<II', address, len(data)))
+        parts.append(bytes(data))
+    parts.append(struct.pack('<I', len(strings)))
+    for s in strings:
+        parts.append(struct.pack('<H', len(s)))
+        parts.append(s)
+    parts.append(struct.pack('<I', len(records)))
+    parts.extend(records)
+
+    # Write atomically, another session may be reading this file
+    tempname = filename + '.tmp'
+    with open(tempname, 'wb') as f:
+        f.write(b''.join(parts))
+    os.replace(tempname, filename)
+
+
+def read_icache(filename, fingerprint):
+    """Read a cache file, returning (blocks, instructions) as accepted by
+    write_icache(). Returns None if the file is missing or for other flash.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+
+    if data[:8] != icache_magic or data[8:28] != fingerprint:
+        return None
+    offset = 28
+
+    def take(fmt):
+        nonlocal offset
+        r = struct.unpack_from(fmt, data, offset)
+        offset += struct.calcsize(fmt)
+        return r
+
+    blocks = []
+    for i in range(take('<I')[0]):
+        address, length = take('<II')
+        blocks.append((address, data[offset:offset + length]))
+        offset += length
+
+    strings = []
+    for i in range(take('<I')[0]):
+        length, = take('<H')
+        strings.append(data[offset:offset + length].decode('utf8'))
+        offset += length
+
+    instructions = []
+    for i in range(take('<I')[0]):
+        key, size, index = take('<IHH')
+        instructions.append((key, size, strings[index - 1] if index else None))
+
+    return blocks, instructions
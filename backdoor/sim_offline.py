@@ -0,0 +1,186 @@
+# Offline device backend for the ARM simulator.
+#
+# SimARMMemory normally proxies flash prefetch, I/O, and HLE calls to a real
+# drive. OfflineDevice implements the same interface as remote.Device and
+# BitbangDevice (peek, poke, read_block, write_block, fill_words, blx, ...) without any
+# hardware: flash comes from a 2 MB firmware image, memory-mapped I/O from a
+# pluggable MMIOModel, and everything else is RAM that reads as zero until
+# written. HLE handlers are Python callables instead of compiled C++.
+#
+# This runs at host speed, so it's also the way to benchmark the simulator.
+
+__all__ = [ 'OfflineDevice', 'MMIOModel' ]
+
+import struct, re
+from sim_pages import PageTable
+from console import console_address
+from memory_map import flash_size, default_memory_map
+
+# Same I/O region as the rest of the tools, end exclusive
+mmio_begin = default_memory_map.find('mmio').begin
+mmio_end = default_memory_map.find('mmio').end + 1
+
+# Fake addresses we hand out for offline HLE handlers
+hle_base = 0xfff00000
+
+
+class MMIOModel(object):
+    """Pluggable model for memory-mapped I/O registers.
+
+    Reads come from the first of these that applies:
+      - A handler function registered with handler()
+      - The next value recorded with record(), in order
+      - The last value written to the register
+      - The register's default from 'registers', or else 'default'
+    """
+    def __init__(self, default = 0, registers = None):
+        self.default = default
+        self.values = dict(registers or {})     # Word address -> value
+        self.recorded = {}                      # Word address -> list of values
+        self.read_handlers = {}
+        self.write_handlers = {}
+
+    def handler(self, address, read = None, write = None):
+        """Register functions for one word-aligned register.
+        read(address, size) returns a value; write(address, value, size).
+        """
+        if read:
+            self.read_handlers[address & ~3] = read
+        if write:
+            self.write_handlers[address & ~3] = write
+
+    def record(self, address, values):
+        """Queue up values for successive word reads from a register"""
+        self.recorded.setdefault(address & ~3, []).extend(values)
+
+    def record_log(self, f):
+        """Queue up every device load from a %sim text log, such as trace.log"""
+        for line in f:
+            m = re.match(r'arm-mem-LOAD\s+(\w+)\[([0-9a-f]+)\] -> ([0-9a-f]+)', line)
+            if m and mmio_begin <= int(m.group(2), 16) < mmio_end:
+                size, address, data = m.group(1), int(m.group(2), 16), int(m.group(3), 16)
+                if size == 'word':
+                    self.record(address, [data])
+
+    def read(self, address, size = 4):
+        word = address & ~3
+        fn = self.read_handlers.get(word)
+        if fn:
+            return fn(address, size)
+        queue = self.recorded.get(word)
+        if queue:
+            value = queue.pop(0)
+        else:
+            value = self.values.get(word, self.default)
+        shift = 8 * (address & 3)
+        return (value >> shift) & ((1 << (8 * size)) - 1)
+
+    def write(self, address, value, size = 4):
+        word = address & ~3
+        fn = self.write_handlers.get(word)
+        if fn:
+            fn(address, value, size)
+        shift = 8 * (address & 3)
+        mask = ((1 << (8 * size)) - 1) << shift
+        old = self.values.get(word, self.default)
+        self.values[word] = (old & ~mask) | ((value << shift) & mask)
+
+
+class OfflineDevice(object):
+    """Device stand-in backed by a firmware image and an MMIO model.
+
+    'firmware' is a filename or the image itself. 'hle' maps HLE handler
+    names (as in SimARMMemory.hle_handlers) to functions taking (device, r0)
+    and returning the new r0. Handlers can print with device.console().
+    Functions for blx() can be added to 'functions' by address, taking
+    (device, r0) and returning (r0, r1).
+    """
+    def __init__(self, firmware, mmio = None, hle = None):
+        if not isinstance(firmware, (bytes, bytearray)):
+            with open(firmware, 'rb') as f:
+                firmware = f.read()
+        if len(firmware) > flash_size:
+            raise ValueError("Firmware image is larger than flash (%d bytes)" % len(firmware))
+
+        self.mmio = mmio or MMIOModel()
+        self.hle = dict(hle or {})
+        self.functions = {}
+        self.ram = PageTable()
+        self.ram.write(0, bytes(firmware) + b'\xff' * (flash_size - len(firmware)))
+
+    def __repr__(self):
+        return 'OfflineDevice()'
+
+    def _is_mmio(self, address):
+        return mmio_begin <= address < mmio_end
+
+    def peek(self, address):
+        if self._is_mmio(address):
+            return self.mmio.read(address)
+        return struct.unpack('<I', self.ram.read(address, 4))[0]
+
+    def poke(self, address, data):
+        if self._is_mmio(address):
+            self.mmio.write(address, data)
+        elif address >= flash_size:
+            self.ram.write(address, struct.pack('<I', data))
+
+    def peek_byte(self, address):
+        if self._is_mmio(address):
+            return self.mmio.read(address, 1)
+        return self.ram.read(address, 1)[0]
+
+    def poke_byte(self, address, data):
+        if self._is_mmio(address):
+            self.mmio.write(address, data, 1)
+        elif address >= flash_size:
+            self.ram.write(address, bytes([data & 0xff]))
+
+    def read_block(self, address, wordcount):
+        if self._is_mmio(address) or self._is_mmio(address + 4 * wordcount - 1):
+            return b''.join(struct.pack('<I', self.peek(address + 4*i)) for i in range(wordcount))
+        return self.ram.read(address, 4 * wordcount)
+
+    def write_block(self, address, data):
+        for i in range(0, len(data), 4):
+            self.poke(address + i, struct.unpack_from('<I', data, i)[0])
+
+    def fill_words(self, address, word, wordcount):
+        for i in range(wordcount):
+            self.poke(address + 4*i, word)
+
+    def fill_bytes(self, address, byte, bytecount):
+        for i in range(bytecount):
+            self.poke_byte(address + i, byte)
+
+    def blx(self, address, r0 = 0, timeout = 30):
+        fn = self.functions.get(address)
+        if fn is None:
+            raise IOError("No offline implementation for function at %08x" % address)
+        return fn(self, r0)
+
+    def console(self, text):
+        """Append text to the console ring buffer, for ConsoleBuffer to read"""
+        data = text.encode('utf8')
+        next_write = self.peek(console_address + 0x10000)
+        for i, b in enumerate(data):
+            self.poke_byte(console_address + ((next_write + i) & 0xffff), b)
+        self.poke(console_address + 0x10000, (next_write + len(data)) & 0xffffffff)
+
+    def install_hle(self, handlers):
+        """Stand-in for compiling HLE handlers. Returns a symbol table."""
+        symbols = {}
+        for i, name in enumerate(sorted(handlers)):
+            address = hle_base + 4 * i
+            symbols[name] = address
+            self.functions[address] = self._hle_function(name)
+        return symbols
+
+    def _hle_function(self, name):
+        def fn(device, r0):
+            handler = self.hle.get(name)
+            if handler is None:
+                self.console('(offline, skipped %s)\n' % name)
+                return r0, 0
+            return handler(self, r0), 0
+        return fn
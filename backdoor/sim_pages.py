@@ -0,0 +1,401 @@
+# Sparse local memory for the ARM simulator.
+#
+# SimARMMemory keeps local RAM and cached flash on the host, so reads and
+# writes there never touch hardware. This used to be a pair of flat BytesIO
+# buffers (flags and data) as large as the highest address ever touched. The
+# page table below only allocates the 4 KiB pages we actually use.
+#
+# Pages where every byte is valid live in 'full', so the common case is a
+# single dict probe followed by struct.unpack_from. Other pages live in
+# 'partial' with a validity bitmap, kept as a Python int with one bit per byte.
+#
+# Watched pages (see watch()) always live in 'partial', so the fast paths miss
+# them and only their stores pay for checking watchpoints.
+#
+# Snapshots are copy-on-write. Each PageSnapshot holds only the pages dirtied
+# since its parent, and shares those page buffers with the live table until
+# the next write to them. Taking a snapshot or restoring one costs time in
+# proportion to the pages that changed, not to the size of memory.
+
+__all__ = [ 'PageTable', 'PageSnapshot', 'page_size', 'page_shift' ]
+
+import struct
+
+page_shift = 12
+page_size = 1 << page_shift
+page_mask = page_size - 1
+all_valid = (1 << page_size) - 1
+
+# Snapshot entry for a page that was discarded
+absent = (None, None)
+
+word = struct.Struct('<I')
+half = struct.Struct('<H')
+
+
+class PageSnapshot(object):
+    """Pages as of one PageTable.snapshot(), stored as changes since 'parent'"""
+
+    def __init__(self, parent, pages):
+        self.parent = parent
+        self.pages = pages      # Page number -> (bytearray, bitmap or None if full)
+        self.depth = parent.depth + 1 if parent else 0
+
+    def page(self, number):
+        """The (bytearray, bitmap) for a page, or None if it didn't exist"""
+        snapshot = self
+        while snapshot is not None:
+            value = snapshot.pages.get(number)
+            if value is not None:
+                return value if value is not absent else None
+            snapshot = snapshot.parent
+
+    def changes(self, other):
+        """Set of page numbers that might differ between two snapshots"""
+        numbers = set()
+        a, b = self, other
+        while a is not b:
+            if a is None or (b is not None and b.depth > a.depth):
+                numbers.update(b.pages)
+                b = b.parent
+            else:
+                numbers.update(a.pages)
+                a = a.parent
+        return numbers
+
+
+class PageTable(object):
+    """Sparse byte-addressed memory, tracking which bytes are valid"""
+
+    def __init__(self):
+        self.full = {}          # Page number -> bytearray
+        self.partial = {}       # Page number -> [bytearray, bitmap]
+        self.dirty = set()      # Pages changed since 'base'
+        self.shared = set()     # Pages whose buffer a snapshot also holds
+        self.base = None        # Latest snapshot taken or restored
+        self.watched = {}       # Page number -> fn(address, size) to call before stores
+
+    def _chunks(self, address, size):
+        # Split a range into (page number, offset, length, position in range)
+        pos = 0
+        while pos < size:
+            offset = (address + pos) & page_mask
+            length = min(size - pos, page_size - offset)
+            yield (address + pos) >> page_shift, offset, length, pos
+            pos += length
+
+    def _modify(self, number):
+        # Call before changing a page. Copies it if a snapshot shares it.
+        self.dirty.add(number)
+        if number in self.shared:
+            self.shared.discard(number)
+            page = self.full.get(number)
+            entry = self.partial.get(number)
+            if page is not None:
+                self.full[number] = bytearray(page)
+            elif entry is not None:
+                self.partial[number] = [bytearray(entry[0]), entry[1]]
+
+    def _partial_page(self, number):
+        entry = self.partial.get(number)
+        if entry is None:
+            entry = self.partial[number] = [bytearray(page_size), 0]
+        return entry
+
+    def mark(self, begin, end):
+        """Mark the inclusive range [begin, end] as valid"""
+        for number, offset, length, pos in self._chunks(begin, end - begin + 1):
+            if number in self.full:
+                continue
+            self._modify(number)
+            entry = self._partial_page(number)
+            entry[1] |= ((1 << length) - 1) << offset
+            if entry[1] == all_valid and number not in self.watched:
+                self.full[number] = entry[0]
+                del self.partial[number]
+
+    def write(self, address, data):
+        """Store bytes and mark them valid"""
+        for number, offset, length, pos in self._chunks(address, len(data)):
+            self._modify(number)
+            page = self.full.get(number)
+            if page is None:
+                page = self._partial_page(number)[0]
+            page[offset:offset + length] = data[pos:pos + length]
+        if data:
+            self.mark(address, address + len(data) - 1)
+
+    def read(self, address, size):
+        """Read bytes, whether or not they're valid. Missing pages read as zero."""
+        parts = []
+        for number, offset, length, pos in self._chunks(address, size):
+            page = self.full.get(number)
+            if page is None:
+                entry = self.partial.get(number)
+                if entry is None:
+                    parts.append(bytes(length))
+                    continue
+                page = entry[0]
+            parts.append(bytes(page[offset:offset + length]))
+        return b''.join(parts)
+
+    def available(self, address, limit):
+        """Count the valid bytes starting at address, up to limit"""
+        count = 0
+        for number, offset, length, pos in self._chunks(address, limit):
+            if number in self.full:
+                count += length
+                continue
+            entry = self.partial.get(number)
+            if entry is None:
+                break
+            invalid = ~(entry[1] >> offset)
+            run = (invalid & -invalid).bit_length() - 1
+            if run < length:
+                return count + run
+            count += length
+        return count
+
+    def valid(self, address, size):
+        return self.available(address, size) == size
+
+    def any_valid(self, address, size):
+        """Is any byte in the range valid?"""
+        for number, offset, length, pos in self._chunks(address, size):
+            if number in self.full:
+                return True
+            entry = self.partial.get(number)
+            if entry and (entry[1] >> offset) & ((1 << length) - 1):
+                return True
+        return False
+
+    def runs(self, begin = 0, end = 1 << 32):
+        """List (address, data) for every run of valid bytes in [begin, end)"""
+        runs = []
+        first = begin >> page_shift
+        last = (end - 1) >> page_shift
+        numbers = sorted(n for n in list(self.full) + list(self.partial) if first <= n <= last)
+        run_start = run_end = None
+
+        for number in numbers:
+            base = number << page_shift
+            page = self.full.get(number)
+            if page is not None:
+                spans = [(0, page_size)]
+            else:
+                page, bits = self.partial[number]
+                spans = []
+                offset = 0
+                while bits >> offset:
+                    bits_here = bits >> offset
+                    start = offset + (bits_here & -bits_here).bit_length() - 1
+                    invalid = ~(bits >> start)
+                    offset = start + (invalid & -invalid).bit_length() - 1
+                    spans.append((start, offset))
+
+            for start, stop in spans:
+                start = max(base + start, begin)
+                stop = min(base + stop, end)
+                if start >= stop:
+                    continue
+                if run_end == start:
+                    run_end = stop
+                else:
+                    if run_start is not None:
+                        runs.append((run_start, run_end))
+                    run_start, run_end = start, stop
+
+        if run_start is not None:
+            runs.append((run_start, run_end))
+        return [(a, self.read(a, b - a)) for a, b in runs]
+
+    def load32(self, address):
+        """Read a local word, or None if any of it isn't valid"""
+        page = self.full.get(address >> page_shift)
+        offset = address & page_mask
+        if page is not None and offset <= page_size - 4:
+            return word.unpack_from(page, offset)[0]
+        if self.valid(address, 4):
+            return word.unpack(self.read(address, 4))[0]
+
+    def load16(self, address):
+        page = self.full.get(address >> page_shift)
+        offset = address & page_mask
+        if page is not None and offset <= page_size - 2:
+            return half.unpack_from(page, offset)[0]
+        if self.valid(address, 2):
+            return half.unpack(self.read(address, 2))[0]
+
+    def load8(self, address):
+        page = self.full.get(address >> page_shift)
+        if page is not None:
+            return page[address & page_mask]
+        if self.valid(address, 1):
+            return self.read(address, 1)[0]
+
+    def store32(self, address, data):
+        """Write a local word. Returns False, storing nothing, if any of it isn't valid."""
+        number = address >> page_shift
+        page = self.full.get(number)
+        offset = address & page_mask
+        if page is not None and offset <= page_size - 4:
+            if number not in self.dirty:
+                self._modify(number)
+                page = self.full[number]
+            word.pack_into(page, offset, data)
+            return True
+        if self.watched:
+            self.check_watch(address, 4)
+        if self.valid(address, 4):
+            self.write(address, word.pack(data))
+            return True
+        return False
+
+    def store16(self, address, data):
+        number = address >> page_shift
+        page = self.full.get(number)
+        offset = address & page_mask
+        if page is not None and offset <= page_size - 2:
+            if number not in self.dirty:
+                self._modify(number)
+                page = self.full[number]
+            half.pack_into(page, offset, data)
+            return True
+        if self.watched:
+            self.check_watch(address, 2)
+        if self.valid(address, 2):
+            self.write(address, half.pack(data))
+            return True
+        return False
+
+    def store8(self, address, data):
+        number = address >> page_shift
+        page = self.full.get(number)
+        if page is not None:
+            if number not in self.dirty:
+                self._modify(number)
+                page = self.full[number]
+            page[address & page_mask] = data
+            return True
+        if self.watched:
+            self.check_watch(address, 1)
+        if self.valid(address, 1):
+            self.write(address, bytes([data]))
+            return True
+        return False
+
+    def watch(self, number, fn):
+        """Call fn(address, size) before each store32/16/8 to a page, local
+        or not. It can raise an exception to stop the store.
+        """
+        self.watched[number] = fn
+        page = self.full.pop(number, None)
+        if page is not None:
+            self.partial[number] = [page, all_valid]
+
+    def unwatch(self, number):
+        if self.watched.pop(number, None):
+            entry = self.partial.get(number)
+            if entry and entry[1] == all_valid:
+                self.full[number] = entry[0]
+                del self.partial[number]
+
+    def check_watch(self, address, size):
+        """Call the watch functions for a store that isn't going through store32/16/8"""
+        for number in set([address >> page_shift, (address + size - 1) >> page_shift]):
+            fn = self.watched.get(number)
+            if fn:
+                fn(address, size)
+
+    def _insert(self, number, page, bits):
+        # Add a page that isn't in the table, keeping watched pages partial
+        if number in self.watched:
+            self.partial[number] = [page, all_valid if bits is None else bits]
+        elif bits is None or bits == all_valid:
+            self.full[number] = page
+        else:
+            self.partial[number] = [page, bits]
+
+    def has_page(self, number):
+        return number in self.full or number in self.partial
+
+    def discard(self, number):
+        """Forget a page entirely, as if nothing in it had been written"""
+        if self.has_page(number):
+            self.dirty.add(number)
+            self.shared.discard(number)
+            self.full.pop(number, None)
+            self.partial.pop(number, None)
+
+    def save(self, f):
+        """Write every page to a binary file"""
+        for number in sorted(self.full):
+            _save_page(f, number, self.full[number], None)
+        for number in sorted(self.partial):
+            _save_page(f, number, *self.partial[number])
+
+    def snapshot(self):
+        """Capture the current contents as a PageSnapshot"""
+        pages = {}
+        for number in self.dirty:
+            page = self.full.get(number)
+            if page is not None:
+                pages[number] = (page, None)
+            elif number in self.partial:
+                pages[number] = tuple(self.partial[number])
+            else:
+                pages[number] = absent
+        self.base = PageSnapshot(self.base, pages)
+        self.shared.update(self.dirty)
+        self.dirty = set()
+        return self.base
+
+    def restore(self, snapshot):
+        """Return to the contents from a PageSnapshot"""
+        for number in self.dirty | snapshot.changes(self.base):
+            self.full.pop(number, None)
+            self.partial.pop(number, None)
+            value = snapshot.page(number)
+            if value is not None:
+                self._insert(number, *value)
+                self.shared.add(number)
+        self.base = snapshot
+        self.dirty = set()
+
+    def save_delta(self, f, snapshot, base = None):
+        """Write the pages of a snapshot that differ from an earlier 'base'
+        snapshot, in the same format as save(). Without a base, writes them all.
+        """
+        for number in sorted(snapshot.changes(base)):
+            value = snapshot.page(number)
+            if value is None:
+                continue
+            old = base and base.page(number)
+            if old is None or old[0] is not value[0] or old[1] != value[1]:
+                _save_page(f, number, *value)
+
+    def load(self, f):
+        """Read pages from save() into this table"""
+        while True:
+            header = f.read(8)
+            if not header:
+                break
+            number, full = struct.unpack('<II', header)
+            self.dirty.add(number)
+            self.shared.discard(number)
+            self.full.pop(number, None)
+            self.partial.pop(number, None)
+            if full:
+                self._insert(number, bytearray(f.read(page_size)), None)
+            else:
+                bits = int.from_bytes(f.read(page_size // 8), 'little')
+                self._insert(number, bytearray(f.read(page_size)), bits)
+
+
+def _save_page(f, number, page, bits):
+    if bits is None:
+        f.write(struct.pack('<II', number, 1))
+    else:
+        f.write(struct.pack('<II', number, 0))
+        f.write(bits.to_bytes(page_size // 8, 'little'))
+    f.write(page)
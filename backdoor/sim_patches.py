@@ -0,0 +1,214 @@
+# Declarative patch sets for the ARM simulator, and a cache for building them.
+#
+# simulate_arm() gets its skips, patches, hooks, and fake clock from a JSON
+# file (sim_patches.json) instead of hand-written Python. The file is a list
+# of entries, each with an "op" naming what to do:
+#
+#   skip                address, reason
+#   local_ram           begin, end
+#   demand_paging       region
+#   patch               address, code, thumb, and an HLE handler as either
+#                       "hle" (C++, run on the device) or "print" (an
+#                       HLEPrint template, run locally)
+#   hook                address, message, and any of clear_skips, save_state,
+#                       restore_state, regs (by name), thumb
+#   autostep            address, until, message
+#   fake_clock          address
+#   cache_decompressor  address, check
+#
+# Addresses are numbers or strings like "0x168530". "code" and "hle" may be
+# a list of lines. Any entry can have a "note", which is only documentation.
+#
+# Building a patch set normally runs the assembler and objdump once per patch
+# and the compiler once for the HLE library. PatchCache keeps those results in
+# one file, keyed by a hash of everything that goes into them: the source
+# text, the address, the defines, and for the library, the C++ headers in
+# backdoor/ and lib/ and the compiler and its flags. A
+# session with an unchanged patch set doesn't run the toolchain at all.
+
+__all__ = [
+    'PatchCache', 'patch_cache_filename', 'read_patch_file', 'apply_patches',
+    'autostep_until', 'fake_clock',
+    'default_patch_file',
+]
+
+import hashlib, json, os, glob
+from code import *
+from code import CC, cc_flags
+from dump import poke_words_from_string
+from sim_arm_core import HLEPrint
+from sim_ts01 import cache_decompressor
+
+default_patch_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim_patches.json')
+
+cache_version = 1
+
+
+def _content_hash(*parts):
+    text = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def _header_text():
+    # Everything the HLE library could #include: our headers, and the
+    # project-wide ones in lib/ that compile_objfile() adds with -I
+    directory = os.path.dirname(os.path.abspath(__file__))
+    names = (glob.glob(os.path.join(directory, '*.h')) +
+             glob.glob(os.path.join(directory, '..', 'lib', '*.h')))
+    headers = []
+    for name in sorted(names):
+        with open(name, 'rb') as f:
+            headers.append((os.path.relpath(name, directory), hashlib.sha1(f.read()).hexdigest()))
+    return headers
+
+
+def patch_cache_filename(directory = '.'):
+    return os.path.join(directory, 'sim-patch-cache.json')
+
+
+class PatchCache(object):
+    """Assembled patches and compiled HLE libraries, by content hash.
+    New results are written to the file as soon as we have them.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+            if data.get('version') == cache_version:
+                self.entries = data['entries']
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+
+    def __repr__(self):
+        return 'PatchCache(%r, %d entries)' % (self.filename, len(self.entries))
+
+    def save(self):
+        # Write atomically, another session may be reading this file
+        tempname = self.filename + '.tmp'
+        with open(tempname, 'w') as f:
+            json.dump(dict(version=cache_version, entries=self.entries), f, sort_keys=True)
+        os.replace(tempname, self.filename)
+
+    def assemble(self, address, code, thumb = True):
+        """Assemble and disassemble some code, as SimARMMemory.patch() does.
+        Returns (disassembly text, size in bytes).
+        """
+        key = _content_hash('asm', address, code, bool(thumb), list(defines.items()))
+        entry = self.entries.get(key)
+        if entry is None:
+            data = assemble_string(address, code, thumb=thumb)
+            entry = dict(text=disassemble_string(data, address=address, thumb=thumb), size=len(data))
+            self.entries[key] = entry
+            self.save()
+        return entry['text'], entry['size']
+
+    def compile_library(self, d, base_address, code_dict, thumb = True):
+        """Like code.compile_library(), but only compiles if we haven't before"""
+        key = _content_hash('library', base_address, sorted(code_dict.items()), bool(thumb),
+            list(includes.items()), list(defines.items()), _header_text(), CC, cc_flags)
+        entry = self.entries.get(key)
+        if entry is None:
+            data, symbols = compile_library_string(base_address, code_dict, thumb=thumb)
+            entry = dict(data=data.hex(), symbols=symbols)
+            self.entries[key] = entry
+            self.save()
+        else:
+            print("* Loaded compiled High Level Emulation handlers from %s" % self.filename)
+        poke_words_from_string(d, base_address, bytes.fromhex(entry['data']))
+        return dict(entry['symbols'])
+
+
+def _number(value):
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+def _text(value):
+    return '\n'.join(value) if isinstance(value, list) else value
+
+
+def read_patch_file(filename = default_patch_file):
+    """List of patch set entries, checked for an op we know about"""
+    with open(filename) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("%s should contain a list of entries" % filename)
+    for entry in entries:
+        if entry.get('op') not in _ops:
+            raise ValueError("Unknown patch op in %s: %r" % (filename, entry))
+    return entries
+
+
+def apply_patches(memory, entries):
+    """Install a list of entries from read_patch_file() into a SimARMMemory"""
+    for entry in entries:
+        _ops[entry['op']](memory, entry)
+
+
+def autostep_until(breakpoint, message):
+    """Return a hook function that continuously steps until the breakpoint"""
+    def fn(arm):
+        print("SIM: autostep until %08x, %s" % (breakpoint, message))
+        while arm.run(until_pcs=[breakpoint], max_steps=1000000).reason != 'breakpoint':
+            print("SIM: still autostepping...")
+        print("SIM: autostep breakpoint reached")
+    return fn
+
+
+def fake_clock():
+    """Return a hook function for a 16-bit timer read that advances by 1 every time"""
+    sim_clock = [0]
+    rates = ('512*1024 Hz', '16*1024 Hz', '1024 Hz')
+    def fn(arm):
+        sim_clock[0] = (sim_clock[0] + 1) & 0xffff
+        print("SIM: Fake clock %04x (requested rate %s)" % (sim_clock[0], rates[arm.regs[0]]))
+        arm.regs[0] = sim_clock[0]
+    return fn
+
+
+def _hook_fn(entry):
+    message = entry.get('message')
+    clear_skips = entry.get('clear_skips')
+    save_state = entry.get('save_state')
+    restore_state = entry.get('restore_state')
+    regs = [(name, _number(value)) for name, value in entry.get('regs', {}).items()]
+    thumb = entry.get('thumb')
+
+    def fn(arm):
+        if clear_skips:
+            arm.memory.skip_stores.clear()
+        if message:
+            print("SIM: %s" % message)
+        if save_state:
+            arm.irq_saved = arm.state
+        if restore_state:
+            arm.state = arm.irq_saved
+        for name, value in regs:
+            arm.regs[arm.reg_numbers[name]] = value
+        if thumb is not None:
+            arm.thumb = thumb
+    return fn
+
+
+def _patch(memory, entry):
+    hle = _text(entry.get('hle'))
+    if 'print' in entry:
+        hle = HLEPrint(entry['print'])
+    memory.patch(_number(entry['address']), _text(entry.get('code')), hle=hle,
+        thumb=entry.get('thumb', True))
+
+
+_ops = {
+    'skip': lambda m, e: m.skip(_number(e['address']), e['reason']),
+    'local_ram': lambda m, e: m.local_ram(_number(e['begin']), _number(e['end'])),
+    'demand_paging': lambda m, e: m.demand_paging(e['region'], e.get('enabled', True)),
+    'patch': _patch,
+    'hook': lambda m, e: m.hook(_number(e['address']), _hook_fn(e)),
+    'autostep': lambda m, e: m.hook(_number(e['address']),
+        autostep_until(_number(e['until']), e.get('message', ''))),
+    'fake_clock': lambda m, e: (m.patch(_number(e['address']), 'bx lr'),
+        m.hook(_number(e['address']), fake_clock())),
+    'cache_decompressor': lambda m, e: cache_decompressor(m, _number(e['address']), e.get('thumb', True),
+        check=e.get('check', False)),
+}
@@ -0,0 +1,295 @@
+# Execution profiler for the ARM simulator.
+#
+# Once attached, SimARM.step() reports each block or single instruction it
+# runs, along with wall-clock time and the number of round trips made to the
+# device (including HLE calls). That's one timer read and a few dict updates
+# per block, cheap enough to leave on for a whole session.
+#
+# The report groups code into functions, using every bl/blx destination we've
+# seen as a function entry point, and points out stub candidates: loops that
+# poll hardware, and functions that cost many round trips per call. These are
+# the kind of thing sim_patches.json already stubs out at 0x7bc3c and
+# 0xc0460.
+#
+# The profiler also keeps a shadow call stack. A bl/blx pushes a frame with
+# the return address it left in lr, and arriving back at that address (by bx
+# lr, pop {pc}, or anything else) pops it. Costs go to the whole stack at the
+# time, so we get inclusive and exclusive totals per function, and a
+# collapsed stack file that flame graph tools read directly.
+
+__all__ = [ 'SimProfiler' ]
+
+import bisect, time
+from sim_blocks import writes_pc
+
+# Stub suggestion thresholds
+loop_min_executions = 100
+function_min_calls = 10
+function_min_ops_per_call = 4
+
+# How many frames to look through for a return, in case some were skipped
+return_search_depth = 8
+
+# Costs per call stack: steps, device round trips, seconds
+metrics = ('steps', 'device_ops', 'seconds')
+
+
+class CountingDevice(object):
+    """Device wrapper that counts round trips for a SimProfiler"""
+    def __init__(self, device, profiler):
+        self.device = device
+        self.profiler = profiler
+
+    def __repr__(self):
+        return 'CountingDevice(%r)' % self.device
+
+    def __getattr__(self, name):
+        attr = getattr(self.device, name)
+        if not callable(attr):
+            return attr
+        def fn(*args, **kw):
+            self.profiler.device_ops += 1
+            return attr(*args, **kw)
+        return fn
+
+
+def _control_flow(instr):
+    if instr.op.split('.', 1)[0] in ('bl', 'blx'):
+        return 'call'
+    if writes_pc(instr):
+        return 'branch'
+
+
+class BlockStats(object):
+    """Totals for one block of code, keyed by (address | thumb, instruction count).
+    The count keeps single steps apart from blocks starting at the same address.
+    """
+    def __init__(self, instructions):
+        self.instructions = instructions
+        self.executions = 0
+        self.device_ops = 0
+        self.seconds = 0.0
+
+
+class SimProfiler(object):
+    """Per-PC and per-block execution profile for a SimARM"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.blocks = {}
+        self.calls = {}
+        self.device_ops = 0
+        self._ops = 0
+        self._time = 0.0
+
+        # Shadow call stack of (entry, return address), and the entry
+        # addresses along it. Costs per path are [steps, device_ops, seconds].
+        self.stack = []
+        self.path = ()
+        self.stacks = {}
+
+        # Last instruction of a block -> 'call', 'branch', or None
+        self.flow = {}
+
+    def attach(self, arm):
+        """Start profiling a simulator. Stays attached until detach()."""
+        if arm.profiler is not self:
+            arm.profiler = self
+            arm.memory.device = CountingDevice(arm.memory.device, self)
+
+    def detach(self, arm):
+        if arm.profiler is self:
+            arm.profiler = None
+            if isinstance(arm.memory.device, CountingDevice):
+                arm.memory.device = arm.memory.device.device
+
+    def begin(self):
+        self._ops = self.device_ops
+        self._time = time.perf_counter()
+
+    def end(self, arm, key, instructions):
+        """Record the block or instruction that ran since begin()"""
+        seconds = time.perf_counter() - self._time
+        key = (key, len(instructions))
+        stats = self.blocks.get(key)
+        if stats is None:
+            stats = self.blocks[key] = BlockStats(instructions)
+        ops = self.device_ops - self._ops
+        stats.executions += 1
+        stats.device_ops += ops
+        stats.seconds += seconds
+
+        cost = self.stacks.get(self.path)
+        if cost is None:
+            cost = self.stacks[self.path] = [0, 0, 0.0]
+        cost[0] += len(instructions)
+        cost[1] += ops
+        cost[2] += seconds
+
+        # From what actually ran; a block and a single step can share a start address
+        last = instructions[-1]
+        flow = self.flow.get(last, False)
+        if flow is False:
+            flow = self.flow[last] = _control_flow(last)
+        if flow == 'call':
+            target = arm.thumb | arm.regs[15]
+            self.calls[target] = self.calls.get(target, 0) + 1
+            self.stack.append((target, arm.regs[14]))
+            self.path += (target,)
+        elif flow == 'branch' and self.stack:
+            self._return(arm.thumb | arm.regs[15])
+
+    def _return(self, pc):
+        # Pop frames if we just arrived at one of their return addresses
+        stack = self.stack
+        for depth in range(1, min(len(stack), return_search_depth) + 1):
+            if stack[-depth][1] == pc:
+                del stack[-depth:]
+                self.path = self.path[:-depth]
+                return
+
+    def pc_counts(self):
+        """Dictionary of executions per instruction address"""
+        counts = {}
+        for stats in self.blocks.values():
+            for instr in stats.instructions:
+                counts[instr.address] = counts.get(instr.address, 0) + stats.executions
+        return counts
+
+    def functions(self):
+        """Totals per function, as a list of dicts sorted by time, highest first.
+        Code before the first known entry point is grouped at address zero.
+        """
+        entries = sorted(set(key & ~1 for key in self.calls) | set([0]))
+        totals = {}
+        for (key, length), stats in self.blocks.items():
+            entry = entries[bisect.bisect_right(entries, key & ~1) - 1]
+            t = totals.get(entry)
+            if t is None:
+                t = totals[entry] = dict(address=entry, thumb=None, calls=0, steps=0, device_ops=0, seconds=0.0)
+            t['steps'] += stats.executions * len(stats.instructions)
+            t['device_ops'] += stats.device_ops
+            t['seconds'] += stats.seconds
+        for key, count in self.calls.items():
+            t = totals.get(key & ~1)
+            if t:
+                t['calls'] += count
+                t['thumb'] = key & 1
+        return sorted(totals.values(), key=lambda t: -t['seconds'])
+
+    def function_costs(self):
+        """Costs per function from the shadow call stack, as a dict mapping
+        entry address (with thumb bit) to {'self': [...], 'total': [...]},
+        each a list of [steps, device_ops, seconds]. 'self' only counts code
+        in the function itself, 'total' includes everything it called.
+        Code outside any call we saw is under entry None.
+        """
+        costs = {}
+        for path, cost in self.stacks.items():
+            leaf = path[-1] if path else None
+            for entry in set(path or (None,)):
+                c = costs.get(entry)
+                if c is None:
+                    c = costs[entry] = {'self': [0, 0, 0.0], 'total': [0, 0, 0.0]}
+                for i in range(3):
+                    c['total'][i] += cost[i]
+                    if entry == leaf:
+                        c['self'][i] += cost[i]
+        return costs
+
+    def write_collapsed(self, f, metric = 'steps', names = None):
+        """Write the call stacks as 'root;caller;callee count' lines, the
+        collapsed format flame graph tools take. 'metric' is 'steps',
+        'device_ops', or 'seconds' (written as microseconds). 'names' can
+        map entry addresses to function names.
+        """
+        index = metrics.index(metric)
+        names = names or {}
+        for path, cost in sorted(self.stacks.items()):
+            value = cost[index]
+            if metric == 'seconds':
+                value = int(value * 1e6)
+            if value:
+                frames = ['root'] + [names.get(entry, '%08x' % entry) for entry in path]
+                f.write('%s %d\n' % (';'.join(frames), value))
+
+    def stub_candidates(self):
+        """List of (address, code, thumb, reason) suggestions for patch()"""
+        suggestions = []
+
+        # Loops that spin on hardware: a backward branch, and everything between
+        # its destination and the branch itself.
+        for (key, length), stats in self.blocks.items():
+            last = stats.instructions[-1]
+            if stats.executions < loop_min_executions or not last.op.startswith('b'):
+                continue
+            try:
+                dest = int(last.args, 0)
+            except ValueError:
+                continue
+            if not dest or dest > last.address:
+                continue
+            ops = sum(s.device_ops for (k, n), s in self.blocks.items()
+                      if (k & 1) == (key & 1) and dest <= (k & ~1) <= last.address)
+            if ops >= stats.executions:
+                suggestions.append((ops, last.address, 'nop', key & 1,
+                    'loop at %08x-%08x polls hardware, %d times, %d round trips' % (
+                    dest, last.address, stats.executions, ops)))
+
+        # Functions with lots of round trips on every call
+        for t in self.functions():
+            calls = t['calls']
+            if calls >= function_min_calls and t['device_ops'] >= function_min_ops_per_call * calls:
+                suggestions.append((t['device_ops'], t['address'], 'bx lr', t['thumb'],
+                    'function called %d times, %d round trips, %.2f s' % (
+                    calls, t['device_ops'], t['seconds'])))
+
+        suggestions.sort(key=lambda s: -s[0])
+        return [s[1:] for s in suggestions]
+
+    def report(self, count = 15):
+        """Text report of the hottest code"""
+        lines = []
+        total_steps = sum(s.executions * len(s.instructions) for s in self.blocks.values())
+        total_seconds = sum(s.seconds for s in self.blocks.values())
+        lines.append('Profile: %d steps, %d device round trips, %.2f s' % (
+            total_steps, self.device_ops, total_seconds))
+
+        lines.append('\nHottest functions:')
+        lines.append('  %-10s %8s %10s %10s %9s' % ('address', 'calls', 'steps', 'round trips', 'seconds'))
+        for t in self.functions()[:count]:
+            lines.append('  %08x   %8d %10d %10d %9.3f' % (
+                t['address'], t['calls'], t['steps'], t['device_ops'], t['seconds']))
+
+        lines.append('\nMost device round trips:')
+        lines.append('  %-19s %10s %10s %9s' % ('block', 'executions', 'round trips', 'seconds'))
+        by_ops = sorted(self.blocks.items(), key=lambda item: -item[1].device_ops)
+        for key, stats in by_ops[:count]:
+            if not stats.device_ops:
+                break
+            lines.append('  %08x-%08x  %10d %10d %9.3f' % (
+                stats.instructions[0].address, stats.instructions[-1].address,
+                stats.executions, stats.device_ops, stats.seconds))
+
+        costs = sorted(((entry, c) for entry, c in self.function_costs().items() if entry is not None),
+                       key=lambda item: -item[1]['total'][2])
+        if costs:
+            lines.append('\nCall stack totals (self / including callees):')
+            lines.append('  %-10s %21s %23s %19s' % ('function', 'steps', 'round trips', 'seconds'))
+            for entry, c in costs[:count]:
+                lines.append('  %08x   %10d %10d %11d %11d %9.3f %9.3f' % (
+                    entry, c['self'][0], c['total'][0], c['self'][1], c['total'][1],
+                    c['self'][2], c['total'][2]))
+
+        candidates = self.stub_candidates()
+        if candidates:
+            lines.append('\nStub candidates:')
+            for address, code, thumb, reason in candidates[:count]:
+                args = '0x%08x, %r' % (address, code)
+                if thumb == 0:
+                    args += ', thumb=False'
+                lines.append('  m.patch(%s)  # %s' % (args, reason))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,253 @@
+# Record and replay of device traffic for the ARM simulator.
+#
+# RecordingDevice wraps a real device and writes every operation the
+# simulator sends it (loads, stores, fills, block reads and writes, blx calls for HLE,
+# and scsi_in for fast reads) along with the response, tagged with the simulator's step count. Later on,
+# ReplayDevice reads that file and answers the same sequence of operations
+# without any hardware. It checks each operation against the recording, so a
+# replay also compares two simulator builds bit-for-bit: the first access
+# that differs raises ReplayMismatch.
+#
+# File layout, all little-endian:
+#
+#   header      magic
+#   records     step, op, address, a, b, payload length, payload
+#
+# A scsi_in record has the size in 'a', the CDB length in 'b', and the CDB
+# followed by the data as its payload. The device only has scsi_in on replay
+# if the recording used it, since that changes how read_block(fast=True) works.
+#   index       (step, file offset) for every index_interval'th record
+#   footer      index entry count, end magic
+#
+# The index and footer are written by close(). A file without them, from a
+# session that didn't finish, is still readable; it just has no index.
+
+__all__ = [ 'RecordingDevice', 'ReplayDevice', 'ReplayMismatch' ]
+
+import struct
+from dump import write_block
+
+replay_magic = b'SIMRR\x00\x01\x00'
+index_magic = b'SIMRRIDX'
+index_interval = 4096
+
+record_header = struct.Struct('<QBIIII')
+index_entry = struct.Struct('<QQ')
+index_footer = struct.Struct('<Q8s')
+
+# Operation codes, and names for messages
+op_peek, op_poke, op_peek_byte, op_poke_byte, op_read_block, op_fill_words, op_fill_bytes, op_blx, op_write_block, op_scsi_in = range(1, 11)
+op_names = {
+    op_peek: 'peek', op_poke: 'poke', op_peek_byte: 'peek_byte', op_poke_byte: 'poke_byte',
+    op_read_block: 'read_block', op_fill_words: 'fill_words', op_fill_bytes: 'fill_bytes',
+    op_blx: 'blx', op_write_block: 'write_block', op_scsi_in: 'scsi_in',
+}
+
+
+class ReplayMismatch(Exception):
+    """The simulator asked for something other than what was recorded"""
+    def __init__(self, step, expected, actual):
+        self.step = step
+        self.expected = expected
+        self.actual = actual
+        Exception.__init__(self, "Replay diverged from recording at step %d: expected %s, got %s" % (
+            step, expected, actual))
+
+
+def _describe(op, address, a = None, b = None):
+    args = [ '%08x' % n for n in (address, a, b) if n is not None ]
+    return '%s(%s)' % (op_names.get(op, op), ', '.join(args))
+
+
+class RecordingDevice(object):
+    """Device wrapper that records all traffic to a file.
+
+    'clock' returns the step count to tag each record with, normally
+    lambda: arm.step_count. It can be set after construction.
+    """
+    def __init__(self, device, filename, clock = None):
+        self.device = device
+        self.clock = clock
+        self.file = open(filename, 'wb')
+        self.file.write(replay_magic)
+        self.offset = len(replay_magic)
+        self.count = 0
+        self.index = []
+
+    def __repr__(self):
+        return 'RecordingDevice(%r)' % self.device
+
+    def _record(self, op, address, a = 0, b = 0, payload = b''):
+        step = self.clock() if self.clock else 0
+        if self.count % index_interval == 0:
+            self.index.append((step, self.offset))
+        data = record_header.pack(step, op, address, a & 0xffffffff, b & 0xffffffff, len(payload)) + payload
+        self.file.write(data)
+        self.offset += len(data)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        for entry in self.index:
+            self.file.write(index_entry.pack(*entry))
+        self.file.write(index_footer.pack(len(self.index), index_magic))
+        self.file.close()
+
+    def peek(self, address):
+        data = self.device.peek(address)
+        self._record(op_peek, address, data)
+        return data
+
+    def poke(self, address, data):
+        self.device.poke(address, data)
+        self._record(op_poke, address, data)
+
+    def peek_byte(self, address):
+        data = self.device.peek_byte(address)
+        self._record(op_peek_byte, address, data)
+        return data
+
+    def poke_byte(self, address, data):
+        self.device.poke_byte(address, data)
+        self._record(op_poke_byte, address, data)
+
+    def read_block(self, address, wordcount):
+        data = self.device.read_block(address, wordcount)
+        self._record(op_read_block, address, wordcount, 0, data)
+        return data
+
+    def fill_words(self, address, word, wordcount):
+        self.device.fill_words(address, word, wordcount)
+        self._record(op_fill_words, address, word, wordcount)
+
+    def fill_bytes(self, address, byte, bytecount):
+        self.device.fill_bytes(address, byte, bytecount)
+        self._record(op_fill_bytes, address, byte, bytecount)
+
+    def write_block(self, address, data):
+        write_block(self.device, address, data)
+        self._record(op_write_block, address, len(data), 0, data)
+
+    def blx(self, address, r0 = 0, timeout = 30):
+        result = self.device.blx(address, r0, timeout=timeout)
+        self._record(op_blx, address, r0, result[0], struct.pack('<I', result[1] & 0xffffffff))
+        return result
+
+    def __getattr__(self, name):
+        # Fast reads use scsi_in, only if the device has it
+        if name != 'scsi_in':
+            raise AttributeError(name)
+        scsi_in = self.device.scsi_in
+        def fn(cdb, size):
+            data = scsi_in(cdb, size)
+            self._record(op_scsi_in, 0, size, len(cdb), bytes(cdb) + data)
+            return data
+        return fn
+
+
+class ReplayDevice(object):
+    """Device that answers from a RecordingDevice file, with no hardware.
+
+    If 'step' is given, playback starts at the first record from that step
+    or later, for resuming from a state saved partway through a recording.
+    """
+    def __init__(self, filename, step = 0):
+        with open(filename, 'rb') as f:
+            self.data = f.read()
+        if self.data[:len(replay_magic)] != replay_magic:
+            raise ValueError("Not a simulator recording")
+
+        # Records end where the index begins, if there is one
+        self.end = len(self.data)
+        self.index = []
+        if self.data.endswith(index_magic):
+            count, _ = index_footer.unpack_from(self.data, self.end - index_footer.size)
+            self.end -= index_footer.size + count * index_entry.size
+            self.index = [index_entry.unpack_from(self.data, self.end + i * index_entry.size)
+                          for i in range(count)]
+
+        self.step = 0
+        self.offset = len(replay_magic)
+        self.has_scsi_in = False
+        while self.offset < self.end:
+            if self._next()[0][1] == op_scsi_in:
+                self.has_scsi_in = True
+                break
+
+        self.offset = len(replay_magic)
+        for entry_step, offset in self.index:
+            if entry_step > step:
+                break
+            self.offset = offset
+        while self.offset < self.end and self._peek_record()[0] < step:
+            self._next()
+
+    def __repr__(self):
+        return 'ReplayDevice()'
+
+    def _peek_record(self):
+        return record_header.unpack_from(self.data, self.offset)
+
+    def _next(self):
+        record = self._peek_record()
+        payload_offset = self.offset + record_header.size
+        self.offset = payload_offset + record[5]
+        return record, self.data[payload_offset:self.offset]
+
+    def _expect(self, op, address, a = None, b = None):
+        # Next record, if it matches the operation. None matches anything.
+        # Returns the recorded (a, b, payload).
+        if self.offset >= self.end:
+            raise ReplayMismatch(self.step, 'end of recording', _describe(op, address, a, b))
+        (step, r_op, r_address, r_a, r_b, _), payload = self._next()
+        self.step = step
+        if ((r_op, r_address) != (op, address)
+                or (a is not None and r_a != a & 0xffffffff)
+                or (b is not None and r_b != b & 0xffffffff)):
+            raise ReplayMismatch(step,
+                _describe(r_op, r_address, r_a, r_b if b is not None else None),
+                _describe(op, address, a, b))
+        return r_a, r_b, payload
+
+    def peek(self, address):
+        return self._expect(op_peek, address)[0]
+
+    def poke(self, address, data):
+        self._expect(op_poke, address, data)
+
+    def peek_byte(self, address):
+        return self._expect(op_peek_byte, address)[0]
+
+    def poke_byte(self, address, data):
+        self._expect(op_poke_byte, address, data)
+
+    def read_block(self, address, wordcount):
+        return self._expect(op_read_block, address, wordcount)[2]
+
+    def fill_words(self, address, word, wordcount):
+        self._expect(op_fill_words, address, word, wordcount)
+
+    def fill_bytes(self, address, byte, bytecount):
+        self._expect(op_fill_bytes, address, byte, bytecount)
+
+    def write_block(self, address, data):
+        payload = self._expect(op_write_block, address, len(data))[2]
+        if payload != data:
+            raise ReplayMismatch(self.step, 'different data', _describe(op_write_block, address, len(data)))
+
+    def blx(self, address, r0 = 0, timeout = 30):
+        _, r0, payload = self._expect(op_blx, address, r0)
+        return r0, struct.unpack('<I', payload)[0]
+
+    def __getattr__(self, name):
+        if name != 'scsi_in' or not self.__dict__.get('has_scsi_in'):
+            raise AttributeError(name)
+        return self._scsi_in
+
+    def _scsi_in(self, cdb, size):
+        payload = self._expect(op_scsi_in, 0, size, len(cdb))[2]
+        if payload[:len(cdb)] != bytes(cdb):
+            raise ReplayMismatch(self.step, 'different CDB', _describe(op_scsi_in, 0, size, len(cdb)))
+        return payload[len(cdb):]
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+#
+# Binary execution trace for the ARM simulator.
+#
+# The text trace.log that %sim writes costs more to format than the
+# simulation itself: a summary and register dump on every step, plus two lines
+# for every memory access. A TraceWriter instead packs small binary records
+# into a buffer and writes it out in large chunks. Use on the command line, or
+# call render_trace(), to turn a binary trace back into the usual text log.
+#
+# File layout, all little-endian. After the magic, each record starts with a
+# one-byte type:
+#
+#   'S'     step: step count, PC, flags, register mask, then one word for each
+#           of r0-r14 set in the mask (registers that changed since last step)
+#   'I'     instruction text for an (address | thumb) key, first time seen
+#   'L'     load: size, address, data
+#   'W'     store: size, address, data
+#   'w'     skipped store: size, address, data, then a message string
+#   'F'     fill: size, address, pattern, count
+#   'P'     flash prefetch: address
+#   'T'     text written to the console, such as HLE and hook output
+#
+# Each writer starts over with a full register dump and its own instruction
+# strings, so a file can hold several %sim sessions appended end to end.
+
+__all__ = [
+    'TraceWriter', 'read_trace', 'render_trace',
+    'load_text', 'store_text', 'fill_text', 'prefetch_text',
+]
+
+import struct, sys
+
+trace_magic = b'SIMTR\x00\x01\x00'
+
+# Flush once this many bytes are buffered
+buffer_limit = 1 << 20
+
+step_header = struct.Struct('<cQIBH')
+reg_value = struct.Struct('<I')
+instr_header = struct.Struct('<cIH')
+mem_record = struct.Struct('<cBIII')
+text_header = struct.Struct('<cI')
+
+size_names = { 4: 'word', 2: 'half', 1: 'byte' }
+size_codes = { 'word': 4, 'half': 2, 'byte': 1 }
+
+flag_names = ('-N', '-Z', '-C', '-V', '-T')
+reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+             'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr')
+
+
+def load_text(address, data, size='word'):
+    return "arm-mem-LOAD  %4s[%08x] -> %08x\n" % (size, address, data)
+
+
+def _replayable_write(address, data, size):
+    # In addition to the human-friendly "arm-mem" logs, we log in a replayable format
+    if size == 'word':
+        return "%%wr %x %x\n" % (address, data)
+    elif size == 'byte':
+        return "%%wrb %x %x\n" % (address, data)
+    elif size == 'half':
+        return "%%wrb %x %x\n%%wrb %x %x\n" % (address, data & 0xff, address + 1, data >> 8)
+
+
+def store_text(address, data, size='word', message=''):
+    return "arm-mem-STORE %4s[%08x] <- %08x %s\n%s" % (
+        size, address, data, message, _replayable_write(address, data, size))
+
+
+def fill_text(address, pattern, count, size='word'):
+    parts = [ "arm-mem-FILL  %4s[%08x] <- %08x * %04x\n" % (size, address, pattern, count) ]
+    step = size_codes[size]
+    for i in range(count):
+        parts.append(_replayable_write(address + i * step, pattern, size))
+    return ''.join(parts)
+
+
+def prefetch_text(address):
+    return "arm-prefetch [%08x]\n" % address
+
+
+class TraceWriter(object):
+    """Buffered writer for binary simulator traces.
+
+    Also usable as a text file, so it can stand in for the log file when
+    capturing console output.
+    """
+    def __init__(self, f):
+        self.file = f
+        self.buffer = bytearray()
+        self.regs = [None] * 15
+        self.instructions = set()
+        if f.tell() == 0:
+            self.buffer += trace_magic
+
+    def _check(self):
+        if len(self.buffer) >= buffer_limit:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def step(self, arm):
+        """Record the state of the simulator, as of the next instruction"""
+        regs = arm.regs
+        pc = regs[15]
+        key = arm.thumb | (pc & ~1)
+        if key not in self.instructions:
+            instr = arm.get_next_instruction()
+            text = '\t'.join((arm.memory.note(instr.address), instr.op, instr.args)).encode('utf8')
+            self.buffer += instr_header.pack(b'I', key, len(text))
+            self.buffer += text
+            self.instructions.add(key)
+
+        last = self.regs
+        mask = 0
+        values = []
+        for i in range(15):
+            if regs[i] != last[i]:
+                last[i] = regs[i]
+                mask |= 1 << i
+                values.append(reg_value.pack(regs[i]))
+
+        flags = (bool(arm.cpsrN) | (bool(arm.cpsrZ) << 1) | (bool(arm.cpsrC) << 2) |
+                 (bool(arm.cpsrV) << 3) | (bool(arm.thumb) << 4))
+        self.buffer += step_header.pack(b'S', arm.step_count, pc, flags, mask)
+        self.buffer += b''.join(values)
+        self._check()
+
+    def load(self, address, data, size='word'):
+        self.buffer += mem_record.pack(b'L', size_codes[size], address, data, 0)
+        self._check()
+
+    def store(self, address, data, size='word', message=''):
+        if message:
+            message = message.encode('utf8')
+            self.buffer += mem_record.pack(b'w', size_codes[size], address, data, len(message))
+            self.buffer += message
+        else:
+            self.buffer += mem_record.pack(b'W', size_codes[size], address, data, 0)
+        self._check()
+
+    def fill(self, address, pattern, count, size='word'):
+        self.buffer += mem_record.pack(b'F', size_codes[size], address, pattern, count)
+        self._check()
+
+    def prefetch(self, address):
+        self.buffer += mem_record.pack(b'P', 0, address, 0, 0)
+        self._check()
+
+    def write(self, s):
+        """Record console text"""
+        data = s.encode('utf8')
+        self.buffer += text_header.pack(b'T', len(data))
+        self.buffer += data
+        self._check()
+
+
+def read_trace(data):
+    """Iterate over the records in a binary trace, given as bytes.
+
+    Yields tuples starting with the record type:
+        ('step', step_count, pc, flags, regs, note, op, args)
+        ('load' | 'store' | 'fill', address, data, size, count or message)
+        ('prefetch', address)
+        ('text', string)
+    where 'regs' is the full list of r0-r14 and 'flags' is a string like '-Z-C-T'.
+    """
+    if data[:8] != trace_magic:
+        raise ValueError("Not a simulator trace file")
+    offset = 8
+    regs = [0] * 15
+    instructions = {}
+
+    while offset < len(data):
+        kind = data[offset:offset+1]
+
+        if kind == b'S':
+            _, step_count, pc, flags, mask = step_header.unpack_from(data, offset)
+            offset += step_header.size
+            for i in range(15):
+                if mask & (1 << i):
+                    regs[i], = reg_value.unpack_from(data, offset)
+                    offset += reg_value.size
+            note, op, args = instructions[(flags >> 4) | (pc & ~1)]
+            flag_string = ''.join(n[(flags >> i) & 1] for i, n in enumerate(flag_names))
+            yield ('step', step_count, pc, flag_string, regs[:], note, op, args)
+
+        elif kind == b'I':
+            _, key, length = instr_header.unpack_from(data, offset)
+            offset += instr_header.size
+            instructions[key] = data[offset:offset + length].decode('utf8').split('\t', 2)
+            offset += length
+
+        elif kind in (b'L', b'W', b'w', b'F', b'P'):
+            _, size, address, value, count = mem_record.unpack_from(data, offset)
+            offset += mem_record.size
+            size = size_names.get(size)
+            if kind == b'L':
+                yield ('load', address, value, size, 0)
+            elif kind == b'W':
+                yield ('store', address, value, size, '')
+            elif kind == b'w':
+                yield ('store', address, value, size, data[offset:offset + count].decode('utf8'))
+                offset += count
+            elif kind == b'F':
+                yield ('fill', address, value, size, count)
+            else:
+                yield ('prefetch', address)
+
+        elif kind == b'T':
+            _, length = text_header.unpack_from(data, offset)
+            offset += text_header.size
+            yield ('text', data[offset:offset + length].decode('utf8'))
+            offset += length
+
+        else:
+            raise ValueError("Bad trace record type %r at offset %d" % (kind, offset))
+
+
+def render_trace(data, f):
+    """Write a binary trace to a text file, in the same format as trace.log"""
+    for record in read_trace(data):
+        kind = record[0]
+        if kind == 'step':
+            _, step_count, pc, flags, regs, note, op, args = record
+            summary = "%s %s >%08x %5s %-8s %s" % (
+                str(step_count).rjust(12, '.'), flags, pc & ~1, note, op, args)
+            f.write('# %-70s %s\n' % (summary,
+                ' '.join('%s=%08x' % (n, r) for n, r in zip(reg_names, regs))))
+        elif kind == 'load':
+            f.write(load_text(record[1], record[2], record[3]))
+        elif kind == 'store':
+            f.write(store_text(record[1], record[2], record[3], record[4]))
+        elif kind == 'fill':
+            f.write(fill_text(record[1], record[2], record[4], record[3]))
+        elif kind == 'prefetch':
+            f.write(prefetch_text(record[1]))
+        else:
+            f.write(record[1])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: %s trace.bin > trace.log" % sys.argv[0])
+        sys.exit(1)
+    with open(sys.argv[1], 'rb') as f:
+        render_trace(f.read(), sys.stdout)
@@ -0,0 +1,238 @@
+# Host-side decompressor for TS01 firmware overlays, and a cache of its results.
+#
+# The TS01 firmware decompresses higher-level code from flash into DRAM at
+# boot (doc/compressed-firmware-notes.txt). Simulating the decompressor takes
+# hours. Each compressed block begins with a header:
+#
+#   uint32_t    decompressed_size;
+#   uint32_t    compressed_size;
+#   uint8_t     table_a[0x120];
+#   uint8_t     table_b[0x20];
+#
+# The tables are code lengths for two canonical Huffman codes, assigned as in
+# DEFLATE (shorter codes first, then by symbol). The bitstream follows the
+# header and is read most significant bit first. Each table_a symbol is a
+# literal byte if below 0x100, otherwise a match of (symbol - 0xfd) bytes,
+# 3 to 34. A match continues with a table_b symbol and 7 more bits, together
+# the distance back into the output: 32 x 128 bytes, a 4 kB window. The block
+# ends after decompressed_size bytes.
+#
+# decompress() does that in Python, well under a second for the boot overlay. The
+# result is saved, so later sessions preload it into local memory and skip the
+# routine entirely. With 'check' the firmware's own decompressor also runs on
+# the hardware, and any difference from our image is an error.
+#
+# Cache files are named by a hash of the flash fingerprint (see sim_icache),
+# the source address, and the header, so they're only used for the same
+# compressed data.
+#
+# File layout, all little-endian:
+#
+#   magic, 20-byte source hash, r0 returned by the decompressor, size, data
+
+__all__ = [
+    'TS01Header', 'read_header', 'decompress',
+    'overlay_hash', 'overlay_filename',
+    'read_overlay', 'write_overlay', 'decompressed_overlay',
+    'cache_decompressor',
+]
+
+import struct, hashlib, os
+from dump import read_block
+from sim_icache import flash_fingerprint
+
+overlay_magic = b'SIMTS\x00\x01\x00'
+
+header_size = 8 + 0x120 + 0x20
+
+# Nothing we decompress can be larger than DRAM
+max_decompressed_size = 0x400000
+
+# Matches are 3 to 34 bytes, their distance is a table_b symbol and 7 bits
+min_match = 3
+distance_low_bits = 7
+
+
+class TS01Header(object):
+    """Header at the beginning of a compressed firmware block"""
+    def __init__(self, data):
+        if len(data) < header_size:
+            raise ValueError("Compressed header is %d bytes, expected %d" % (len(data), header_size))
+        self.data = bytes(data[:header_size])
+        self.decompressed_size, self.compressed_size = struct.unpack_from('<II', data)
+        self.table_a = self.data[8:8 + 0x120]
+        self.table_b = self.data[8 + 0x120:header_size]
+        if not 0 < self.decompressed_size <= max_decompressed_size:
+            raise ValueError("Doesn't look like compressed firmware, decompressed size %08x" % self.decompressed_size)
+
+    def __repr__(self):
+        return 'TS01Header(decompressed_size=%08x, compressed_size=%08x)' % (
+            self.decompressed_size, self.compressed_size)
+
+
+def _huffman_table(lengths):
+    # Canonical Huffman code as a lookup table, indexed by the next 'bits'
+    # bits of input. Returns (table of (symbol, length), bits).
+    bits = max(lengths)
+    table = [None] * (1 << bits)
+    code = 0
+    for length in range(1, bits + 1):
+        for symbol, l in enumerate(lengths):
+            if l == length:
+                if code >> length:
+                    raise ValueError("Huffman code lengths are oversubscribed")
+                shift = bits - length
+                table[code << shift:(code + 1) << shift] = [(symbol, length)] * (1 << shift)
+                code += 1
+        code <<= 1
+    if None in table:
+        raise ValueError("Huffman code lengths are incomplete")
+    return table, bits
+
+
+def decompress(data):
+    """Decompress a TS01 block, starting with its header. Returns the image."""
+    header = TS01Header(data)
+    literals, literal_bits = _huffman_table(header.table_a)
+    distances, distance_bits = _huffman_table(header.table_b)
+
+    # A few zeros at the end so we can always look ahead a full code
+    stream = bytes(data[header_size:]) + bytes(4)
+    size = header.decompressed_size
+    out = bytearray()
+    acc = nbits = pos = 0
+
+    try:
+        while len(out) < size:
+            while nbits < 24:
+                acc = ((acc << 8) | stream[pos]) & 0xffffffff
+                pos += 1
+                nbits += 8
+            symbol, length = literals[(acc >> (nbits - literal_bits)) & ((1 << literal_bits) - 1)]
+            nbits -= length
+            if symbol < 0x100:
+                out.append(symbol)
+                continue
+
+            while nbits < 24:
+                acc = ((acc << 8) | stream[pos]) & 0xffffffff
+                pos += 1
+                nbits += 8
+            high, length = distances[(acc >> (nbits - distance_bits)) & ((1 << distance_bits) - 1)]
+            nbits -= length + distance_low_bits
+            distance = (high << distance_low_bits) | ((acc >> nbits) & ((1 << distance_low_bits) - 1))
+            count = symbol - 0x100 + min_match
+
+            if not 0 < distance <= len(out):
+                raise ValueError("Match distance %d at output offset %x is out of range" % (distance, len(out)))
+            if distance >= count:
+                begin = len(out) - distance
+                out += out[begin:begin + count]
+            else:
+                for i in range(count):
+                    out.append(out[-distance])
+    except IndexError:
+        raise ValueError("Compressed data ends after %d of %d bytes" % (len(out), size))
+
+    return bytes(out[:size])
+
+
+def read_header(memory, src):
+    """Read the header of a compressed block through a SimARMMemory.
+    It's in flash, so it stays in the local cache.
+    """
+    if memory.local_data_available(src, header_size) < header_size:
+        memory.fetch_local_data(src, header_size)
+    return TS01Header(memory.local.read(src, header_size))
+
+
+def overlay_hash(memory, src, header):
+    fingerprint = getattr(memory, 'icache_fingerprint', None) or flash_fingerprint(memory)
+    h = hashlib.sha1(fingerprint)
+    h.update(struct.pack('<I', src))
+    h.update(header.data)
+    return h.digest()
+
+
+def overlay_filename(source_hash, directory = '.'):
+    return os.path.join(directory, 'sim-ts01-%s.bin' % source_hash.hex()[:16])
+
+
+def write_overlay(filename, source_hash, r0, data):
+    # Write atomically, another session may be reading this file
+    tempname = filename + '.tmp'
+    with open(tempname, 'wb') as f:
+        f.write(overlay_magic + source_hash + struct.pack('<II', r0, len(data)) + bytes(data))
+    os.replace(tempname, filename)
+
+
+def read_overlay(filename, source_hash):
+    """Read a cache file, returning (r0, data), or None if the file is
+    missing, damaged, or for other compressed data.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+
+    if data[:8] != overlay_magic or data[8:28] != source_hash:
+        return None
+    r0, size = struct.unpack_from('<II', data, 28)
+    image = data[36:]
+    if len(image) != size:
+        return None
+    return r0, image
+
+
+def decompressed_overlay(memory, function, src, dest, directory = '.', check = False):
+    """Decompressed image for the block at 'src', as (r0, data).
+    Comes from the cache if we can, otherwise from decompress(). With 'check',
+    the decompressor 'function' also runs on the hardware with (src, dest),
+    and a ValueError says where its result differs from ours.
+    """
+    header = read_header(memory, src)
+    source_hash = overlay_hash(memory, src, header)
+    filename = overlay_filename(source_hash, directory)
+
+    cached = read_overlay(filename, source_hash)
+    if cached and not check:
+        print("* Loaded decompressed firmware from %s" % filename)
+        return cached
+
+    compressed = read_block(memory.device, src, header_size + header.compressed_size, fast=True)
+    data = decompress(compressed)
+
+    # Not seen any caller look at the result; until 'check' says otherwise,
+    # assume it's the number of bytes written.
+    r0 = len(data)
+
+    if check:
+        r0, _ = memory.offload_call(function, (src, dest), writes=[(dest, len(data))],
+            name='firmware decompression')
+        device_data = read_block(memory.device, dest, len(data), fast=True)
+        if device_data != data:
+            offset = next(i for i in range(len(data)) if device_data[i] != data[i])
+            raise ValueError("Hardware decompressed %08x differently, first at %08x (%02x, expected %02x)" % (
+                src, dest + offset, device_data[offset], data[offset]))
+        print("* Hardware decompressor agrees, %d bytes" % len(data))
+
+    write_overlay(filename, source_hash, r0, data)
+    print("* Saved decompressed firmware to %s" % filename)
+    return r0, data
+
+
+def cache_decompressor(memory, address, thumb = True, directory = '.', check = False):
+    """Replace a decompressor taking (src, dest) with decompress(), cached.
+    The image is written to local memory at 'dest' and r0 gets the value
+    the real decompressor returns. DRAM outside local_ram() is demand paged,
+    so a local copy there is written back like any other store.
+    """
+    function = thumb | (address & ~1)
+    def fn(arm):
+        src, dest = arm.regs[0], arm.regs[1]
+        r0, data = decompressed_overlay(arm.memory, function, src, dest, directory, check)
+        arm.memory.page_in(dest, len(data))
+        arm.memory.local.write(dest, data)
+        arm.regs[0] = r0
+    memory.replace_function(address, fn, 'TS01 decompressor', thumb)
@@ -21,6 +21,10 @@ shell_code = 0x1e40000
 
 hook_code  = 0x1e44000
 
+# Thunk for functions the simulator runs on hardware, see SimARMMemory.offload()
+
+offload_code = 0x1e47000
+
 # Backdoor stubs
 
 bitbang_backdoor = 0x1e48000
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 from struct import pack, unpack
 from binascii import a2b_hex, b2a_hex
-import random, struct, remote, hilbert
+import random, struct, sys, remote, hilbert
 from dump import *
 from code import *
 d = remote.Device()
@@ -85,4 +85,28 @@ assert d.peek(pad + 0x8) == 0x1234
 assert d.peek(pad + 0xc) == 0xf00f
 assert d.peek(pad + 0x10) == 0xffffffff
 
+# Block writes then reads. The length isn't a multiple of the 1 kB chunks
+# BitbangDevice sends. Here it's a poke per word, the fallback for devices
+# without block writes.
+def test_write_block(d, wordcount = 0x123):
+	pattern = [random.randint(0, 0xffffffff) for i in range(wordcount)]
+	write_block(d, pad, struct.pack('<%dI' % wordcount, *pattern))
+	assert words_from_string(read_block(d, pad, wordcount * 4)) == tuple(pattern)
+test_write_block(d)
+
+# With a serial port on the command line, also check the bitbang backdoor's
+# block write (0x69) and its fallback for builds without it. This switches
+# the drive to bitbang mode, and back again.
+if len(sys.argv) > 1:
+	from bitbang import bitbang_backdoor, BitbangDevice
+	import target_memory
+	bitbang_backdoor(d, target_memory.bitbang_backdoor)
+	b = BitbangDevice(sys.argv[1])
+	assert b.has_write_block, "Signature doesn't mention write block"
+	test_write_block(b)
+	b.has_write_block = False
+	test_write_block(b)
+	b.has_write_block = True
+	b.exit()
+
 print("Looks good!")